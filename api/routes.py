@@ -1,43 +1,84 @@
 import logging
-from flask import Blueprint, jsonify, request
-from models import TelegramMessage
+import math
+from datetime import datetime, timedelta
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from sqlalchemy import and_, func, or_, select
+from models import (ChangeVersion, MessageBody, NearDuplicate, Sender,
+                    TelegramMessage)
+import bodies
+import changes
+import content_codec
+import participants
+import trending
 from .auth import require_api_key
 from app import db
+from db_routing import read_only
+from versions import conditional
+from export import (EXPORT_FORMATS, DEFAULT_BATCH_SIZE, ExportUnavailable,
+                    export_chunks, parse_bool, parse_datetime)
+from .serialization import (NotAcceptable, parse_fields, render,
+                            rows_to_dicts, select_messages)
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 api = Blueprint('api', __name__)
 
+def _requested_fields():
+    return parse_fields(request.args.get('fields'), request.args.get('exclude'))
+
+
 @api.route('/messages', methods=['GET'])
+@read_only
 @require_api_key
+@conditional(channel_arg='channel')
 def get_messages():
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = min(request.args.get('per_page', 10, type=int), 100)
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 10, type=int), 1), 100)
         channel = request.args.get('channel')
+        body_hash = request.args.get('body_hash')
+        sender_id = request.args.get('sender_id')
+        fields = _requested_fields()
 
-        query = TelegramMessage.query
-
+        query = select_messages(fields)
+        total = select(func.count()).select_from(TelegramMessage)
         if channel:
-            query = query.filter_by(channel_title=channel)
+            query = query.where(TelegramMessage.channel_title == channel)
+            total = total.where(TelegramMessage.channel_title == channel)
+        if body_hash:
+            # Every copy of a shared body
+            query = query.where(TelegramMessage.body_hash == body_hash)
+            total = total.where(TelegramMessage.body_hash == body_hash)
+        if sender_id:
+            # Served by the (sender_id, timestamp) index
+            query = query.where(TelegramMessage.sender_id == sender_id)
+            total = total.where(TelegramMessage.sender_id == sender_id)
 
-        messages = query.order_by(TelegramMessage.timestamp.desc())\
-                       .paginate(page=page, per_page=per_page)
+        rows = db.session.execute(
+            query.order_by(TelegramMessage.timestamp.desc())
+            .limit(per_page).offset((page - 1) * per_page)).all()
+        total = db.session.scalar(total)
 
-        return jsonify({
-            'messages': [msg.to_dict() for msg in messages.items],
-            'total': messages.total,
-            'pages': messages.pages,
-            'current_page': messages.page
+        return render({
+            'messages': rows_to_dicts(fields, rows),
+            'total': total,
+            'pages': math.ceil(total / per_page),
+            'current_page': page
         })
 
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error in get_messages: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @api.route('/channels', methods=['GET'])
+@read_only
 @require_api_key
+@conditional()
 def get_channels():
     try:
         channels = db.session.query(TelegramMessage.channel_title)\
@@ -51,22 +92,299 @@ def get_channels():
         return jsonify({'error': str(e)}), 500
 
 @api.route('/search', methods=['GET'])
+@read_only
 @require_api_key
+@conditional()
 def search_messages():
     try:
         query = request.args.get('q')
         if not query:
             return jsonify({'error': 'Search query required'}), 400
+        fields = _requested_fields()
 
-        messages = TelegramMessage.query\
-            .filter(TelegramMessage.content.ilike(f'%{query}%'))\
-            .order_by(TelegramMessage.timestamp.desc())\
-            .limit(100)\
-            .all()
+        match = bodies.CONTENT.ilike(f'%{query}%')
+        if content_codec.in_use(db.session):
+            # Compressed content is matched in Python
+            match = or_(match, TelegramMessage.id.in_(
+                content_codec.search_compressed(db.session, query, 100)))
 
-        return jsonify({
-            'messages': [msg.to_dict() for msg in messages]
-        })
+        rows = db.session.execute(
+            select_messages(fields, with_bodies=True)
+            .where(match)
+            .order_by(TelegramMessage.timestamp.desc())
+            .limit(100)).all()
+
+        return render({'messages': rows_to_dicts(fields, rows)})
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error in search_messages: {str(e)}")
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/duplicates', methods=['GET'])
+@read_only
+@require_api_key
+@conditional()
+def get_duplicates():
+    """Message bodies seen in the most chats"""
+    try:
+        min_chats = max(request.args.get('min_chats', 2, type=int), 1)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+
+        rows = db.session.execute(
+            select(MessageBody.hash, MessageBody.chat_count,
+                   MessageBody.message_count, MessageBody.first_channel_id,
+                   MessageBody.first_message_id, MessageBody.first_seen_at,
+                   MessageBody.content, MessageBody.content_zstd,
+                   MessageBody.content_dict_id)
+            .where(MessageBody.chat_count >= min_chats)
+            .order_by(MessageBody.chat_count.desc(),
+                      MessageBody.first_seen_at.desc())
+            .limit(limit)).all()
+
+        fields = ['hash', 'seen_in', 'message_count', 'first_channel_id',
+                  'first_message_id', 'first_seen_at', 'content']
+        return render({'bodies': rows_to_dicts(fields, rows)})
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except Exception as e:
+        logger.error(f"Error in get_duplicates: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def _same_message(model):
+    return and_(model.channel_id == TelegramMessage.channel_id,
+                model.message_id == TelegramMessage.message_id)
+
+
+@api.route('/near-duplicates', methods=['GET'])
+@read_only
+@require_api_key
+@conditional()
+def get_near_duplicates():
+    """Clusters of near-identical messages seen in the last `hours`"""
+    try:
+        hours = min(max(request.args.get('hours', 24, type=int), 1), 24 * 90)
+        min_chats = max(request.args.get('min_chats', 2, type=int), 1)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        since = datetime.utcnow() - timedelta(hours=hours)
+
+        seen_in = func.count(func.distinct(NearDuplicate.channel_id))
+        message_count = func.count()
+        clusters = db.session.execute(
+            select(NearDuplicate.cluster_id, message_count, seen_in,
+                   func.min(NearDuplicate.timestamp),
+                   func.max(NearDuplicate.timestamp))
+            .where(NearDuplicate.timestamp >= since)
+            .group_by(NearDuplicate.cluster_id)
+            .having(seen_in >= min_chats)
+            .order_by(seen_in.desc(), message_count.desc(),
+                      func.max(NearDuplicate.timestamp).desc())
+            .limit(limit)).all()
+
+        # The earliest message of each cluster in the window stands for it
+        samples = {}
+        if clusters:
+            rows = db.session.execute(
+                bodies.join_bodies(select(NearDuplicate.cluster_id,
+                                          bodies.CONTENT,
+                                          *bodies.STORED_COLUMNS))
+                .join(NearDuplicate, _same_message(NearDuplicate))
+                .where(NearDuplicate.cluster_id.in_(
+                           [cluster[0] for cluster in clusters]),
+                       NearDuplicate.timestamp >= since)
+                .order_by(NearDuplicate.timestamp.desc())).all()
+            samples = {row['cluster_id']: row['content'] for row in
+                       rows_to_dicts(['cluster_id', 'content'], rows)}
+
+        fields = ['cluster_id', 'message_count', 'seen_in', 'first_seen',
+                  'last_seen']
+        return render({'hours': hours, 'clusters': [
+            dict(zip(fields, cluster), content=samples.get(cluster[0]))
+            for cluster in clusters]})
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except Exception as e:
+        logger.error(f"Error in get_near_duplicates: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/near-duplicates/<cluster_id>', methods=['GET'])
+@read_only
+@require_api_key
+@conditional()
+def get_near_duplicate_cluster(cluster_id):
+    """Messages of one near-duplicate cluster, oldest first"""
+    try:
+        fields = _requested_fields()
+        rows = db.session.execute(
+            select_messages(fields)
+            .join(NearDuplicate, _same_message(NearDuplicate))
+            .where(NearDuplicate.cluster_id == cluster_id)
+            .order_by(TelegramMessage.timestamp)
+            .limit(500)).all()
+        if not rows:
+            return jsonify({'error': 'Cluster not found'}), 404
+        return render({'cluster_id': cluster_id,
+                       'messages': rows_to_dicts(fields, rows)})
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in get_near_duplicate_cluster: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/trending', methods=['GET'])
+@read_only
+@require_api_key
+@conditional(channel_arg='channel')
+def get_trending():
+    """Most frequent terms, hashtags, links or mentions of the last period"""
+    try:
+        period = request.args.get('period', 'day')
+        kind = request.args.get('kind', 'terms')
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        channel = request.args.get('channel')
+
+        scope = trending.GLOBAL_SCOPE
+        if channel:
+            # change_versions maps titles to channel ids in one indexed read
+            scope = db.session.execute(
+                select(ChangeVersion.scope)
+                .where(ChangeVersion.channel_title == channel)
+                .limit(1)).scalar()
+            if scope is None:
+                return jsonify({'error': 'Channel not found'}), 404
+
+        items, messages = trending.top(db.session, period, kind, scope, limit)
+        return render({'period': period, 'kind': kind, 'channel': channel,
+                       'messages': messages, 'items': items})
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in get_trending: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/senders/<sender_id>', methods=['GET'])
+@read_only
+@require_api_key
+@conditional()
+def get_sender(sender_id):
+    """A message author as last seen by the collector"""
+    try:
+        sender = db.session.get(Sender, sender_id)
+        if sender is None:
+            return jsonify({'error': 'Sender not found'}), 404
+        return render({column.name: getattr(sender, column.name)
+                       for column in Sender.__table__.columns})
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except Exception as e:
+        logger.error(f"Error in get_sender: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/participants', methods=['GET'])
+@read_only
+@require_api_key
+@conditional()
+def get_participants():
+    """Channels by estimated unique senders, over all time or `days`"""
+    try:
+        days = request.args.get('days', type=int)
+        if days is not None:
+            days = min(max(days, 1), 366)
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 500)
+
+        total, channels = participants.leaderboard(db.session, days, limit)
+        return render({'days': days, 'participants': total, 'channels': [
+            {'channel_id': channel_id, 'channel_title': title,
+             'participants': estimate}
+            for channel_id, title, estimate in channels]})
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except Exception as e:
+        logger.error(f"Error in get_participants: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Fields every change carries, whatever `fields=` asks for
+CHANGE_FIELDS = ['change_seq', 'channel_id', 'message_id', 'edit_date']
+
+@api.route('/changes', methods=['GET'])
+@read_only
+@require_api_key
+@conditional()
+def get_changes():
+    """Inserts, edits and deletions numbered above `after`, in commit order"""
+    try:
+        after = max(request.args.get('after', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        fields = CHANGE_FIELDS + [f for f in _requested_fields()
+                                  if f not in CHANGE_FIELDS]
+
+        found = changes.read_changes(db.session, select_messages(fields),
+                                     after, limit)
+        messages = iter(rows_to_dicts(
+            fields, [row for op, _, row in found if op != 'delete']))
+        result = []
+        for op, seq, row in found:
+            if op == 'delete':
+                result.append({'seq': seq, 'op': op,
+                               'channel_id': row.channel_id,
+                               'message_id': row.message_id,
+                               'deleted_at': row.deleted_at})
+            else:
+                result.append({'seq': seq, 'op': op, 'message': next(messages)})
+
+        return render({
+            'changes': result,
+            'next': result[-1]['seq'] if result else after,
+            'last_seq': changes.last_seq(db.session),
+            'has_more': len(result) == limit,
+        })
+    except NotAcceptable as e:
+        return jsonify({'error': str(e)}), 406
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in get_changes: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/export', methods=['GET'])
+@read_only
+@require_api_key
+def export_messages():
+    """Stream the message cache as JSON Lines, CSV or Parquet"""
+    try:
+        fmt = request.args.get('format', 'jsonl')
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+
+        chunks = export_chunks(
+            db.session,
+            fmt,
+            batch_size=min(request.args.get('batch_size', DEFAULT_BATCH_SIZE,
+                                            type=int), 50000),
+            channel=request.args.get('channel'),
+            channel_id=request.args.get('channel_id'),
+            since=parse_datetime(request.args.get('since')),
+            until=parse_datetime(request.args.get('until')),
+            is_ton_dev=parse_bool(request.args.get('is_ton_dev')),
+            is_outgoing=parse_bool(request.args.get('is_outgoing')),
+            dialog_type=request.args.get('dialog_type'))
+
+        return Response(stream_with_context(chunks),
+                        mimetype=EXPORT_FORMATS[fmt],
+                        headers={
+                            'Content-Disposition':
+                            f'attachment; filename=messages.{fmt}'
+                        })
+    except ExportUnavailable as e:
+        return jsonify({'error': str(e)}), 501
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in export_messages: {str(e)}")
+        return jsonify({'error': str(e)}), 500
@@ -0,0 +1,141 @@
+"""Column-level reads and fast encoding for the API list endpoints.
+
+List endpoints select only the columns a client asked for as plain Core rows,
+skipping ORM instances and identity-map bookkeeping, and encode them with
+orjson when it is installed. Clients choose columns with `fields=` or drop
+some with `exclude=` (e.g. `exclude=content` for listings), and can ask for
+MessagePack instead of JSON with `Accept: application/msgpack`, which needs
+the optional `msgpack` package.
+"""
+import json
+from datetime import datetime
+
+from flask import Response, request
+from sqlalchemy import select
+
+import bodies
+import content_codec
+from export import EXPORT_COLUMNS
+from models import TelegramMessage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# `seen_in` is the number of chats the message body was seen in
+MESSAGE_FIELDS = EXPORT_COLUMNS + [
+    'body_hash', 'fwd_from_id', 'fwd_from_message_id', 'fwd_date',
+    'sender_id', 'change_seq', 'edit_date', 'seen_in'
+]
+
+# Fields that are not plain TelegramMessage columns; both need the bodies join
+_EXPRESSIONS = {
+    'content': bodies.CONTENT,
+    'seen_in': bodies.SEEN_IN,
+}
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+class NotAcceptable(Exception):
+    """The client only accepts an encoding we cannot produce"""
+
+
+def parse_fields(fields=None, exclude=None):
+    """Columns to return for `fields=` and `exclude=` query parameters
+
+    Both take comma-separated column names; unknown names raise ValueError.
+    """
+    selected = _split(fields) or list(MESSAGE_FIELDS)
+    excluded = set(_split(exclude))
+    unknown = (set(selected) | excluded) - set(MESSAGE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    selected = [f for f in selected if f not in excluded]
+    if not selected:
+        raise ValueError("No fields selected")
+    return selected
+
+
+def _split(value):
+    if not value:
+        return []
+    names = []
+    for name in value.split(','):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def select_messages(fields, with_bodies=False):
+    """SELECT of the given TelegramMessage columns, ready for filters
+
+    With `content`, the compressed columns are selected too, for
+    rows_to_dicts to decode. message_bodies is joined when a field needs it
+    or `with_bodies` is set.
+    """
+    columns = [_EXPRESSIONS[f].label(f) if f in _EXPRESSIONS else
+               getattr(TelegramMessage, f) for f in fields]
+    if 'content' in fields:
+        columns.extend(bodies.STORED_COLUMNS)
+    query = select(*columns)
+    if with_bodies or _EXPRESSIONS.keys() & set(fields):
+        query = bodies.join_bodies(query)
+    return query
+
+
+def rows_to_dicts(fields, rows):
+    if 'content' in fields:
+        rows = content_codec.decode_rows(rows, fields.index('content'))
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def dumps_json(payload):
+    if orjson is not None:
+        # Naive datetimes come out as isoformat() does, like the stdlib path
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=_default, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def dumps_msgpack(payload):
+    return msgpack.packb(payload, default=_default, use_bin_type=True)
+
+
+def negotiate():
+    """Pick the response encoding from the Accept header"""
+    offered = [JSON_MIMETYPE]
+    if msgpack is not None:
+        offered.extend(MSGPACK_MIMETYPES)
+    accept = request.accept_mimetypes
+    if not accept.provided:
+        return JSON_MIMETYPE
+    best = accept.best_match(offered)
+    if best is None:
+        raise NotAcceptable(
+            f"Supported encodings: {', '.join(offered)}")
+    return best
+
+
+def render(payload, status=200):
+    """Encode `payload` as JSON or MessagePack, whichever the client accepts"""
+    mimetype = negotiate()
+    if mimetype == JSON_MIMETYPE:
+        body = dumps_json(payload)
+    else:
+        body = dumps_msgpack(payload)
+    return Response(body, status=status, mimetype=mimetype)
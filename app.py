@@ -3,74 +3,10 @@ import logging
 from flask import Flask, redirect
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
-import atexit
 
-collector_thread = None
-
-
-def start_collector():
-    """Initialize and start the collector thread"""
-    global collector_thread
-    logger.info("Starting collector thread...")
-    try:
-        # Stop existing collector if running
-        if collector_thread and collector_thread.is_alive():
-            logger.info("Stopping existing collector thread...")
-            # The thread will exit gracefully on next iteration
-            import time
-            time.sleep(1)  # Give a brief moment for thread to clean up
-
-        # Check if session exists and is valid
-        session_path = os.path.join(os.environ.get('REPL_HOME', ''),
-                                    'ton_collector_session.session')
-        session_valid = os.path.exists(session_path) and os.path.getsize(
-            session_path) > 0
-
-        if not session_valid:
-            logger.warning(
-                "No valid session found. Collector will start but may not collect messages until setup is complete."
-            )
-
-        # Reload the collector module to refresh state
-        import importlib
-        import sys
-        if 'collector' in sys.modules:
-            importlib.reload(sys.modules['collector'])
-
-        # Start new collector thread
-        from collector import ensure_single_collector
-        ensure_single_collector()
-
-        # Get the updated thread reference
-        from collector import collector_thread as ct
-        collector_thread = ct
-
-        # Verify the thread was created and is running
-        if collector_thread and collector_thread.is_alive():
-            logger.info("Collector thread started successfully")
-            return True
-        else:
-            logger.error("Collector thread was not started properly")
-            return False
-    except Exception as e:
-        logger.error(f"Failed to start collector: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
-        # Don't let collector failure prevent web server from starting
-        return False
-
-
-# Register cleanup function
-def cleanup():
-    """Cleanup function to be called on shutdown"""
-    if collector_thread and collector_thread.is_alive():
-        logger.info("Shutting down collector thread...")
-
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Configure logging, level and format come from LOG_LEVEL and LOG_FORMAT
+from logging_setup import configure_logging  # noqa: E402
+configure_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -79,7 +15,12 @@ class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+# Read-only views can be routed to replicas, see db_routing.py
+from db_routing import RoutingSession, engine_options, replica_binds  # noqa: E402
+from config import Config  # noqa: E402
+import sqlite_profile  # noqa: E402
+
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 
 # Create Flask app
 app = Flask(__name__)
@@ -87,33 +28,33 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET")
 
 # configure the database, relative to the app instance folder
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-    "pool_size": 5,
-    "max_overflow": 10,
-    "connect_args": {
-        "connect_timeout": 30,
-        "options": "-c statement_timeout=30000"
-    }
-}
+database_url = os.environ.get("DATABASE_URL")
+app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+    database_url, Config.DB_POOL_SIZE, Config.DB_MAX_OVERFLOW)
+app.config["SQLALCHEMY_BINDS"] = replica_binds(Config.DATABASE_REPLICA_URLS) or \
+    sqlite_profile.reader_binds(database_url,
+                                app.config["SQLALCHEMY_ENGINE_OPTIONS"])
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False  # Added from original
 
 # initialize the app with the extension, flask-sqlalchemy >= 3.0.x
 db.init_app(app)
-
 with app.app_context():
-    # Make sure to import the models here or their tables won't be created
-    import models  # noqa: F401
-    try:
-        db.create_all()
+    # WAL and tuned pragmas when running on a SQLite file
+    sqlite_profile.configure_engines(db.engines)
+
+# Prometheus request instrumentation and the /metrics endpoint
+import metrics  # noqa: E402
+metrics.init_app(app)
 
-        start_collector()
+# Statement timing, slow-query log and per-request SQL profiles
+import profiling  # noqa: E402
+profiling.init_app(app)
 
-        # Register cleanup
-        atexit.register(cleanup)
+# gzip for large JSON and HTML responses
+import compression  # noqa: E402
+compression.init_app(app)
 
-    except Exception as e:
-        logger.error(f"Failed to start server: {str(e)}")
-        raise
+# Register the models on db.metadata; tables are created out-of-band by
+# `python manage.py init-db`, not by every process that imports the app
+import models  # noqa: E402,F401
@@ -0,0 +1,17 @@
+"""ASGI entry point for serving the app with an ASGI server.
+
+    pip install .[asgi]
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+The Telegram setup views (/setup_process, /verify_code) are async views
+that await the shared gateway loop (telegram_gateway.py) rather than block
+on it. Flask still runs each async view to completion in the request's
+thread, so under this wrapper a request holds a server pool thread as it
+does under gunicorn; serving them from the ASGI server's own event loop
+would need an ASGI-native framework such as Quart, which is not done here.
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+from main import app
+
+application = WsgiToAsgi(app)
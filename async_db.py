@@ -0,0 +1,590 @@
+"""Async persistence layer used by the collector.
+
+The collector is an asyncio program, so its reads and bulk writes go through
+SQLAlchemy's asyncio extension (asyncpg for PostgreSQL, aiosqlite for
+SQLite) instead of Flask-SQLAlchemy's synchronous session. It needs no Flask
+app context, has its own small connection pool, and commits no longer block
+the event loop, so Telegram updates keep flowing while a batch is written.
+
+The engine is built from the same DATABASE_URL as the web app, with the
+driver swapped for its async counterpart.
+
+On SQLite the store is the single writer: it holds one connection and
+keeps a transaction open across dialogs, committing every
+SQLITE_BATCH_ROWS messages and whenever the heartbeat is saved (at the
+start and end of each cycle). Reads go through the same connection, so
+uncommitted rows are already visible to the collector; after a crash the
+lost rows are simply fetched again. The change handlers write through that
+session too, from their own tasks, so every read, write and commit of it
+holds a lock for its duration.
+
+With a spool (spool.py), writes are appended to it before they reach the
+database and replayed from it in order, so the collector keeps going while
+the database is away. The spool checkpoint only moves on commit: a rolled
+back batch transaction is replayed again.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from config import Config
+import sqlite_profile
+from models import (CollectorHeartbeat, ContentDictionary, DialogLag,
+                    HOT_WINDOW_DAYS, MessageTombstone, TelegramEntity,
+                    TelegramMessage)
+import bodies
+import changes
+import content_codec
+import metrics
+import near_duplicates
+import participants
+import trending
+import versions
+from spool import Spool
+
+logger = logging.getLogger(__name__)
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+ENTITY_FIELDS = ('id', 'access_hash', 'peer_type', 'dialog_type', 'username',
+                 'title', 'is_dialog', 'archived')
+
+
+def async_database_url(url):
+    """Swap the driver of a sync database URL for its async counterpart"""
+    url = make_url(url.replace('postgres://', 'postgresql://', 1)
+                   if isinstance(url, str) else url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == 'postgresql' and 'sslmode' in url.query:
+        # asyncpg spells libpq's sslmode as ssl
+        query = dict(url.query)
+        query['ssl'] = query.pop('sslmode')
+        url = url.set(query=query)
+    return url
+
+
+def create_collector_engine(database_url=None):
+    """Async engine with a pool sized for the collector alone"""
+    url = async_database_url(database_url or os.environ.get('DATABASE_URL'))
+    options = {'pool_pre_ping': True, 'pool_recycle': 300}
+    if url.get_backend_name() == 'postgresql':
+        options.update({
+            'pool_size': Config.COLLECTOR_DB_POOL_SIZE,
+            'max_overflow': Config.COLLECTOR_DB_MAX_OVERFLOW,
+            'connect_args': {
+                'timeout': 30,
+                'server_settings': {
+                    'statement_timeout': '30000'
+                }
+            }
+        })
+        return create_async_engine(url, **options)
+
+    # SQLite allows one writer at a time; keep exactly one connection
+    options.update({'pool_size': 1, 'max_overflow': 0})
+    engine = create_async_engine(url, **options)
+    if sqlite_profile.is_sqlite_file(url):
+        sqlite_profile.install_pragmas(engine.sync_engine)
+    return engine
+
+
+class CollectorStore:
+    """Reads and writes the collector needs, on an async engine"""
+
+    def __init__(self, engine, batch_rows=None, spool=None):
+        self.engine = engine
+        self.session = async_sessionmaker(engine, expire_on_commit=False)
+        # With batch_rows, writes share one open transaction
+        self.batch_rows = batch_rows
+        self._batch = None
+        self._pending = 0
+        # The batch session is shared by the cycle and the change handlers,
+        # which run as separate tasks; one use of it at a time
+        self._batch_lock = asyncio.Lock()
+        # Compresses content when CONTENT_COMPRESSION is set
+        self.codec = None
+        self._codec_loaded = 0.0
+        # Built from the recent messages on first use when NEAR_DUP is set
+        self.near_duplicates = None
+        self._trending_pruned = 0.0
+        # Writes go through the spool when one is given
+        self.spool = spool
+        self._replaying = asyncio.Lock()
+        self._replay_at = 0.0
+        self._replay_delay = 0.0
+
+    @classmethod
+    def from_url(cls, database_url=None, spool_dir=None):
+        engine = create_collector_engine(database_url)
+        batch_rows = Config.SQLITE_BATCH_ROWS \
+            if engine.dialect.name == 'sqlite' else None
+        return cls(engine, batch_rows, Spool(spool_dir) if spool_dir else None)
+
+    async def commit(self):
+        """Commit the batch transaction, if any"""
+        async with self._batch_lock:
+            await self._commit()
+
+    async def _commit(self):
+        if self._batch is not None and self._batch.in_transaction():
+            try:
+                await self._batch.commit()
+            except Exception:
+                await self._rollback()
+                raise
+        self._pending = 0
+        if self.spool is not None:
+            self.spool.checkpoint()
+
+    async def close(self):
+        try:
+            async with self._batch_lock:
+                if self._batch is not None:
+                    try:
+                        await self._commit()
+                    finally:
+                        await self._batch.close()
+                        self._batch = None
+        finally:
+            if self.spool is not None:
+                self.spool.close()
+            await self.engine.dispose()
+
+    async def _rollback(self):
+        """Drop the batch transaction; spooled writes in it replay again"""
+        await self._batch.rollback()
+        self._pending = 0
+        if self.spool is not None:
+            self.spool.rewind()
+
+    @contextlib.asynccontextmanager
+    async def _reading(self):
+        if self.batch_rows is None:
+            async with self.session() as session:
+                yield session
+            return
+
+        async with self._batch_lock:
+            try:
+                yield self._batch_session()
+            except Exception:
+                await self._rollback()
+                raise
+
+    @contextlib.asynccontextmanager
+    async def _writing(self, rows=0, commit=False):
+        if self.batch_rows is None:
+            async with self.session() as session, session.begin():
+                yield session
+            return
+
+        async with self._batch_lock:
+            session = self._batch_session()
+            try:
+                yield session
+                await session.flush()
+            except Exception:
+                # Everything since the last commit is lost and will be
+                # fetched again, or replayed from the spool
+                await self._rollback()
+                raise
+            self._pending += rows
+            if commit or self._pending >= self.batch_rows:
+                await self._commit()
+
+    def _batch_session(self):
+        """The shared batch session; callers hold _batch_lock"""
+        if self._batch is None:
+            self._batch = self.session()
+        return self._batch
+
+    async def latest_message(self, channel_id):
+        """(message_id, timestamp) of the newest stored message, or None
+
+        Messages waiting in the spool count as stored. While the database
+        is unreachable only they are known, and messages fetched again are
+        dropped on replay.
+        """
+        try:
+            async with self._reading() as session:
+                result = await session.execute(
+                    select(TelegramMessage.message_id,
+                           TelegramMessage.timestamp).where(
+                               TelegramMessage.channel_id == channel_id)
+                    .order_by(TelegramMessage.message_id.desc()).limit(1))
+                latest = result.first()
+        except Exception:
+            if self.spool is None:
+                raise
+            latest = None
+        if self.spool is not None:
+            spooled = self.spool.high_water.get(channel_id)
+            if spooled is not None and (
+                    latest is None or spooled.message_id > latest.message_id):
+                return spooled
+        return latest
+
+    async def recent_timestamps(self, channel_ids, limit):
+        """Dates of up to `limit` newest messages per channel, in one query
+
+        Only the hot window is looked at, so dialogs that were quiet for
+        longer get no seed, as if they were new.
+        """
+        if not channel_ids:
+            return {}
+        ranked = select(
+            TelegramMessage.channel_id, TelegramMessage.timestamp,
+            func.row_number().over(
+                partition_by=TelegramMessage.channel_id,
+                order_by=TelegramMessage.message_id.desc()).label('rank')).where(
+                    TelegramMessage.channel_id.in_(list(channel_ids)),
+                    TelegramMessage.timestamp >= datetime.utcnow() -
+                    timedelta(days=HOT_WINDOW_DAYS)).subquery()
+        timestamps = {}
+        async with self._reading() as session:
+            result = await session.execute(
+                select(ranked.c.channel_id,
+                       ranked.c.timestamp).where(ranked.c.rank <= limit))
+            for channel_id, timestamp in result:
+                if timestamp is not None:
+                    timestamps.setdefault(channel_id, []).append(timestamp)
+        return timestamps
+
+    async def insert_messages(self, rows, senders=None):
+        """Insert message rows (dicts of column values) in one transaction
+
+        Long bodies are stored once in message_bodies (bodies.py), near
+        duplicates are clustered (near_duplicates.py), trending and
+        participant sketches and `senders` are updated (trending.py,
+        participants.py; `senders` maps sender ids to their details), rows
+        are numbered for the changefeed (changes.py), and the change
+        versions of the touched channels are bumped in the same transaction
+        (versions.py).
+
+        With a spool, the rows are spooled and replayed, and the number
+        returned is the number accepted.
+        """
+        if not rows:
+            return 0
+        if self.spool is not None:
+            return await self._spool(
+                {'op': 'insert', 'rows': rows,
+                 'senders': list((senders or {}).values())}, len(rows))
+        return await self._insert_messages(rows, senders)
+
+    async def _insert_messages(self, rows, senders=None):
+        # Rows are rewritten below; keep the caller's intact for retries
+        rows = [dict(row) for row in rows]
+        codec = await self._content_codec() if Config.CONTENT_COMPRESSION \
+            else None
+        members = await self._near_duplicate_members(rows) \
+            if Config.NEAR_DUP else []
+        deltas = trending.tally(rows) if Config.TRENDING else {}
+        sender_rows = participants.sender_rows(rows, senders)
+        participant_deltas = participants.tally(rows)
+        async with self._writing(rows=len(rows)) as session:
+            changes.number(rows, await self._allocate(session, len(rows)))
+            if Config.CONTENT_DEDUP:
+                await self._share_bodies(session, rows, codec)
+            if codec is not None:
+                content_codec.compress_rows(rows, codec)
+            await session.execute(insert(TelegramMessage), rows)
+            if members:
+                await session.execute(
+                    near_duplicates.insert_statement(self.engine.dialect.name),
+                    members)
+            if deltas:
+                await self._update_trending(session, deltas)
+            if sender_rows:
+                await session.execute(
+                    participants.sender_upsert(self.engine.dialect.name),
+                    sender_rows)
+                await self._update_participants(session, participant_deltas)
+            await session.execute(
+                versions.bump_statement(self.engine.dialect.name),
+                versions.bump_rows(rows, datetime.utcnow()))
+        return len(rows)
+
+    async def _share_bodies(self, session, rows, codec=None):
+        """Point rows at shared bodies, storing new bodies and sightings"""
+        hashes = bodies.shareable(rows)
+        if not hashes:
+            for row in rows:
+                row['body_hash'] = None
+            return
+        body_query, sighting_query = bodies.lookup_queries(
+            hashes, [row['channel_id'] for row in rows])
+        known_bodies = set((await session.execute(body_query)).scalars())
+        known_sightings = set(map(tuple, await session.execute(sighting_query)))
+        new_bodies, sightings, increments = bodies.plan(
+            rows, hashes, known_bodies, known_sightings, datetime.utcnow())
+        if codec is not None:
+            content_codec.compress_rows(new_bodies, codec)
+        for statement, parameters in bodies.write_statements(
+                new_bodies, sightings, increments):
+            await session.execute(statement, parameters)
+
+    async def _update_trending(self, session, deltas):
+        """Merge item counts into the stored sketches, pruning hourly"""
+        now = datetime.utcnow()
+        stored = {(row.scope, row.kind, row.granularity, row.bucket_start): row
+                  for row in (await session.execute(
+                      trending.lookup_query(deltas)))}
+        await session.execute(trending.upsert_statement(self.engine.dialect.name),
+                              trending.apply(stored, deltas, now))
+        if time.monotonic() - self._trending_pruned > 3600:
+            await session.execute(trending.prune_statement(now))
+            self._trending_pruned = time.monotonic()
+
+    async def edit_messages(self, edits):
+        """Store edited texts of stored messages
+
+        `edits` are dicts of channel_id, message_id, content and edit_date.
+        Edited text is kept inline, compressed when CONTENT_COMPRESSION is
+        set. Returns the number of messages changed, or with a spool the
+        number of edits accepted.
+        """
+        if not edits:
+            return 0
+        if self.spool is not None:
+            return await self._spool({'op': 'edit', 'edits': edits}, len(edits))
+        return await self._edit_messages(edits)
+
+    async def _edit_messages(self, edits):
+        by_key = {(edit['channel_id'], edit['message_id']): edit
+                  for edit in edits}
+        codec = await self._content_codec() if Config.CONTENT_COMPRESSION \
+            else None
+        async with self._writing(rows=len(edits)) as session:
+            found = (await session.execute(
+                select(TelegramMessage.id, TelegramMessage.channel_id,
+                       TelegramMessage.message_id, TelegramMessage.dialog_type,
+                       TelegramMessage.body_hash)
+                .where(changes.message_keys(by_key)))).all()
+            if not found:
+                return 0
+            params = [dict(by_key[(row.channel_id, row.message_id)],
+                           row_id=row.id, dialog_type=row.dialog_type)
+                      for row in found]
+            if codec is not None:
+                content_codec.compress_rows(params, codec)
+            else:
+                for row in params:
+                    row['content_zstd'] = row['content_dict_id'] = None
+            changes.number(params, await self._allocate(session, len(params)))
+            await session.execute(changes.EDIT, params)
+            # Edited text is inline, the shared body lost a message
+            await self._release_bodies(session, found)
+            await session.execute(
+                versions.bump_statement(self.engine.dialect.name),
+                versions.bump_rows(params, datetime.utcnow()))
+        return len(params)
+
+    async def delete_messages(self, channel_id, message_ids):
+        """Delete stored messages, leaving tombstones for the changefeed
+
+        `channel_id` is None when Telegram did not say which chat; see
+        changes.deleted_condition. Returns the number of messages deleted,
+        or with a spool the number of ids accepted.
+        """
+        if not message_ids:
+            return 0
+        if self.spool is not None:
+            return await self._spool(
+                {'op': 'delete', 'channel_id': channel_id,
+                 'message_ids': list(message_ids)}, len(message_ids))
+        return await self._delete_messages(channel_id, message_ids)
+
+    async def _delete_messages(self, channel_id, message_ids):
+        now = datetime.utcnow()
+        async with self._writing(rows=len(message_ids)) as session:
+            found = (await session.execute(
+                select(TelegramMessage.id, TelegramMessage.channel_id,
+                       TelegramMessage.message_id, TelegramMessage.body_hash)
+                .where(changes.deleted_condition(channel_id, message_ids))
+                .order_by(TelegramMessage.id))).all()
+            if not found:
+                return 0
+            tombstones = [{'channel_id': row.channel_id,
+                           'message_id': row.message_id,
+                           'deleted_at': now} for row in found]
+            last = await self._allocate(session, len(tombstones))
+            for tombstone in changes.number(tombstones, last):
+                tombstone['seq'] = tombstone.pop('change_seq')
+            await session.execute(insert(MessageTombstone), tombstones)
+            await session.execute(delete(TelegramMessage).where(
+                TelegramMessage.id.in_([row.id for row in found])))
+            await self._release_bodies(session, found)
+            await session.execute(
+                versions.bump_statement(self.engine.dialect.name),
+                versions.bump_rows(tombstones, now))
+        return len(found)
+
+    async def _release_bodies(self, session, found):
+        """Keep body counts exact once `found` messages left their bodies"""
+        released = [(row.body_hash, row.channel_id) for row in found
+                    if row.body_hash is not None]
+        if not released:
+            return
+        remaining = (await session.execute(
+            bodies.remaining_query(released))).all()
+        forgotten, decrements = bodies.release(released, remaining)
+        if forgotten:
+            await session.execute(bodies.FORGET_SIGHTING, forgotten)
+        await session.execute(bodies.INCREMENT, decrements)
+
+    async def _spool(self, record, count):
+        self.spool.append(record)
+        metrics.spool_pending.set(self.spool.pending)
+        await self.replay()
+        return count
+
+    async def replay(self):
+        """Apply spooled writes to the database, oldest first
+
+        Stops at the first error and tries again no sooner than
+        SPOOL_RETRY_SECONDS later, doubling the wait while errors go on.
+        A replay already running picks up records spooled meanwhile.
+        Returns the number of writes applied.
+        """
+        if self.spool is None or not self.spool.pending or \
+                self._replaying.locked() or time.monotonic() < self._replay_at:
+            return 0
+        applied = 0
+        async with self._replaying:
+            try:
+                while self.spool.pending:
+                    applied_before = applied
+                    for position, record in self.spool.unapplied():
+                        await self._apply(record)
+                        self.spool.advance(position)
+                        applied += 1
+                        if self.batch_rows is None:
+                            # Each write committed on its own
+                            self.spool.checkpoint()
+                    if applied == applied_before:
+                        break
+            except Exception as e:
+                self._replay_delay = min(
+                    max(self._replay_delay * 2, Config.SPOOL_RETRY_SECONDS),
+                    Config.SPOOL_RETRY_MAX_SECONDS)
+                self._replay_at = time.monotonic() + self._replay_delay
+                metrics.spool_replay_errors.inc()
+                logger.warning("Database unavailable, %d writes spooled; "
+                               "retrying in %.0fs: %s", self.spool.pending,
+                               self._replay_delay, e)
+            else:
+                self._replay_delay = 0.0
+            finally:
+                metrics.spool_replayed.inc(applied)
+                metrics.spool_pending.set(self.spool.pending)
+        return applied
+
+    async def _apply(self, record):
+        if record['op'] == 'insert':
+            rows = await self._unstored(record['rows'])
+            if rows:
+                await self._insert_messages(
+                    rows, {sender['id']: sender for sender in record['senders']})
+        elif record['op'] == 'edit':
+            await self._edit_messages(record['edits'])
+        elif record['op'] == 'delete':
+            await self._delete_messages(record['channel_id'],
+                                        record['message_ids'])
+
+    async def _unstored(self, rows):
+        """Rows not stored yet; a record can be replayed twice after a crash"""
+        async with self._reading() as session:
+            stored = set(map(tuple, await session.execute(
+                select(TelegramMessage.channel_id, TelegramMessage.message_id)
+                .where(changes.message_keys(
+                    (row['channel_id'], row['message_id']) for row in rows)))))
+        return [row for row in rows
+                if (row['channel_id'], row['message_id']) not in stored]
+
+    async def _allocate(self, session, count):
+        """Reserve `count` changefeed numbers; returns the last"""
+        result = await session.execute(
+            changes.allocate_statement(self.engine.dialect.name, count))
+        return result.scalar_one()
+
+    async def _update_participants(self, session, deltas):
+        """Add the batch's senders to the stored HyperLogLog sketches"""
+        stored = {(row.scope, row.granularity, row.bucket_start): row
+                  for row in await session.execute(
+                      participants.lookup_query(deltas))}
+        await session.execute(
+            participants.sketch_upsert(self.engine.dialect.name),
+            participants.apply(stored, deltas, datetime.utcnow()))
+
+    async def _near_duplicate_members(self, rows):
+        """Index rows for near duplicates; returns near_duplicates rows"""
+        if self.near_duplicates is None:
+            index = near_duplicates.NearDuplicateIndex()
+            codec = await self._content_codec() if Config.CONTENT_COMPRESSION \
+                else None
+            async with self._reading() as session:
+                recent = (await session.execute(near_duplicates.warm_query(
+                    datetime.utcnow() - index.window))).all()
+            await asyncio.to_thread(index.load, recent, codec)
+            self.near_duplicates = index
+        texts = [near_duplicates.text_of(row.get('content')) for row in rows]
+        # Hashing is CPU work; keep the event loop free meanwhile
+        signatures = await asyncio.to_thread(near_duplicates.signatures, texts)
+        return self.near_duplicates.add(rows, signatures)
+
+    async def _content_codec(self):
+        """Codec with the current dictionaries, reloaded now and then"""
+        if self.codec is None or time.monotonic() - self._codec_loaded > \
+                content_codec.DICTIONARY_RELOAD_INTERVAL:
+            codec = self.codec or content_codec.ContentCodec()
+            query = select(ContentDictionary.id, ContentDictionary.scope,
+                           ContentDictionary.data)
+            if codec.ids:
+                # Dictionaries never change, only fetch new ones
+                query = query.where(ContentDictionary.id.notin_(codec.ids))
+            async with self._reading() as session:
+                codec.load((await session.execute(query)).all())
+            self.codec, self._codec_loaded = codec, time.monotonic()
+        return self.codec
+
+    async def load_entities(self):
+        """Every cached entity as a dict of its fields"""
+        async with self._reading() as session:
+            result = await session.execute(
+                select(*(getattr(TelegramEntity, field)
+                         for field in ENTITY_FIELDS)))
+            return [row._asdict() for row in result]
+
+    async def save_entities(self, records):
+        """Upsert entity records"""
+        now = datetime.utcnow()
+        async with self._writing() as session:
+            for record in records:
+                await session.merge(TelegramEntity(updated_at=now, **record))
+
+    async def save_heartbeat(self, heartbeat_id, state, dialog_rows):
+        """Upsert the collector heartbeat and dialog lag rows
+
+        Also commits any batched writes, so readers see them.
+        """
+        async with self._writing(commit=True) as session:
+            await session.merge(
+                CollectorHeartbeat(id=heartbeat_id,
+                                   updated_at=datetime.utcnow(),
+                                   **state))
+            for row in dialog_rows:
+                await session.merge(DialogLag(**row))
@@ -0,0 +1 @@
+"""Benchmark harness for the ingest and read paths, see benchmarks/__main__.py"""
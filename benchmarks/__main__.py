@@ -0,0 +1,122 @@
+"""Benchmark suite for the collector ingest path and the read path.
+
+    python -m benchmarks all --output bench.json
+    python -m benchmarks ingest --dialogs 200 --backlog 100
+    python -m benchmarks ingest --duration 60 --mean-rate 0.5 --flood-wait 0.01
+    python -m benchmarks http --seed-messages 100000 --requests 100
+    python -m benchmarks http --url http://localhost:5000 --api-key KEY
+    python -m benchmarks startup --repeats 10
+
+Runs against a throwaway SQLite file unless --database-url is given (for
+example a local PostgreSQL database). Results are printed, or written with
+--output, as JSON so runs can be compared across releases.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description="Ingest and read path benchmarks")
+    parser.add_argument('suite', choices=['ingest', 'http', 'startup', 'all'])
+    parser.add_argument('--database-url', help="Defaults to a temporary SQLite file")
+    parser.add_argument('--output', help="Write JSON results to this file")
+
+    ingest = parser.add_argument_group('ingest')
+    ingest.add_argument('--dialogs', type=int, default=200)
+    ingest.add_argument('--backlog', type=int, default=100,
+                        help="Messages already waiting in each dialog")
+    ingest.add_argument('--cycles', type=int, default=1)
+    ingest.add_argument('--duration', type=float,
+                        help="Run the collector in real time for this many seconds")
+    ingest.add_argument('--mean-rate', type=float, default=0.2,
+                        help="Mean messages per second per live dialog")
+    ingest.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds added to every Telegram request")
+    ingest.add_argument('--flood-wait', type=float, default=0.0,
+                        help="Probability of a FloodWaitError per request")
+    ingest.add_argument('--catch-up-limit', type=int, default=100)
+
+    http = parser.add_argument_group('http')
+    http.add_argument('--url', help="Load a running server instead of the test client")
+    http.add_argument('--api-key', default=None)
+    http.add_argument('--requests', type=int, default=50)
+    http.add_argument('--concurrency', type=int, default=4)
+    http.add_argument('--seed-messages', type=int, default=20000)
+
+    startup = parser.add_argument_group('startup')
+    startup.add_argument('--repeats', type=int, default=5)
+    startup.add_argument('--startup-module', default='main',
+                         help="Module a web worker imports")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv if argv is not None else sys.argv[1:])
+    logging.basicConfig(level=logging.WARNING)
+
+    database_url = args.database_url
+    if not database_url:
+        fd, path = tempfile.mkstemp(prefix='bench-', suffix='.db')
+        os.close(fd)
+        database_url = f'sqlite:///{path}'
+    # app.py reads the URL at import time
+    os.environ['DATABASE_URL'] = database_url
+
+    from app import app, db
+    import main as web  # noqa: F401  registers the routes
+    from benchmarks.common import environment
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report = {'suite': 'telegram-cache-proxy', **environment(database_url), 'results': {}}
+
+    if args.suite in ('ingest', 'all'):
+        from benchmarks.ingest import run_ingest
+        report['results']['ingest'] = run_ingest(
+            app,
+            db,
+            cycles=args.cycles,
+            duration=args.duration,
+            catch_up_limit=args.catch_up_limit,
+            dialogs=args.dialogs,
+            backlog=args.backlog,
+            mean_rate=args.mean_rate,
+            latency=args.latency,
+            flood_wait_probability=args.flood_wait)
+
+    if args.suite in ('http', 'all'):
+        from benchmarks.http_load import (API_KEY, run_http_inprocess,
+                                          run_http_remote, seed_messages)
+        if args.url:
+            report['results']['http'] = run_http_remote(args.url,
+                                                        args.api_key or API_KEY,
+                                                        requests=args.requests,
+                                                        concurrency=args.concurrency)
+        else:
+            with app.app_context():
+                db.create_all()
+                seed_messages(db, args.seed_messages)
+            report['results']['http'] = run_http_inprocess(app,
+                                                           db,
+                                                           requests=args.requests)
+
+    if args.suite in ('startup', 'all'):
+        from benchmarks.startup import run_startup
+        report['results']['startup'] = run_startup(database_url,
+                                                   module=args.startup_module,
+                                                   repeats=args.repeats)
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
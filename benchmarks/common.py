@@ -0,0 +1,75 @@
+import platform
+import subprocess
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """Counts statements executed on an engine while attached
+
+    Pass the `Engine` class to count statements of every engine.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _on_execute(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+    def reset(self):
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile, None for an empty sample"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def latency_summary(seconds):
+    """p50/p99/max of a latency sample, in milliseconds"""
+    return {
+        'count': len(seconds),
+        'p50_ms': _ms(percentile(seconds, 50)),
+        'p99_ms': _ms(percentile(seconds, 99)),
+        'max_ms': _ms(max(seconds) if seconds else None),
+    }
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+def environment(database_url):
+    """Metadata stored next to the results to compare runs"""
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                  capture_output=True,
+                                  text=True,
+                                  timeout=5).stdout.strip() or None
+    except Exception:
+        revision = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': database_url.split(':', 1)[0],
+    }
@@ -0,0 +1,183 @@
+"""In-memory stand-in for a connected Telethon client.
+
+Dialogs are real Telethon `Channel`/`User` objects so the collector's dialog
+typing, entity cache and InputPeer handling run unchanged. Each dialog
+produces messages at its own rate (exponentially distributed around the
+configured mean, with some dead dialogs), optionally starts with a backlog,
+and every request can be slowed down by a fixed latency or answered with an
+injected FloodWaitError.
+"""
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from telethon import errors, utils
+from telethon.tl.types import Channel, ChatPhotoEmpty, User
+
+WORDS = ("ton wallet jetton nft contract deploy testnet mainnet validator "
+         "staking bridge dex swap airdrop tact func fift blueprint sdk "
+         "release update bug fix docs grant hackathon meetup question "
+         "help error gas fee block shard node api tonapi toncenter "
+         "telegram bot mini app payment stars channel chat").split()
+
+ANNOUNCEMENT = ("New TON release is out, upgrade your nodes before the next "
+                "validation round. Details: https://ton.org/news #ton")
+
+
+class FakeMessage:
+    def __init__(self, id, text, date, out=False, sender_id=None):
+        self.id = id
+        self.text = text
+        self.message = text
+        self.date = date
+        self.out = out
+        self.sender_id = sender_id
+        self.sender = None
+        self.fwd_from = None
+
+
+class FakeDialog:
+    def __init__(self, entity, archived=False):
+        self.entity = entity
+        self.id = utils.get_peer_id(entity)
+        self.title = self.name = utils.get_display_name(entity)
+        self.archived = archived
+        self.message = None
+        self.input_entity = utils.get_input_peer(entity)
+
+
+class FakeFeed:
+    """Message stream of one dialog"""
+
+    def __init__(self, dialog, rate, backlog, start, rng, duplicate_ratio):
+        self.dialog = dialog
+        self.rate = rate
+        self.backlog = backlog
+        self.start = start
+        self.delivered = 0
+        self._rng = random.Random(rng.random())
+        self._duplicate_ratio = duplicate_ratio
+        self._texts = {}
+
+    def count(self, now):
+        if self.rate <= 0:
+            return self.backlog
+        return self.backlog + int((now - self.start) * self.rate)
+
+    def arrival(self, message_id):
+        """Monotonic arrival time of a message in seconds"""
+        if message_id <= self.backlog:
+            return self.start - (self.backlog - message_id) * 10.0
+        return self.start + (message_id - self.backlog) / self.rate
+
+    def text(self, message_id):
+        text = self._texts.get(message_id)
+        if text is None:
+            rng = random.Random(hash((self.dialog.id, message_id)))
+            if rng.random() < self._duplicate_ratio:
+                text = ANNOUNCEMENT
+            else:
+                text = ' '.join(rng.choice(WORDS)
+                                for _ in range(rng.randint(5, 30)))
+            self._texts[message_id] = text
+        return text
+
+
+class FakeTelegramClient:
+    """Enough of TelegramClient for the collector pipeline"""
+
+    def __init__(self, dialogs=200, mean_rate=0.2, backlog=0, latency=0.0,
+                 flood_wait_probability=0.0, flood_wait_seconds=1,
+                 dead_ratio=0.3, duplicate_ratio=0.05, seed=0):
+        self._rng = random.Random(seed)
+        self.latency = latency
+        self.flood_wait_probability = flood_wait_probability
+        self.flood_wait_seconds = flood_wait_seconds
+        self.handlers = []
+        self.stats = {
+            'requests': 0,
+            'get_dialogs': 0,
+            'iter_messages': 0,
+            'empty_polls': 0,
+            'flood_waits': 0,
+            'messages_served': 0,
+        }
+        self.delivery_delays = []
+
+        start = time.monotonic()
+        self.epoch = datetime.now(timezone.utc) - timedelta(seconds=start)
+        self.feeds = {}
+        for i in range(dialogs):
+            dialog = FakeDialog(self._make_entity(i + 1))
+            rate = 0.0 if self._rng.random() < dead_ratio else \
+                self._rng.expovariate(1.0 / mean_rate) if mean_rate > 0 else 0.0
+            self.feeds[dialog.id] = FakeFeed(dialog, rate, backlog, start,
+                                             self._rng, duplicate_ratio)
+
+    def _make_entity(self, n):
+        kind = self._rng.random()
+        if kind < 0.1:
+            return User(id=n, first_name=f"User {n}", access_hash=n)
+        return Channel(id=n,
+                       title=f"{'TON Dev' if n % 17 == 0 else 'Channel'} {n}",
+                       photo=ChatPhotoEmpty(),
+                       date=None,
+                       access_hash=n,
+                       megagroup=kind < 0.3,
+                       username=f"chan{n}" if n % 3 == 0 else None)
+
+    @property
+    def total_messages(self):
+        now = time.monotonic()
+        return sum(feed.count(now) for feed in self.feeds.values())
+
+    async def _request(self):
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_wait_probability and \
+                self._rng.random() < self.flood_wait_probability:
+            self.stats['flood_waits'] += 1
+            raise errors.FloodWaitError(request=None,
+                                        capture=self.flood_wait_seconds)
+
+    async def connect(self):
+        return True
+
+    async def disconnect(self):
+        return None
+
+    async def is_user_authorized(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    async def get_dialogs(self, limit=None):
+        self.stats['get_dialogs'] += 1
+        await self._request()
+        dialogs = [feed.dialog for feed in self.feeds.values()]
+        return dialogs[:limit] if limit else dialogs
+
+    async def iter_messages(self, entity, limit=None):
+        self.stats['iter_messages'] += 1
+        await self._request()
+        feed = self.feeds[utils.get_peer_id(entity)]
+        now = time.monotonic()
+        newest = feed.count(now)
+        oldest = max(newest - (limit or newest), 0)
+        if newest <= feed.delivered:
+            self.stats['empty_polls'] += 1
+
+        for message_id in range(newest, oldest, -1):
+            arrival = feed.arrival(message_id)
+            if message_id > feed.delivered and message_id > feed.backlog:
+                self.delivery_delays.append(now - arrival)
+            self.stats['messages_served'] += 1
+            yield FakeMessage(message_id,
+                              feed.text(message_id),
+                              self.epoch + timedelta(seconds=arrival),
+                              out=message_id % 11 == 0,
+                              sender_id=1000 + message_id % 37)
+        feed.delivered = max(feed.delivered, newest)
@@ -0,0 +1,108 @@
+"""Latency and query-count load driver for the dashboard and API routes"""
+import random
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy.engine import Engine
+
+from benchmarks.common import QueryCounter, latency_summary
+from benchmarks.fake_telegram import WORDS
+
+ROUTES = [
+    '/',
+    '/api/messages?per_page=100',
+    '/api/messages?per_page=100&exclude=content',
+    '/api/channels',
+    '/api/search?q=wallet',
+]
+
+API_KEY = 'benchmark-key'
+
+
+def seed_messages(db, count, channels=200, seed=0):
+    """Bulk insert synthetic messages spread over the last 30 days"""
+    from models import TelegramMessage, ApiKey
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    existing = db.session.query(TelegramMessage).count()
+    rows = []
+    for i in range(existing, count):
+        channel = rng.randrange(channels)
+        rows.append({
+            'message_id': i + 1,
+            'channel_id': str(channel),
+            'channel_title': f"Channel {channel}",
+            'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 30))),
+            'timestamp': now - timedelta(seconds=rng.randrange(30 * 86400)),
+            'is_ton_dev': channel % 17 == 0,
+            'is_outgoing': i % 11 == 0,
+            'dialog_type': 'channel',
+        })
+        if len(rows) == 10000:
+            db.session.execute(TelegramMessage.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(TelegramMessage.__table__.insert(), rows)
+    if not ApiKey.query.filter_by(key=API_KEY).first():
+        db.session.add(ApiKey(key=API_KEY, name='benchmark'))
+    db.session.commit()
+
+
+def run_http_inprocess(app, db, requests=50, routes=ROUTES, warmup=3):
+    """Call routes through Flask's test client and count DB statements"""
+    client = app.test_client()
+    headers = {'X-API-Key': API_KEY}
+    results = {}
+    # Count on every engine, read-only routes may use a reader pool
+    with QueryCounter(Engine) as counter:
+        for route in routes:
+            for _ in range(warmup):
+                client.get(route, headers=headers)
+            latencies, statuses, queries = [], Counter(), 0
+            counter.reset()
+            for _ in range(requests):
+                started = time.perf_counter()
+                response = client.get(route, headers=headers)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] += 1
+            queries = counter.reset()
+            results[route] = dict(latency_summary(latencies),
+                                  status_codes=dict(statuses),
+                                  db_queries_per_request=round(queries / requests, 2))
+    return results
+
+
+def _fetch(url, api_key):
+    request = urllib.request.Request(url, headers={'X-API-Key': api_key})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception:
+        status = 0
+    return time.perf_counter() - started, status
+
+
+def run_http_remote(base_url, api_key=API_KEY, requests=50, concurrency=4,
+                    routes=ROUTES):
+    """Load a running server over HTTP; query counts are not available"""
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for route in routes:
+            url = base_url.rstrip('/') + route
+            started = time.perf_counter()
+            samples = list(pool.map(lambda _: _fetch(url, api_key), range(requests)))
+            elapsed = time.perf_counter() - started
+            results[route] = dict(
+                latency_summary([latency for latency, _ in samples]),
+                status_codes=dict(Counter(status for _, status in samples)),
+                requests_per_sec=round(requests / elapsed, 1))
+    return results
@@ -0,0 +1,79 @@
+"""Drive the real collector pipeline with a fake Telegram client"""
+import asyncio
+import json
+import time
+
+from sqlalchemy.engine import Engine
+
+from benchmarks.common import QueryCounter, latency_summary
+from benchmarks.fake_telegram import FakeTelegramClient
+
+
+def _scopes(catch_up_limit, poll_interval):
+    return json.dumps({
+        'tiers': {
+            'default': {
+                'poll_interval': poll_interval,
+                'catch_up_limit': catch_up_limit,
+                'min_interval': min(poll_interval, 0.5),
+            }
+        }
+    })
+
+
+async def _drive(client, cycles, duration):
+    from collector import run_collection
+
+    if duration:
+        try:
+            await asyncio.wait_for(run_collection(client), duration)
+        except asyncio.TimeoutError:
+            pass
+    else:
+        await run_collection(client, max_cycles=cycles)
+
+
+def run_ingest(app, db, cycles=1, duration=None, catch_up_limit=100,
+               poll_interval=5, **client_options):
+    """Run the collector against a fake client and report throughput
+
+    With `duration` the collector runs in real time for that many seconds,
+    otherwise for `cycles` scheduler iterations.
+    """
+    from config import Config
+    from models import TelegramMessage
+
+    Config.COLLECTOR_SCOPES = _scopes(catch_up_limit, poll_interval)
+    Config.COLLECTOR_SCOPES_FILE = ''
+
+    with app.app_context():
+        db.create_all()
+        before = db.session.query(TelegramMessage).count()
+        client = FakeTelegramClient(**client_options)
+
+        # The collector writes through its own async engine
+        with QueryCounter(Engine) as counter:
+            started = time.perf_counter()
+            asyncio.run(_drive(client, cycles, duration))
+            elapsed = time.perf_counter() - started
+            queries = counter.count
+
+        db.session.remove()
+        stored = db.session.query(TelegramMessage).count() - before
+
+    return {
+        'parameters': dict(client_options,
+                           cycles=cycles,
+                           duration=duration,
+                           catch_up_limit=catch_up_limit,
+                           poll_interval=poll_interval),
+        'messages_stored': stored,
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_sec': round(stored / elapsed, 1) if elapsed else None,
+        'telegram_requests': client.stats['requests'],
+        'empty_polls': client.stats['empty_polls'],
+        'flood_waits': client.stats['flood_waits'],
+        'db_queries': queries,
+        'db_queries_per_message': round(queries / stored, 3) if stored else None,
+        'delivery_latency': latency_summary(client.delivery_delays),
+    }
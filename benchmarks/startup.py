@@ -0,0 +1,63 @@
+"""Cold import time of the web app, as paid by every gunicorn worker"""
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.common import latency_summary
+
+# Packages a web worker should never import
+HEAVY_PACKAGES = ('telethon', 'pyarrow', 'collector')
+
+
+def parse_importtime(stderr):
+    """Parse `-X importtime` output into (module, self_us, cumulative_us)"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def _by_package(modules):
+    totals = {}
+    for name, self_us, _ in modules:
+        package = name.split('.', 1)[0]
+        totals[package] = totals.get(package, 0) + self_us
+    return totals
+
+
+def run_startup(database_url, module='main', repeats=5, top=15):
+    """Import `module` in fresh interpreters and report where the time goes
+
+    Wall time covers interpreter start and the import; the per-package
+    breakdown comes from the last run's `-X importtime` output.
+    """
+    env = dict(os.environ, DATABASE_URL=database_url)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    command = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+    # Warm the bytecode cache so every measured run is comparable
+    subprocess.run(command, env=env, capture_output=True, check=True)
+
+    wall = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = subprocess.run(command, env=env, capture_output=True,
+                                text=True, check=True)
+        wall.append(time.perf_counter() - started)
+
+    modules = parse_importtime(result.stderr)
+    packages = _by_package(modules)
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    loaded = {name.split('.', 1)[0] for name, _, _ in modules}
+    return {
+        'parameters': {'module': module, 'repeats': repeats},
+        'wall': latency_summary(wall),
+        'import_ms': round(sum(self_us for _, self_us, _ in modules) / 1000, 3),
+        'modules_imported': len(modules),
+        'heavy_packages_loaded': sorted(loaded.intersection(HEAVY_PACKAGES)),
+        'slowest_packages_ms': {name: round(us / 1000, 3)
+                                for name, us in slowest[:top]},
+    }
@@ -0,0 +1,244 @@
+"""Content-addressed storage of message bodies.
+
+The same announcement is often forwarded into dozens of the dialogs we
+collect. Bodies of at least CONTENT_DEDUP_MIN_BYTES are therefore stored
+once in `message_bodies`, keyed by a BLAKE2b hash of the text, and messages
+only keep the hash. `body_sightings` records each chat a body was seen in,
+so `message_bodies.chat_count` ("seen in N chats") stays exact without
+counting messages, and finding the copies of a message is a lookup on the
+indexed hash. Shorter messages stay inline in `telegram_messages.content`.
+
+Readers get the text from CONTENT (and the compressed columns from
+STORED_COLUMNS, see content_codec.py) on a query built with `join_bodies`.
+
+Existing inline rows are moved with:
+    python bodies.py migrate --chunk-size 5000
+"""
+import argparse
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy import bindparam, delete, func, insert, select, update
+
+from config import Config
+from models import BodySighting, MessageBody, TelegramMessage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 5000
+
+CONTENT = func.coalesce(TelegramMessage.content, MessageBody.content)
+STORED_COLUMNS = (
+    func.coalesce(TelegramMessage.content_zstd, MessageBody.content_zstd),
+    func.coalesce(TelegramMessage.content_dict_id, MessageBody.content_dict_id),
+)
+SEEN_IN = func.coalesce(MessageBody.chat_count, 1)
+
+
+def body_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def join_bodies(query):
+    """Outer join message_bodies to a SELECT over telegram_messages"""
+    return query.outerjoin_from(TelegramMessage, MessageBody,
+                                MessageBody.hash == TelegramMessage.body_hash)
+
+
+def shareable(rows, min_bytes=None):
+    """Hashes of the message rows (dicts) whose content should be shared"""
+    min_bytes = Config.CONTENT_DEDUP_MIN_BYTES if min_bytes is None else min_bytes
+    hashes = {}
+    for index, row in enumerate(rows):
+        content = row.get('content')
+        if content and len(content.encode('utf-8')) >= min_bytes:
+            hashes[index] = body_hash(content)
+    return hashes
+
+
+def plan(rows, hashes, known_bodies, known_sightings, now):
+    """Work out the body and sighting writes for a batch of message rows
+
+    `hashes` maps row positions to body hashes, `known_bodies` are hashes
+    already stored and `known_sightings` are stored (hash, channel_id)
+    pairs. Rows are rewritten in place to reference their body. Returns new
+    body rows, new sighting rows and count increments for known bodies.
+    """
+    new_bodies, sightings, increments = {}, {}, {}
+    for index, row in enumerate(rows):
+        digest = hashes.get(index)
+        row['body_hash'] = digest
+        if digest is None:
+            continue
+        if digest not in known_bodies and digest not in new_bodies:
+            content = row['content']
+            new_bodies[digest] = {
+                'hash': digest,
+                'content': content,
+                'size': len(content.encode('utf-8')),
+                'message_count': 0,
+                'chat_count': 0,
+                'first_channel_id': row['channel_id'],
+                'first_message_id': row['message_id'],
+                'dialog_type': row.get('dialog_type'),
+                'first_seen_at': now,
+            }
+        counts = new_bodies.get(digest) or increments.setdefault(
+            digest, {'message_count': 0, 'chat_count': 0})
+        counts['message_count'] += 1
+        pair = (digest, row['channel_id'])
+        if pair not in known_sightings and pair not in sightings:
+            sightings[pair] = {'body_hash': digest,
+                               'channel_id': row['channel_id'],
+                               'message_id': row['message_id'],
+                               'seen_at': now}
+            counts['chat_count'] += 1
+        row['content'] = None
+    return (list(new_bodies.values()), list(sightings.values()),
+            [dict(counts, b_hash=digest) for digest, counts in increments.items()])
+
+
+def lookup_queries(hashes, channel_ids):
+    """Queries for the bodies and sightings `plan` needs to know about"""
+    digests = sorted(set(hashes.values()))
+    return (select(MessageBody.hash).where(MessageBody.hash.in_(digests)),
+            select(BodySighting.body_hash, BodySighting.channel_id).where(
+                BodySighting.body_hash.in_(digests),
+                BodySighting.channel_id.in_(sorted(set(channel_ids)))))
+
+
+# Core rather than ORM update, so sessions can run it executemany-style
+_bodies = MessageBody.__table__
+INCREMENT = update(_bodies).where(_bodies.c.hash == bindparam('b_hash')).values(
+    message_count=_bodies.c.message_count + bindparam('message_count'),
+    chat_count=_bodies.c.chat_count + bindparam('chat_count'))
+
+
+_sightings = BodySighting.__table__
+FORGET_SIGHTING = delete(_sightings).where(
+    _sightings.c.body_hash == bindparam('b_hash'),
+    _sightings.c.channel_id == bindparam('b_channel'))
+
+
+def remaining_query(released):
+    """Pairs of `released` still referenced by some message"""
+    return select(TelegramMessage.body_hash, TelegramMessage.channel_id).where(
+        TelegramMessage.body_hash.in_(sorted({digest for digest, _ in released})),
+        TelegramMessage.channel_id.in_(sorted({channel for _, channel in released}))
+    ).distinct()
+
+
+def release(released, remaining):
+    """Undo the counts of messages that no longer reference their body
+
+    `released` holds a (hash, channel_id) pair per edited or deleted message
+    that had a body, `remaining` the pairs still referenced afterwards.
+    Returns the sightings to forget and count decrements for INCREMENT.
+    """
+    decrements = {}
+    for digest, _ in released:
+        counts = decrements.setdefault(digest, {'message_count': 0,
+                                                'chat_count': 0})
+        counts['message_count'] -= 1
+    gone = sorted(set(released) - set(map(tuple, remaining)))
+    for digest, _ in gone:
+        decrements[digest]['chat_count'] -= 1
+    return ([{'b_hash': digest, 'b_channel': channel} for digest, channel in gone],
+            [dict(counts, b_hash=digest) for digest, counts in decrements.items()])
+
+
+def write_statements(new_bodies, sightings, increments):
+    """(statement, parameters) pairs applying a plan"""
+    statements = []
+    if new_bodies:
+        statements.append((insert(MessageBody), new_bodies))
+    if sightings:
+        statements.append((insert(BodySighting), sightings))
+    if increments:
+        statements.append((INCREMENT, increments))
+    return statements
+
+
+def share_rows(conn, rows, now=None):
+    """Move the shareable content of message rows into message_bodies
+
+    Synchronous counterpart of CollectorStore's ingest path, for tools.
+    Returns the new body rows.
+    """
+    hashes = shareable(rows)
+    if not hashes:
+        for row in rows:
+            row['body_hash'] = None
+        return []
+    body_query, sighting_query = lookup_queries(
+        hashes, [row['channel_id'] for row in rows])
+    known_bodies = set(conn.execute(body_query).scalars())
+    known_sightings = set(map(tuple, conn.execute(sighting_query)))
+    new_bodies, sightings, increments = plan(rows, hashes, known_bodies,
+                                             known_sightings,
+                                             now or datetime.utcnow())
+    for statement, parameters in write_statements(new_bodies, sightings,
+                                                  increments):
+        conn.execute(statement, parameters)
+    return new_bodies
+
+
+def migrate(engine, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Move long inline bodies of existing messages into message_bodies
+
+    Walks the table by primary key, one transaction per chunk. Compressed
+    inline rows are left alone. Returns row counts and the inline content
+    bytes moved versus the bytes of new bodies.
+    """
+    stmt = update(TelegramMessage).where(
+        TelegramMessage.id == bindparam('row_id')).values(
+            content=None, body_hash=bindparam('new_hash'))
+    report = {'rows': 0, 'shared': 0, 'new_bodies': 0,
+              'bytes_moved': 0, 'bytes_stored': 0}
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = [row._asdict() for row in conn.execute(
+                select(TelegramMessage.id, TelegramMessage.message_id,
+                       TelegramMessage.channel_id, TelegramMessage.content,
+                       TelegramMessage.dialog_type).where(
+                           TelegramMessage.id > last_id,
+                           TelegramMessage.body_hash.is_(None),
+                           TelegramMessage.content.isnot(None)).order_by(
+                               TelegramMessage.id).limit(chunk_size))]
+            if not rows:
+                break
+            sizes = [len(row['content'].encode('utf-8')) for row in rows]
+            new_bodies = share_rows(conn, rows)
+            changes = [{'row_id': row['id'], 'new_hash': row['body_hash']}
+                       for row in rows if row['body_hash']]
+            if changes:
+                conn.execute(stmt, changes)
+            report['rows'] += len(rows)
+            report['shared'] += len(changes)
+            report['new_bodies'] += len(new_bodies)
+            report['bytes_moved'] += sum(size for size, row in zip(sizes, rows)
+                                         if row['body_hash'])
+            report['bytes_stored'] += sum(body['size'] for body in new_bodies)
+            last_id = rows[-1]['id']
+        logger.info(f"Scanned {report['rows']} rows, shared {report['shared']}")
+    report['bytes_saved'] = report['bytes_moved'] - report['bytes_stored']
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deduplicate message bodies")
+    parser.add_argument('command', choices=['migrate'])
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    from app import app, db
+
+    with app.app_context():
+        print(json.dumps(migrate(db.engine, args.chunk_size), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Ingest-ordered changefeed of the message cache.
+
+Every stored, edited or deleted message takes the next number of one
+sequence, kept as the `#changes` row of change_versions. The row is locked
+from allocation until the writing transaction commits, so numbers become
+visible in commit order. Messages keep the number of their latest insert or
+edit in `change_seq`; deletions leave a row in `message_tombstones`. Both are
+indexed, so `/api/changes?after=` is two range scans.
+
+A message appears once, at its latest number, so a consumer that applies the
+feed in order and remembers the last number it applied converges on the
+cache. Rows stored before the feed existed have no number until
+`python changes.py backfill`; retention dropping old partitions is not part
+of the feed.
+"""
+import argparse
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy import and_, bindparam, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from heartbeat import utc_naive
+from models import ChangeVersion, MessageTombstone, TelegramMessage
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_SCOPE = '#changes'
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def allocate_statement(dialect_name, count, now=None):
+    """Upsert reserving `count` numbers; returns the last one"""
+    dialect = postgresql if dialect_name == 'postgresql' else sqlite
+    now = now or datetime.utcnow()
+    stmt = dialect.insert(ChangeVersion).values(
+        scope=SEQUENCE_SCOPE, version=count, changed_at=now)
+    return stmt.on_conflict_do_update(
+        index_elements=[ChangeVersion.scope],
+        set_={'version': ChangeVersion.version + count, 'changed_at': now},
+    ).returning(ChangeVersion.version)
+
+
+def number(rows, last):
+    """Give rows the `count` numbers ending at `last`, in order"""
+    for seq, row in enumerate(rows, start=last - len(rows) + 1):
+        row['change_seq'] = seq
+    return rows
+
+
+def last_seq(session):
+    return session.execute(select(ChangeVersion.version).where(
+        ChangeVersion.scope == SEQUENCE_SCOPE)).scalar() or 0
+
+
+def message_keys(keys):
+    """Condition matching (channel_id, message_id) pairs
+
+    One IN list per channel, so a batch does not nest thousands of terms.
+    """
+    by_channel = {}
+    for channel_id, message_id in keys:
+        by_channel.setdefault(channel_id, []).append(message_id)
+    return or_(*(and_(TelegramMessage.channel_id == channel_id,
+                      TelegramMessage.message_id.in_(message_ids))
+                 for channel_id, message_ids in by_channel.items()))
+
+
+def deleted_condition(channel_id, message_ids):
+    """Messages named by a deletion update
+
+    Telegram only says which chat for channels and supergroups; ids in
+    other chats are unique per account, so those match any non-channel.
+    """
+    condition = TelegramMessage.message_id.in_(list(message_ids))
+    if channel_id is not None:
+        return and_(condition, TelegramMessage.channel_id == channel_id)
+    return and_(condition, TelegramMessage.channel_id.notlike('-100%'))
+
+
+_messages = TelegramMessage.__table__
+EDIT = update(_messages).where(_messages.c.id == bindparam('row_id')).values(
+    content=bindparam('content'), content_zstd=bindparam('content_zstd'),
+    content_dict_id=bindparam('content_dict_id'), body_hash=None,
+    edit_date=bindparam('edit_date'), change_seq=bindparam('change_seq'))
+
+
+def read_changes(session, select_messages, after, limit):
+    """Up to `limit` changes numbered above `after`, in order
+
+    `select_messages` is a SELECT of message columns including change_seq
+    and edit_date. Returns (op, seq, row) tuples: row is a message row for
+    inserts and edits, a tombstone for deletions.
+    """
+    messages = session.execute(
+        select_messages.where(TelegramMessage.change_seq > after)
+        .order_by(TelegramMessage.change_seq).limit(limit)).all()
+    tombstones = session.execute(
+        select(MessageTombstone.seq, MessageTombstone.channel_id,
+               MessageTombstone.message_id, MessageTombstone.deleted_at)
+        .where(MessageTombstone.seq > after)
+        .order_by(MessageTombstone.seq).limit(limit)).all()
+    merged = [('edit' if row.edit_date is not None else 'insert',
+               row.change_seq, row) for row in messages]
+    merged += [('delete', row.seq, row) for row in tombstones]
+    merged.sort(key=lambda change: change[1])
+    return merged[:limit]
+
+
+class ChangeListener:
+    """Telethon handlers storing edits and deletions as they arrive"""
+
+    def __init__(self, store):
+        self.store = store
+
+    async def edited(self, event):
+        message = event.message
+        if not message.text:
+            return
+        try:
+            await self.store.edit_messages([{
+                'channel_id': str(event.chat_id),
+                'message_id': message.id,
+                'content': message.text,
+                'edit_date': utc_naive(message.edit_date) or datetime.utcnow(),
+            }])
+        except Exception as e:
+            logger.error("Error storing edit of message %s: %s", message.id, e)
+
+    async def deleted(self, event):
+        channel_id = str(event.chat_id) if event.chat_id is not None else None
+        try:
+            await self.store.delete_messages(channel_id, event.deleted_ids)
+        except Exception as e:
+            logger.error("Error storing deletion of %s: %s", event.deleted_ids, e)
+
+
+def backfill(engine, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Number rows stored before the feed existed, in id order
+
+    One transaction per chunk. Returns the number of rows numbered.
+    """
+    stmt = update(_messages).where(_messages.c.id == bindparam('row_id')).values(
+        change_seq=bindparam('change_seq'))
+    numbered = 0
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(
+                select(TelegramMessage.id).where(
+                    TelegramMessage.change_seq.is_(None)).order_by(
+                        TelegramMessage.id).limit(chunk_size)).scalars().all()
+            if not ids:
+                break
+            last = conn.execute(allocate_statement(conn.dialect.name,
+                                                   len(ids))).scalar_one()
+            conn.execute(stmt, number([{'row_id': row_id} for row_id in ids],
+                                      last))
+            numbered += len(ids)
+        logger.info(f"Numbered {numbered} rows")
+    return numbered
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Message changefeed")
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    from app import app, db
+
+    with app.app_context():
+        print(json.dumps({'numbered': backfill(db.engine, args.chunk_size)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,131 +2,373 @@ import os
 import asyncio
 import logging
 import threading
+import time
 from datetime import datetime, timedelta
-from telethon import TelegramClient
-from flask import current_app
+from telethon import TelegramClient, events, errors
 import sys
-from app import db
-from models import TelegramMessage
-from utils import should_be_ton_dev, get_proper_dialog_type
+from utils import (should_be_ton_dev, get_proper_dialog_type, forward_origin,
+                   sender_info)
+from config import Config
+from scopes import ScopeConfig, load_folder_peers
+from scheduler import PollScheduler
+from entity_cache import EntityCache
+from heartbeat import Heartbeat, utc_naive
+from async_db import CollectorStore
+from changes import ChangeListener
+import metrics
+import profiling
+from logging_setup import LogSampler
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # Global collector thread reference
 collector_thread = None
 
+# How often folder membership is re-read from Telegram, in seconds
+FOLDER_REFRESH_INTERVAL = 600
+
+# Stored messages used to seed a dialog's arrival rate estimate
+RATE_SEED_SAMPLE = 20
+
+# Bounds of the sleep between scheduler wake-ups, in seconds
+MIN_SLEEP = 0.5
+MAX_ERROR_SLEEP = 60
+
+# Repeated per-dialog errors are logged once per this many seconds
+ERROR_LOG_INTERVAL = 300
+
+
+def loop_time():
+    """Monotonic clock of the running event loop"""
+    return asyncio.get_running_loop().time()
+
+
+def schedule_dialogs(scheduler, scope_config, dialogs, folder_peers, now,
+                     seeds=None):
+    """Register in-scope dialogs with the scheduler and drop the rest
+
+    `seeds` maps channel ids to stored message dates used to seed the
+    arrival rate estimate of newly scheduled dialogs. Returns a mapping of
+    channel id to (dialog, dialog_type, tier).
+    """
+    seeds = seeds or {}
+    dialogs_by_id = {}
+    for dialog in dialogs:
+        if not hasattr(dialog, 'id'):
+            continue
+        channel_id = str(dialog.id)
+        dialog_type = dialog.dialog_type
+        tier = scope_config.classify(dialog, folder_peers, dialog_type)
+        if tier is None:
+            continue
+
+        timestamps = None
+        if channel_id not in scheduler:
+            timestamps = seeds.get(channel_id)
+        scheduler.register(channel_id, tier, now, timestamps)
+        dialogs_by_id[channel_id] = (dialog, dialog_type, tier)
+
+    for channel_id in list(scheduler.dialogs):
+        if channel_id not in dialogs_by_id:
+            scheduler.remove(channel_id)
+    return dialogs_by_id
+
+
+async def process_dialog(client, store, dialog, dialog_type, tier,
+                         heartbeat=None):
+    """Fetch and store new messages of one dialog
+
+    Returns the dates of stored messages and the number of messages fetched.
+    The newest message Telegram returned and the stored high-water mark are
+    reported to `heartbeat`.
+    """
+    channel_id = str(dialog.id)
+    channel_title = getattr(dialog, 'title', channel_id)
+
+    stored = []
+    fetched = 0
+
+    # Get latest stored message ID
+    latest = await store.latest_message(channel_id)
+    latest_id = latest.message_id if latest else 0
+
+    # Collect new messages and write them as one bulk insert
+    rows = []
+    senders = {}
+    top = None
+    is_ton_dev = should_be_ton_dev(channel_title)
+    async for message in client.iter_messages(dialog.input_entity,
+                                              limit=tier.catch_up_limit):
+        if top is None:
+            # Messages arrive newest first
+            top = message
+            if heartbeat is not None:
+                heartbeat.seen(channel_id, message.id, message.date,
+                               channel_title)
+        if message.id <= latest_id and latest_id != 0:
+            continue  # Skip processed messages
+
+        fetched += 1
+        if message.text:  # Only process text messages
+            fwd_from_id, fwd_from_message_id, fwd_date = forward_origin(message)
+            sender = sender_info(message)
+            if sender is not None:
+                senders[sender['id']] = sender
+            rows.append({
+                'message_id': message.id,
+                'channel_id': channel_id,
+                'channel_title': channel_title,
+                'content': message.text,
+                'timestamp': utc_naive(message.date),
+                'is_ton_dev': is_ton_dev,
+                'is_outgoing': bool(getattr(message, 'out', False)),
+                'dialog_type': dialog_type,
+                'fwd_from_id': fwd_from_id,
+                'fwd_from_message_id': fwd_from_message_id,
+                'fwd_date': utc_naive(fwd_date),
+                'sender_id': sender['id'] if sender else None,
+            })
+
+    if rows:
+        for retry in range(3):
+            try:
+                with metrics.db_commit_latency.time():
+                    await store.insert_messages(rows, senders)
+                logger.debug("Saved %d new messages from %s", len(rows),
+                             channel_title)
+                metrics.messages_ingested.labels(
+                    dialog_type=dialog_type).inc(len(rows))
+                stored = [row['timestamp'] for row in rows]
+                if heartbeat is not None:
+                    heartbeat.committed()
+                break
+            except Exception as e:
+                logger.error("Error saving messages batch of %s (attempt %d): %s",
+                             channel_title, retry + 1, e)
+                if retry < 2:  # Don't sleep on last attempt
+                    metrics.db_commit_retries.inc()
+                    await asyncio.sleep(1 * (retry + 1))  # Progressive backoff
+                else:
+                    metrics.db_commit_failures.inc()
+
+    if heartbeat is not None and top is not None:
+        if stored or not rows:
+            # Everything up to the top message is processed
+            heartbeat.stored(channel_id, top.id, top.date, channel_title)
+        else:
+            # The oldest message of the failed batch keeps waiting
+            heartbeat.seen(channel_id, top.id,
+                           min(row['timestamp'] for row in rows), channel_title)
 
-async def setup_telegram_session():
-    """Set up a new Telegram session"""
-    try:
-        # Use Replit's persistent storage for session
-        session_path = os.path.join(os.environ.get('REPL_HOME', ''),
-                                    'ton_collector_session.session')
-        logger.info(f"Setting up Telegram session at: {session_path}")
+    return stored, fetched
 
-        # Get credentials from environment
-        api_id = int(os.environ.get('TELEGRAM_API_ID', 0))
-        api_hash = os.environ.get('TELEGRAM_API_HASH', '')
-        phone = os.environ.get('TELEGRAM_PHONE', '')
 
-        logger.info(f"Got phone number: {phone}")
-        logger.debug(f"Using API ID: {api_id}")
+async def run_collection(client, max_cycles=None, store=None):
+    """Poll dialogs of a connected, authorized client
 
-        if not all([api_id, api_hash, phone]):
-            logger.error("Missing required credentials:")
-            logger.error(f"API ID present: {bool(api_id)} (got: {api_id})")
-            logger.error(
-                f"API Hash present: {bool(api_hash)} (got: {'[hidden]' if api_hash else 'None'})"
-            )
-            logger.error(
-                f"Phone present: {bool(phone)} (got: {phone if phone else 'None'})"
-            )
-            return False
+    Runs forever unless `max_cycles` is given, which tests and benchmarks
+    use to drive the pipeline with a fake client. Database access goes
+    through `store`, by default a CollectorStore on DATABASE_URL spooling
+    to SPOOL_DIR.
+    """
+    own_store = store is None
+    if own_store:
+        store = CollectorStore.from_url(spool_dir=Config.SPOOL_DIR)
+    try:
+        return await _run_collection(client, store, max_cycles)
+    finally:
+        if own_store:
+            await store.close()
 
-        # Remove existing session if it exists
-        if os.path.exists(session_path):
-            try:
-                os.remove(session_path)
-                logger.info(f"Removed existing session file for clean start")
-            except Exception as e:
-                logger.warning(f"Could not remove existing session: {str(e)}")
 
-        logger.info("Creating TelegramClient with provided credentials")
-        # Initialize client with proper error handling
+async def _run_collection(client, store, max_cycles):
+    try:
+        scope_config = ScopeConfig.load(Config.COLLECTOR_SCOPES,
+                                        Config.COLLECTOR_SCOPES_FILE)
+    except Exception as e:
+        logger.error(
+            f"Invalid collector scope configuration, collecting all dialogs: {str(e)}"
+        )
+        scope_config = ScopeConfig()
+    logger.info("Collector tiers: %s", list(scope_config.tiers.values()))
+
+    # Start from the persisted dialog list, reconciling right away
+    # only when there is nothing cached yet
+    entity_cache = EntityCache(store)
+    await entity_cache.load()
+    client.add_event_handler(entity_cache.handle_update, events.Raw)
+
+    # Liveness and per-dialog lag, readable by /healthz in every worker
+    heartbeat = Heartbeat(store)
+    client.add_event_handler(heartbeat.handle_update, events.Raw)
+
+    # Edits and deletions only arrive as updates; polling never sees them
+    listener = ChangeListener(store)
+    client.add_event_handler(listener.edited, events.MessageEdited())
+    client.add_event_handler(listener.deleted, events.MessageDeleted())
+
+    reconciled_at = loop_time() if entity_cache.dialogs() else None
+
+    folder_peers = {}
+    folders_loaded_at = None
+    scheduler = PollScheduler()
+    dialogs_by_id = {}
+    reschedule = True
+    cycle_errors = 0
+    error_sampler = LogSampler(ERROR_LOG_INTERVAL)
+
+    cycles = 0
+    while max_cycles is None or cycles < max_cycles:  # Continuous collection loop
+        cycles += 1
+        cycle_started = time.perf_counter()
+        summary = {
+            'cycle': cycles,
+            'polled': 0,
+            'fetched': 0,
+            'stored': 0,
+            'empty': 0,
+            'errors': 0,
+            'flood_wait': 0,
+        }
+        if Config.SQL_PROFILING:
+            profiling.begin(f"collector cycle {cycles}")
+        sleep_for = None
         try:
-            client = TelegramClient(session_path,
-                                    api_id=api_id,
-                                    api_hash=api_hash)
-        except Exception as e:
-            logger.error(f"Failed to create TelegramClient: {str(e)}")
-            return False
+            # Writes spooled during a database outage go first
+            await store.replay()
+            await heartbeat.cycle_started(cycles)
+
+            # Refresh folder membership used by folder scopes
+            if scope_config.folder_names and (
+                    folders_loaded_at is None or
+                    loop_time() - folders_loaded_at >= FOLDER_REFRESH_INTERVAL):
+                try:
+                    folder_peers = await load_folder_peers(
+                        client, scope_config.folder_names)
+                    folders_loaded_at = loop_time()
+                    reschedule = True
+                except Exception as e:
+                    logger.error("Error loading folders: %s", e)
+
+            # Reconcile the cached dialog list with Telegram occasionally
+            reconcile = reconciled_at is None or loop_time(
+            ) - reconciled_at >= Config.DIALOG_RECONCILE_INTERVAL
+            metrics.record_cache('dialogs', hit=not reconcile)
+            if reconcile:
+                dialogs = await client.get_dialogs(limit=Config.DIALOG_LIMIT)
+                logger.info("Found %d dialogs", len(dialogs))
+                entity_cache.sync_dialogs(dialogs)
+                reconciled_at = loop_time()
+                folders_loaded_at = None
+
+            # Persist entities learned from dialogs and updates, and
+            # re-classify dialogs whenever the cached list changed
+            if await entity_cache.flush() or reschedule:
+                dialogs = entity_cache.dialogs()
+                # Seed arrival rates of new dialogs from what we already stored
+                seeds = await store.recent_timestamps(
+                    [str(d.id) for d in dialogs if str(d.id) not in scheduler],
+                    RATE_SEED_SAMPLE)
+                dialogs_by_id = schedule_dialogs(scheduler, scope_config,
+                                                 dialogs, folder_peers,
+                                                 loop_time(), seeds)
+                logger.info("Scheduled %d dialogs", len(dialogs_by_id))
+                reschedule = False
+
+            # Poll every dialog whose next poll time has come
+            due = scheduler.pop_due(loop_time())
+            metrics.queue_depth.set(len(due))
+            metrics.scheduled_dialogs.set(len(scheduler))
+            for position, channel_id in enumerate(due):
+                target = dialogs_by_id.get(channel_id)
+                if target is None:
+                    continue
+                dialog, dialog_type, tier = target
+                try:
+                    with metrics.dialog_fetch_latency.labels(tier=tier.name).time():
+                        stored, fetched = await process_dialog(
+                            client, store, dialog, dialog_type, tier,
+                            heartbeat)
+                    scheduler.record_poll(channel_id, stored, loop_time(),
+                                          fetched)
+                    summary['polled'] += 1
+                    summary['fetched'] += fetched
+                    summary['stored'] += len(stored)
+                    if not fetched:
+                        summary['empty'] += 1
+                except errors.FloodWaitError as e:
+                    # The wait applies to the whole account, pause everything
+                    logger.warning("FloodWait of %d seconds while polling %s",
+                                   e.seconds, dialog.title)
+                    metrics.flood_wait_seconds.inc(e.seconds)
+                    summary['flood_wait'] += e.seconds
+                    for pending in due[position:]:
+                        scheduler.defer(pending, loop_time(), e.seconds)
+                    await asyncio.sleep(e.seconds)
+                    break
+                except Exception as e:
+                    summary['errors'] += 1
+                    error_sampler.log(logger,
+                                      logging.ERROR, (channel_id, type(e)),
+                                      "Error processing dialog %s: %s",
+                                      getattr(dialog, 'title', channel_id),
+                                      e,
+                                      exc_info=True)
+                    scheduler.record_poll(channel_id, [], loop_time())
+
+            cycle_errors = 0
+            duration = time.perf_counter() - cycle_started
+            metrics.cycle_duration.observe(duration)
+            summary['duration'] = round(duration, 3)
+            # One record per cycle instead of lines per dialog
+            logger.info(
+                "Cycle %d: polled %d dialogs (%d empty, %d errors), "
+                "stored %d of %d fetched messages in %.2fs", cycles,
+                summary['polled'], summary['empty'], summary['errors'],
+                summary['stored'], summary['fetched'], duration,
+                extra=summary)
+            await heartbeat.cycle_finished()
+
+            # Sleep until the next dialog is due or the dialog list is stale
+            now = loop_time()
+            refresh_in = reconciled_at + Config.DIALOG_RECONCILE_INTERVAL - now
+            sleep_for = scheduler.seconds_until_next(now, default=refresh_in)
+            sleep_for = max(min(sleep_for, refresh_in), MIN_SLEEP)
+
+        except errors.FloodWaitError as e:
+            logger.warning("FloodWait of %d seconds in collection cycle",
+                           e.seconds)
+            metrics.flood_wait_seconds.inc(e.seconds)
+            await heartbeat.cycle_finished(f"FloodWait of {e.seconds} seconds")
+            await asyncio.sleep(e.seconds)
 
-        # Connect with timeout handling
-        try:
-            await asyncio.wait_for(client.connect(), timeout=30)
-            logger.info("Connected to Telegram servers")
-        except asyncio.TimeoutError:
-            logger.error("Timeout connecting to Telegram servers")
-            return False
         except Exception as e:
-            logger.error(f"Failed to connect to Telegram: {str(e)}")
-            return False
-
-        if not await client.is_user_authorized():
-            try:
-                logger.info(f"Sending code request to: {phone}")
-                # Send code request with proper formatting
-                # Make sure the phone is in international format (with +)
-                if not phone.startswith('+'):
-                    phone = '+' + phone
-
-                # Send the code request
-                code_sent = await client.send_code_request(phone)
-                logger.info(
-                    f"Verification code sent successfully: {code_sent}")
-
-                # Store the phone hash if available
-                if hasattr(code_sent, 'phone_code_hash'):
-                    os.environ[
-                        'TELEGRAM_PHONE_HASH'] = code_sent.phone_code_hash
-                    logger.info("Stored phone code hash for verification")
-
-                # At this point, we return True to indicate the code was sent
-                # The actual sign-in will happen in the verify_code endpoint
-                return True
+            cycle_errors += 1
+            await heartbeat.cycle_finished(f"{type(e).__name__}: {e}")
+            retry_wait = min(MIN_SLEEP * 2**cycle_errors, MAX_ERROR_SLEEP)
+            logger.error("Error in collection cycle, retrying in %g seconds: %s",
+                         retry_wait, e, exc_info=True)
+            await asyncio.sleep(retry_wait)
 
-            except Exception as e:
-                logger.error(f"Error during code request: {str(e)}")
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                logger.error(e)
-                logger.error("File: %s Lineno: %s", fname, exc_tb.tb_lineno)
-                await client.disconnect()
-                return False
-        else:
-            logger.info("Already authorized, no need for verification code")
-            await client.disconnect()
-            return True
+        finally:
+            # Also closes the profile of a cycle that failed
+            profiling.end()
 
-    except Exception as e:
-        logger.error(f"Error setting up Telegram session: {str(e)}")
-        return False
+        if sleep_for is not None and (max_cycles is None or
+                                      cycles < max_cycles):
+            logger.debug("Collector sleeping for %.1f seconds", sleep_for)
+            await asyncio.sleep(sleep_for)
+    return True
 
 
 async def collect_messages():
     """Main collection function"""
-    from app import app  # Import Flask app
-    
     client = None
     try:
         # Use Replit's persistent storage for session
         session_path = os.path.join(os.environ.get('REPL_HOME', ''),
                                     'ton_collector_session.session')
-        
-        # Create application context
-        app.app_context().push()
+
 
         # Check if deployment environment
         is_deployment = os.environ.get('REPLIT_DEPLOYMENT', False)
@@ -135,11 +377,11 @@ async def collect_messages():
                 "Deployment environment detected, checking session validity")
 
         # Check if session exists and is not empty
-        if not os.path.exists(session_path) or os.path.getsize(
-                session_path) == 0:
+        session_exists = os.path.exists(session_path)
+        if not session_exists or os.path.getsize(session_path) == 0:
             logger.error(
                 "Session file not found or empty. Please run setup first")
-            if os.path.exists(session_path):
+            if session_exists:
                 os.remove(session_path)
                 logger.info("Removed invalid session file")
             return False
@@ -178,117 +420,7 @@ async def collect_messages():
 
             logger.info("Successfully connected using existing session")
 
-            while True:  # Continuous collection loop
-                try:
-                    # Get all dialogs
-                    dialogs = await client.get_dialogs(limit=200)
-                    logger.info(f"Found {len(dialogs)} dialogs")
-
-                    # Process each dialog
-                    for dialog in dialogs:
-                        try:
-                            if not hasattr(dialog, 'id'):
-                                continue
-
-                            channel_id = str(dialog.id)
-                            channel_title = getattr(dialog, 'title',
-                                                    channel_id)
-
-                            # Get dialog type
-                            entity = dialog.entity
-                            dialog_type = get_proper_dialog_type(entity)
-
-                            # Log dialog's latest message info from Telethon
-                            logger.info(f"Dialog: {channel_title}")
-                            logger.info(
-                                f"Latest message date from Telethon: {getattr(dialog.message, 'date', 'Unknown')}"
-                            )
-
-                            # Get latest messages - use app's context manager
-                            with current_app.app_context():
-                                # Get latest stored message ID
-                                latest_msg = TelegramMessage.query.filter_by(
-                                    channel_id=channel_id).order_by(
-                                        TelegramMessage.message_id.desc(
-                                        )).first()
-
-                                latest_id = latest_msg.message_id if latest_msg else 0
-                                logger.debug(
-                                    f"Processing {channel_title} from message_id > {latest_id}"
-                                )
-                                logger.debug(
-                                    f"Latest message in DB: {latest_msg.timestamp if latest_msg else 'None'}"
-                                )
-
-                                # Process new messages with smaller batch size
-                                message_batch = []
-                                async for message in client.iter_messages(
-                                        dialog, limit=20):
-                                    if message.id <= latest_id and latest_id != 0:
-                                        logger.debug(
-                                            f"Skipping message {message.id} - already processed"
-                                        )
-                                        continue  # Skip processed messages
-
-                                    if message.text:  # Only process text messages
-                                        try:
-                                            is_outgoing = getattr(
-                                                message, 'out', False)
-                                            is_ton_dev = should_be_ton_dev(
-                                                channel_title)
-
-                                            new_msg = TelegramMessage(
-                                                message_id=message.id,
-                                                channel_id=channel_id,
-                                                channel_title=channel_title,
-                                                content=message.text,
-                                                timestamp=message.date,
-                                                is_ton_dev=is_ton_dev,
-                                                is_outgoing=is_outgoing,
-                                                dialog_type=dialog_type)
-                                            db.session.add(new_msg)
-                                            message_batch.append(message.id)
-                                        except Exception as e:
-                                            logger.error(
-                                                f"Error preparing message: {str(e)}"
-                                            )
-
-                                # Commit all messages for this dialog at once
-                                if message_batch:
-                                    for retry in range(3):
-                                        try:
-                                            db.session.commit()
-                                            logger.info(
-                                                f"Saved {len(message_batch)} new messages from {channel_title}"
-                                            )
-                                            break
-                                        except Exception as e:
-                                            logger.error(
-                                                f"Error saving messages batch (attempt {retry + 1}): {str(e)}"
-                                            )
-                                            db.session.rollback()
-                                            if retry < 2:  # Don't sleep on last attempt
-                                                import time
-                                                time.sleep(1 * (retry + 1))  # Progressive backoff
-
-                        except Exception as e:
-                            exc_type, exc_obj, exc_tb = sys.exc_info()
-                            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                            logger.error(e)
-                            logger.error("File: %s Lineno: %s", fname, exc_tb.tb_lineno)
-                            logger.error(
-                                f"Error processing dialog {getattr(dialog, 'title', 'Unknown')}: {str(e)}"
-                            )
-                            continue
-
-                    # Short sleep between collection cycles
-                    logger.info(
-                        "Completed collection cycle, sleeping for 30 seconds")
-                    await asyncio.sleep(30)
-
-                except Exception as e:
-                    logger.error(f"Error in collection cycle: {str(e)}")
-                    await asyncio.sleep(60)
+            return await run_collection(client)
 
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
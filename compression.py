@@ -0,0 +1,47 @@
+"""gzip response compression for the dashboard and API.
+
+JSON and HTML listings compress several-fold. Only complete bodies are
+compressed; streamed responses such as /api/export are passed through, and
+so are small bodies and responses the client did not ask to compress.
+"""
+import gzip
+
+from flask import request
+
+from config import Config
+
+COMPRESSIBLE = ('text/', 'application/json', 'application/msgpack',
+                'application/x-msgpack', 'application/javascript')
+
+
+def _compressible(response):
+    if response.direct_passthrough or response.is_streamed:
+        return False
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    return response.mimetype.startswith(COMPRESSIBLE)
+
+
+def _compress(response):
+    response.vary.add('Accept-Encoding')
+    if not _compressible(response) or \
+            'gzip' not in request.accept_encodings:
+        return response
+    body = response.get_data()
+    if len(body) < Config.COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=Config.COMPRESS_LEVEL,
+                                    mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    # A strong validator would claim byte equality with the identity body
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """Compress eligible responses on the way out"""
+    app.after_request(_compress)
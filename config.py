@@ -0,0 +1,127 @@
+import os
+
+
+class Config:
+    """Application configuration read from environment variables"""
+    TELEGRAM_API_ID = int(os.environ.get('TELEGRAM_API_ID', 0) or 0)
+    TELEGRAM_API_HASH = os.environ.get('TELEGRAM_API_HASH', '')
+
+    # Folder used by the legacy TelegramCollector in telegram_client.py
+    TARGET_FOLDER = os.environ.get('TARGET_FOLDER', '')
+
+    # Number of most recent dialogs the collector looks at
+    DIALOG_LIMIT = int(os.environ.get('COLLECTOR_DIALOG_LIMIT', 200))
+
+    # Seconds between `get_dialogs` reconciliations of the cached dialog list
+    DIALOG_RECONCILE_INTERVAL = int(
+        os.environ.get('COLLECTOR_DIALOG_RECONCILE_INTERVAL', 600))
+
+    # Collection scopes and priority tiers, see scopes.py for the format.
+    # COLLECTOR_SCOPES holds inline JSON, COLLECTOR_SCOPES_FILE a path to it.
+    COLLECTOR_SCOPES = os.environ.get('COLLECTOR_SCOPES', '')
+    COLLECTOR_SCOPES_FILE = os.environ.get('COLLECTOR_SCOPES_FILE', '')
+
+    # Per-request and per-collection-cycle SQL profiling, see profiling.py.
+    # Always on for requests when Flask runs in debug mode.
+    SQL_PROFILING = os.environ.get('SQL_PROFILING', '').lower() in ('1', 'true', 'yes')
+
+    # Statements slower than this many milliseconds are logged with their
+    # EXPLAIN plan; 0 disables the slow-query log
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 500))
+
+    # Share of slow statements that are logged and explained
+    SLOW_QUERY_SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_SAMPLE_RATE', 0.1))
+
+    # Identical statements repeated this often in one request or
+    # collection cycle are reported as a likely N+1 pattern
+    N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10))
+
+    # Root log level and output format ("text" or "json"), see logging_setup.py
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+
+    # Seconds without collector progress before /readyz reports it as down.
+    # The collector sleeps at most DIALOG_RECONCILE_INTERVAL between cycles.
+    COLLECTOR_STALE_AFTER = int(os.environ.get('COLLECTOR_STALE_AFTER', 900))
+
+    # Connection pool of the collector's async engine (PostgreSQL only),
+    # kept apart from the web workers' pools, see async_db.py
+    COLLECTOR_DB_POOL_SIZE = int(os.environ.get('COLLECTOR_DB_POOL_SIZE', 4))
+    COLLECTOR_DB_MAX_OVERFLOW = int(
+        os.environ.get('COLLECTOR_DB_MAX_OVERFLOW', 2))
+
+    # Web connection pools. The primary pool serves writes and every route
+    # that is not marked read-only (see db_routing.py); lower it when
+    # replicas take the read traffic.
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+
+    # Comma-separated read replica URLs for read-only routes, each with its
+    # own pool. Replicas lagging more than REPLICA_MAX_LAG seconds are
+    # skipped; lag is re-checked every REPLICA_LAG_CHECK_INTERVAL seconds.
+    DATABASE_REPLICA_URLS = [
+        url.strip()
+        for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if url.strip()
+    ]
+    REPLICA_POOL_SIZE = int(os.environ.get('REPLICA_POOL_SIZE', 5))
+    REPLICA_MAX_OVERFLOW = int(os.environ.get('REPLICA_MAX_OVERFLOW', 10))
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 30))
+    REPLICA_LAG_CHECK_INTERVAL = float(
+        os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+
+    # SQLite profile, see sqlite_profile.py: page cache per connection in
+    # KiB, memory-mapped I/O size in bytes, lock wait in milliseconds, and
+    # rows the collector's single writer buffers before committing
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 65536))
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 268435456))
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_BATCH_ROWS = int(os.environ.get('SQLITE_BATCH_ROWS', 5000))
+
+    # gzip responses of at least COMPRESS_MIN_SIZE bytes when the client
+    # accepts it, see compression.py
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+
+    # Store new message content zstd-compressed, with dictionaries trained
+    # by `python content_codec.py train`, see content_codec.py. Channels with
+    # at least CONTENT_CHANNEL_DICT_MIN messages get their own dictionary.
+    CONTENT_COMPRESSION = os.environ.get('CONTENT_COMPRESSION', '').lower() in ('1', 'true', 'yes')
+    CONTENT_COMPRESSION_LEVEL = int(os.environ.get('CONTENT_COMPRESSION_LEVEL', 3))
+    CONTENT_DICT_SIZE = int(os.environ.get('CONTENT_DICT_SIZE', 16384))
+    CONTENT_DICT_SAMPLES = int(os.environ.get('CONTENT_DICT_SAMPLES', 5000))
+    CONTENT_CHANNEL_DICT_MIN = int(os.environ.get('CONTENT_CHANNEL_DICT_MIN', 2000))
+
+    # Store message bodies of at least CONTENT_DEDUP_MIN_BYTES once, keyed by
+    # their hash, see bodies.py. Shorter ones stay inline.
+    CONTENT_DEDUP = os.environ.get('CONTENT_DEDUP', '1').lower() in ('1', 'true', 'yes')
+    CONTENT_DEDUP_MIN_BYTES = int(os.environ.get('CONTENT_DEDUP_MIN_BYTES', 64))
+
+    # Cluster near-identical messages (spam waves) at ingest with MinHash/LSH,
+    # comparing each message with those of the last NEAR_DUP_WINDOW_HOURS,
+    # see near_duplicates.py. Messages under NEAR_DUP_MIN_CHARS are ignored.
+    NEAR_DUP = os.environ.get('NEAR_DUP', '1').lower() in ('1', 'true', 'yes')
+    NEAR_DUP_WINDOW_HOURS = int(os.environ.get('NEAR_DUP_WINDOW_HOURS', 24))
+    NEAR_DUP_THRESHOLD = float(os.environ.get('NEAR_DUP_THRESHOLD', 0.6))
+    NEAR_DUP_MIN_CHARS = int(os.environ.get('NEAR_DUP_MIN_CHARS', 40))
+
+    # Count terms, hashtags, links and mentions per channel and time bucket
+    # as messages are stored, see trending.py
+    TRENDING = os.environ.get('TRENDING', '1').lower() in ('1', 'true', 'yes')
+    TRENDING_CAPACITY = int(os.environ.get('TRENDING_CAPACITY', 200))
+    TRENDING_CMS_WIDTH = int(os.environ.get('TRENDING_CMS_WIDTH', 2048))
+    TRENDING_CMS_DEPTH = int(os.environ.get('TRENDING_CMS_DEPTH', 4))
+
+    # Unique senders per channel and day are estimated with HyperLogLog
+    # sketches of 2**PARTICIPANTS_PRECISION registers, see participants.py
+    PARTICIPANTS_PRECISION = int(os.environ.get('PARTICIPANTS_PRECISION', 10))
+
+    # Spool collector writes to SPOOL_DIR before the database, so ingestion
+    # goes on through database outages, see spool.py. Empty disables it.
+    # Replay is retried after SPOOL_RETRY_SECONDS, doubling up to
+    # SPOOL_RETRY_MAX_SECONDS while the database keeps failing.
+    SPOOL_DIR = os.environ.get('SPOOL_DIR', 'collector_spool')
+    SPOOL_SEGMENT_BYTES = int(os.environ.get('SPOOL_SEGMENT_BYTES', 16 * 1024 * 1024))
+    SPOOL_FSYNC = os.environ.get('SPOOL_FSYNC', '1').lower() in ('1', 'true', 'yes')
+    SPOOL_RETRY_SECONDS = float(os.environ.get('SPOOL_RETRY_SECONDS', 5))
+    SPOOL_RETRY_MAX_SECONDS = float(os.environ.get('SPOOL_RETRY_MAX_SECONDS', 300))
@@ -0,0 +1,393 @@
+"""Optional zstd compression of message content with trained dictionaries.
+
+Chat text repeats a lot within a channel (signatures, links, templates) but
+single messages are too short for a compressor to find the repetition on its
+own. zstd dictionaries trained on a sample of messages supply it: one per
+dialog type, plus one per busy channel. Compressed rows keep `content` NULL
+and store the frame in `content_zstd` together with the dictionary id;
+messages that would not shrink are stored as plain text.
+
+Reads decompress transparently: ORM instances get `content` filled in on
+load, and the Core read paths (API listings, export) call `decode`.
+Dictionaries are never modified, so rows written with an older one stay
+readable after retraining.
+
+Usage:
+    python content_codec.py train                  # train dictionaries
+    python content_codec.py migrate --chunk-size 5000
+    python content_codec.py migrate --decompress   # back to plain text
+
+Set CONTENT_COMPRESSION=1 to have the collector compress new messages; it
+picks up newly trained dictionaries within DICTIONARY_RELOAD_INTERVAL.
+Needs the optional `zstandard` package.
+"""
+import argparse
+import json
+import logging
+import threading
+
+from sqlalchemy import bindparam, event, func, null, select, update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from config import Config
+import bodies
+from models import ContentDictionary, MessageBody, TelegramMessage
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_SCOPE = 'channel:'
+TYPE_SCOPE = 'dialog_type:'
+
+# Seconds the collector keeps its dictionary list before reloading it
+DICTIONARY_RELOAD_INTERVAL = 600
+
+# Fewer samples than this cannot train a useful dictionary
+MIN_TRAINING_SAMPLES = 100
+
+DEFAULT_CHUNK_SIZE = 5000
+
+# Newest compressed rows /api/search decompresses looking for matches
+SEARCH_SCAN_LIMIT = 20000
+
+
+def _require_zstd():
+    if zstd is None:
+        raise RuntimeError("Content compression requires zstandard to be installed")
+
+
+class ContentCodec:
+    """Dictionaries by id and the newest one per scope
+
+    Dictionaries missing from memory are fetched with `loader(dict_id)`,
+    which returns the raw dictionary bytes.
+    """
+
+    def __init__(self, loader=None, level=None):
+        self.loader = loader
+        self.level = level if level is not None else Config.CONTENT_COMPRESSION_LEVEL
+        self.current = {}  # scope -> id of the newest dictionary
+        self._dictionaries = {}
+        self._local = threading.local()  # zstd contexts are not thread-safe
+        self._lock = threading.Lock()
+
+    def add(self, dict_id, scope, data):
+        _require_zstd()
+        with self._lock:
+            if dict_id not in self._dictionaries:
+                self._dictionaries[dict_id] = zstd.ZstdCompressionDict(data)
+            if scope and dict_id > self.current.get(scope, 0):
+                self.current[scope] = dict_id
+        return self._dictionaries[dict_id]
+
+    @property
+    def ids(self):
+        return list(self._dictionaries)
+
+    def load(self, rows):
+        """Add (id, scope, data) rows, e.g. all of content_dictionaries"""
+        for dict_id, scope, data in rows:
+            self.add(dict_id, scope, data)
+
+    def pick(self, channel_id=None, dialog_type=None):
+        """Id of the dictionary for a channel, falling back to its dialog type"""
+        return self.current.get(f'{CHANNEL_SCOPE}{channel_id}') or \
+            self.current.get(f'{TYPE_SCOPE}{dialog_type}')
+
+    def _dictionary(self, dict_id):
+        dictionary = self._dictionaries.get(dict_id)
+        if dictionary is None:
+            data = self.loader(dict_id) if self.loader else None
+            if data is None:
+                raise LookupError(f"Unknown content dictionary {dict_id}")
+            dictionary = self.add(dict_id, None, data)
+        return dictionary
+
+    def _context(self, kind, dict_id):
+        contexts = self._local.__dict__.setdefault(kind, {})
+        context = contexts.get(dict_id)
+        if context is None:
+            dictionary = self._dictionary(dict_id) if dict_id else None
+            if kind == 'compress':
+                context = zstd.ZstdCompressor(level=self.level,
+                                              dict_data=dictionary)
+            else:
+                context = zstd.ZstdDecompressor(dict_data=dictionary)
+            contexts[dict_id] = context
+        return context
+
+    def compress(self, text, channel_id=None, dialog_type=None):
+        """(frame, dict_id), or None when compressing would not save space"""
+        _require_zstd()
+        raw = text.encode('utf-8')
+        dict_id = self.pick(channel_id, dialog_type)
+        frame = self._context('compress', dict_id).compress(raw)
+        if len(frame) >= len(raw):
+            return None
+        return frame, dict_id
+
+    def decompress(self, frame, dict_id=None):
+        _require_zstd()
+        return self._context('decompress', dict_id).decompress(
+            frame).decode('utf-8')
+
+    def decode(self, content, frame, dict_id):
+        """Content of a row given its stored columns"""
+        if frame is None:
+            return content
+        return self.decompress(frame, dict_id)
+
+
+def _load_dictionary(dict_id):
+    from app import db
+
+    # Always from the primary, a replica may not have it yet
+    with db.engine.connect() as conn:
+        return conn.execute(
+            select(ContentDictionary.data).where(
+                ContentDictionary.id == dict_id)).scalar()
+
+
+# Shared by the web tier and the command line tools
+codec = ContentCodec(loader=_load_dictionary)
+
+
+def decode_rows(rows, content_index):
+    """Replace the trailing bodies.STORED_COLUMNS of Core rows by the content"""
+    decoded = []
+    for row in rows:
+        row = list(row)
+        dict_id, frame = row.pop(), row.pop()
+        row[content_index] = codec.decode(row[content_index], frame, dict_id)
+        decoded.append(tuple(row))
+    return decoded
+
+
+def compress_rows(rows, with_codec):
+    """Compress the content of message or body rows (dicts) in place"""
+    for row in rows:
+        compressed = with_codec.compress(row['content'],
+                                         row.get('channel_id') or
+                                         row.get('first_channel_id'),
+                                         row.get('dialog_type')) \
+            if row.get('content') else None
+        if compressed is None:
+            row['content_zstd'] = row['content_dict_id'] = None
+        else:
+            row['content'] = None
+            row['content_zstd'], row['content_dict_id'] = compressed
+    return rows
+
+
+def in_use(session):
+    """Whether compressed rows may exist"""
+    return Config.CONTENT_COMPRESSION or session.execute(
+        select(ContentDictionary.id).limit(1)).first() is not None
+
+
+def search_compressed(session, needle, limit, scan_limit=None):
+    """Ids of compressed messages containing `needle`, newest first
+
+    SQL cannot look inside compressed content, so this decompresses up to
+    `scan_limit` of the newest compressed messages.
+    """
+    needle = needle.casefold()
+    frame = bodies.STORED_COLUMNS[0]
+    result = session.execute(
+        bodies.join_bodies(
+            select(TelegramMessage.id, bodies.CONTENT, *bodies.STORED_COLUMNS))
+        .where(frame.isnot(None))
+        .order_by(TelegramMessage.timestamp.desc())
+        .limit(scan_limit or SEARCH_SCAN_LIMIT)
+        .execution_options(yield_per=1000))
+    ids = []
+    try:
+        for row_id, content in decode_rows(result, 1):
+            if needle in content.casefold():
+                ids.append(row_id)
+                if len(ids) >= limit:
+                    break
+    finally:
+        result.close()
+    return ids
+
+
+@event.listens_for(TelegramMessage, 'load')
+def _decode_on_load(target, context):
+    if target.content_zstd is not None:
+        # Committed value, so the instance is not marked dirty
+        set_committed_value(
+            target, 'content',
+            codec.decompress(target.content_zstd, target.content_dict_id))
+
+
+def _samples(conn, condition, limit):
+    rows = conn.execute(
+        bodies.join_bodies(select(bodies.CONTENT, *bodies.STORED_COLUMNS))
+        .where(condition).order_by(TelegramMessage.id.desc()).limit(limit))
+    return [codec.decode(*row).encode('utf-8') for row in rows
+            if row[0] or row[1] is not None]
+
+
+def train_dictionaries(conn, dict_size=None, samples=None, channel_min=None):
+    """Train a dictionary per dialog type and per busy channel
+
+    Returns the scopes that got a new dictionary.
+    """
+    _require_zstd()
+    dict_size = dict_size or Config.CONTENT_DICT_SIZE
+    samples = samples or Config.CONTENT_DICT_SAMPLES
+    channel_min = channel_min or Config.CONTENT_CHANNEL_DICT_MIN
+
+    scopes = []
+    for (dialog_type,) in conn.execute(
+            select(TelegramMessage.dialog_type).distinct().where(
+                TelegramMessage.dialog_type.isnot(None))):
+        scopes.append((f'{TYPE_SCOPE}{dialog_type}',
+                       TelegramMessage.dialog_type == dialog_type))
+    for (channel_id,) in conn.execute(
+            select(TelegramMessage.channel_id).group_by(
+                TelegramMessage.channel_id).having(
+                    func.count() >= channel_min)):
+        scopes.append((f'{CHANNEL_SCOPE}{channel_id}',
+                       TelegramMessage.channel_id == channel_id))
+
+    trained = []
+    for scope, condition in scopes:
+        texts = _samples(conn, condition, samples)
+        if len(texts) < MIN_TRAINING_SAMPLES:
+            logger.info(f"Skipping {scope}: only {len(texts)} samples")
+            continue
+        try:
+            data = zstd.train_dictionary(dict_size, texts).as_bytes()
+        except zstd.ZstdError as e:
+            logger.warning(f"Could not train a dictionary for {scope}: {e}")
+            continue
+        dict_id = conn.execute(
+            ContentDictionary.__table__.insert().values(
+                scope=scope, data=data, samples=len(texts)).returning(
+                    ContentDictionary.id)).scalar()
+        codec.add(dict_id, scope, data)
+        trained.append(scope)
+        logger.info(f"Trained {len(data)} byte dictionary {dict_id} for "
+                    f"{scope} from {len(texts)} messages")
+    return trained
+
+
+def _stored_size(content, frame):
+    if frame is not None:
+        return len(frame)
+    return len(content.encode('utf-8')) if content else 0
+
+
+# Tables holding content: key, the columns picking a dictionary, and the
+# column an edit changes (bodies are keyed by their text and never edited)
+_TARGETS = (
+    (TelegramMessage, 'id', 'channel_id', 'dialog_type', 'change_seq'),
+    (MessageBody, 'hash', 'first_channel_id', 'dialog_type', None),
+)
+
+
+def migrate(engine, chunk_size=DEFAULT_CHUNK_SIZE, decompress=False):
+    """(Re)compress every message and shared body with the newest dictionaries
+
+    Walks each table by primary key, one transaction per chunk, so it can
+    run next to the collector and be interrupted. Rows already stored with
+    the right dictionary are skipped, and so are rows edited since they were
+    read. With `decompress`, restores plain text. Returns counts and the
+    stored content size before and after.
+    """
+    with engine.connect() as conn:
+        codec.load(conn.execute(select(ContentDictionary.id,
+                                       ContentDictionary.scope,
+                                       ContentDictionary.data)))
+
+    report = {'rows': 0, 'updated': 0, 'skipped': 0,
+              'bytes_before': 0, 'bytes_after': 0}
+    for model, key, channel, dialog_type, version in _TARGETS:
+        key = getattr(model, key)
+        version = getattr(model, version) if version else None
+        stmt = update(model).where(key == bindparam('row_key'))
+        if version is not None:
+            # Leaves a row alone if an edit landed after it was read
+            stmt = stmt.where(version.is_not_distinct_from(
+                bindparam('row_version')))
+        stmt = stmt.values(content=bindparam('new_content'),
+                           content_zstd=bindparam('new_zstd'),
+                           content_dict_id=bindparam('new_dict_id'))
+        last_key = None
+        while True:
+            with engine.begin() as conn:
+                query = select(key, getattr(model, channel),
+                               getattr(model, dialog_type), model.content,
+                               model.content_zstd, model.content_dict_id,
+                               version if version is not None else null())
+                if last_key is not None:
+                    query = query.where(key > last_key)
+                rows = conn.execute(query.order_by(key).limit(chunk_size)).all()
+                if not rows:
+                    break
+                for (row_key, channel_id, dialog, content, frame, dict_id,
+                     row_version) in rows:
+                    text = codec.decode(content, frame, dict_id)
+                    before = _stored_size(content, frame)
+                    target = None if decompress or not text else \
+                        codec.compress(text, channel_id, dialog)
+                    if target is None:
+                        new = {'new_content': text, 'new_zstd': None,
+                               'new_dict_id': None}
+                    else:
+                        new = {'new_content': None, 'new_zstd': target[0],
+                               'new_dict_id': target[1]}
+                    if (new['new_zstd'] is None) == (frame is None) and \
+                            new['new_dict_id'] == dict_id:
+                        after = before
+                    elif conn.execute(stmt, dict(new, row_key=row_key,
+                                                 row_version=row_version)
+                                      ).rowcount:
+                        report['updated'] += 1
+                        after = _stored_size(new['new_content'],
+                                             new['new_zstd'])
+                    else:
+                        # The next run picks up the edited content
+                        report['skipped'] += 1
+                        continue
+                    report['bytes_before'] += before
+                    report['bytes_after'] += after
+                report['rows'] += len(rows)
+                last_key = rows[-1][0]
+            logger.info(f"Migrated {report['rows']} rows, "
+                        f"updated {report['updated']}, "
+                        f"skipped {report['skipped']} edited")
+
+    report['bytes_saved'] = report['bytes_before'] - report['bytes_after']
+    report['ratio'] = round(report['bytes_before'] / report['bytes_after'], 3) \
+        if report['bytes_after'] else None
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compress message content with zstd")
+    parser.add_argument('command', choices=['train', 'migrate'])
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--decompress', action='store_true',
+                        help="Store every message as plain text again")
+    args = parser.parse_args(argv)
+
+    from app import app, db
+
+    with app.app_context():
+        if args.command == 'train':
+            with db.engine.begin() as conn:
+                train_dictionaries(conn)
+        else:
+            report = migrate(db.engine, args.chunk_size, args.decompress)
+            print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
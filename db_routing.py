@@ -0,0 +1,146 @@
+"""Route read-only requests to replica databases.
+
+Every URL in DATABASE_REPLICA_URLS becomes a Flask-SQLAlchemy bind named
+`replica_<n>` with its own connection pool. Views decorated with
+`read_only` run their queries on a replica picked once per request; every
+other query, and any flush, uses the primary. A replica is skipped while its
+replication lag exceeds REPLICA_MAX_LAG or while it cannot be reached, and
+reads fall back to the primary when no replica qualifies.
+
+Lag is measured with pg_last_xact_replay_timestamp() on PostgreSQL and
+cached for REPLICA_LAG_CHECK_INTERVAL seconds. Other databases (such as two
+SQLite files used locally) report no lag.
+"""
+import logging
+import random
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+
+from config import Config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+REPLICA_PREFIX = 'replica_'
+
+# Zero when the replica has replayed everything it received, so an idle
+# primary does not look like replication lag
+PG_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery()
+             OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+
+def engine_options(url, pool_size, max_overflow):
+    """Engine options for a web pool; sizing only applies to PostgreSQL"""
+    options = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+    if url and url.startswith("postgres"):
+        options.update({
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "connect_args": {
+                "connect_timeout": 30,
+                "options": "-c statement_timeout=30000"
+            }
+        })
+    return options
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS entries for the replica URLs"""
+    return {
+        f"{REPLICA_PREFIX}{n}": {
+            "url": url,
+            **engine_options(url, Config.REPLICA_POOL_SIZE,
+                             Config.REPLICA_MAX_OVERFLOW)
+        }
+        for n, url in enumerate(urls)
+    }
+
+
+def measure_lag(engine):
+    """Replication lag of a replica in seconds"""
+    if engine.dialect.name != 'postgresql':
+        return 0.0
+    with engine.connect() as conn:
+        return float(conn.execute(PG_LAG_QUERY).scalar() or 0.0)
+
+
+class ReplicaRouter:
+    """Tracks replica lag and picks a replica for a request"""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._checked = {}  # bind key -> (checked at, usable)
+
+    def usable(self, key, engine):
+        now = self._clock()
+        with self._lock:
+            checked = self._checked.get(key)
+            if checked and now - checked[0] < Config.REPLICA_LAG_CHECK_INTERVAL:
+                return checked[1]
+        try:
+            lag = measure_lag(engine)
+            metrics.replica_lag.labels(replica=key).set(lag)
+            usable = lag <= Config.REPLICA_MAX_LAG
+            if not usable:
+                logger.warning("Replica %s is %.1f seconds behind, skipping it",
+                               key, lag)
+        except Exception as e:
+            logger.warning("Replica %s is unavailable: %s", key, e)
+            usable = False
+        with self._lock:
+            self._checked[key] = (now, usable)
+        return usable
+
+    def pick(self, engines):
+        """Bind key of a usable replica, or None to read from the primary"""
+        keys = [key for key in engines
+                if key and key.startswith(REPLICA_PREFIX)]
+        random.shuffle(keys)
+        for key in keys:
+            if self.usable(key, engines[key]):
+                return key
+        return None
+
+
+router = ReplicaRouter()
+
+
+def read_only(view):
+    """Run a view's queries on a replica when one is configured"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session sending read-only requests to a replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() \
+                and g.get('db_read_only'):
+            if 'db_replica' not in g:
+                g.db_replica = router.pick(self._db.engines)
+                metrics.routed_reads.labels(
+                    target='replica' if g.db_replica else 'primary').inc()
+            if g.db_replica is not None:
+                return self._db.engines[g.db_replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
@@ -0,0 +1,513 @@
+"""Bulk import of Telegram Desktop exports (result.json).
+
+Seeding the cache through the API is slow and rate limited. Telegram
+Desktop can export whole chats, or the whole account, as one JSON file of
+any size. `python desktop_import.py result.json` loads such a file:
+
+* the file is read in 1 MiB chunks and each message is decoded on its own,
+  so memory stays flat however large the export is;
+* messages are cut into chunks of one chat, and a process pool turns them
+  into rows: text with formatting as Telethon's markdown gives it, chat ids
+  and dialog types as the collector stores them, `is_ton_dev`, senders and
+  participant tallies;
+* a writer thread inserts each chunk in one transaction while the next ones
+  are read, skipping messages already stored, so imports merge with
+  collected messages and can be repeated.
+
+Progress is saved to `<export>.import-state.json` after every chunk; an
+interrupted import picks up after the last chunk stored. Long bodies are
+stored once as usual (bodies.py); run `python content_codec.py migrate`
+afterwards when CONTENT_COMPRESSION is set.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+import bodies
+import changes
+import participants
+import partitions
+import versions
+from config import Config
+from models import TelegramMessage
+from utils import should_be_ton_dev
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 5000
+READ_SIZE = 1 << 20
+STATE_SUFFIX = '.import-state.json'
+
+# Export chat types as get_proper_dialog_type names them
+DIALOG_TYPES = {
+    'personal_chat': 'private',
+    'saved_messages': 'private',
+    'bot_chat': 'bot',
+    'private_group': 'group',
+    'private_supergroup': 'private_supergroup',
+    'public_supergroup': 'public_supergroup',
+    'private_channel': 'channel',
+    'public_channel': 'channel',
+}
+
+# Keys whose objects and arrays are walked rather than decoded whole
+_WALKED = {'chats', 'left_chats', 'list'}
+
+# Text entities as Telethon's markdown writes them
+_DELIMITERS = {'bold': '**', 'italic': '__', 'strikethrough': '~~',
+               'code': '`', 'pre': '```'}
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class ExportReader:
+    """Streaming walk of an export, yielding events
+
+    ('self', user id) for the exporting account, ('chat', fields) when a
+    chat's messages start, with the fields seen before them, then
+    ('message', dict) for each of its messages. With `raw`, messages are
+    their JSON text instead, which is cheaper to hand to another process.
+    """
+
+    def __init__(self, f, read_size=READ_SIZE, raw=False):
+        self.f = f
+        self.read_size = read_size
+        self.raw = raw
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        data = self.f.read(self.read_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r} at {self._where()}")
+        self.pos += 1
+
+    def _where(self):
+        return repr(self.buf[self.pos:self.pos + 40])
+
+    def _value(self, raw=False):
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number may go on in the next read
+            if end == len(self.buf) and not self.eof and self._fill():
+                continue
+            if raw:
+                value = self.buf[self.pos:end]
+            self.pos = end
+            return value
+
+    def __iter__(self):
+        self._expect('{')
+        yield from self._object()
+        if self._peek():
+            raise ValueError(f"Trailing data at {self._where()}")
+
+    def _object(self):
+        fields = {}
+        while True:
+            char = self._peek()
+            if char == '}':
+                self.pos += 1
+                return
+            if char == ',':
+                self.pos += 1
+                continue
+            key = self._value()
+            self._expect(':')
+            char = self._peek()
+            if key == 'messages' and char == '[':
+                self.pos += 1
+                yield 'chat', fields
+                yield from self._array(walk=False)
+            elif key in _WALKED and char in '{[':
+                self.pos += 1
+                yield from self._object() if char == '{' else self._array()
+            else:
+                value = fields[key] = self._value()
+                if key == 'personal_information' and isinstance(value, dict):
+                    yield 'self', value.get('user_id')
+
+    def _array(self, walk=True):
+        while True:
+            char = self._peek()
+            if char == ']':
+                self.pos += 1
+                return
+            if char == ',':
+                self.pos += 1
+                continue
+            if not char:
+                raise ValueError("Unexpected end of export")
+            if walk and char == '{':
+                self.pos += 1
+                yield from self._object()
+            elif walk:
+                self._value()
+            else:
+                yield 'message', self._value(raw=self.raw)
+
+
+def chunks(events, chunk_size=DEFAULT_CHUNK_SIZE, skip=0):
+    """(chat, self id, messages) of at most `chunk_size` from one chat
+
+    The first `skip` messages are read past, for resuming.
+    """
+    chat, self_id, batch = None, None, []
+    for kind, value in events:
+        if kind == 'message':
+            if skip:
+                skip -= 1
+                continue
+            batch.append(value)
+            if len(batch) >= chunk_size:
+                yield chat, self_id, batch
+                batch = []
+            continue
+        if batch:
+            yield chat, self_id, batch
+            batch = []
+        if kind == 'chat':
+            chat = value
+        elif kind == 'self':
+            self_id = value
+    if batch:
+        yield chat, self_id, batch
+
+
+def peer_id(chat):
+    """Chat id as the collector stores it (Telethon's marked peer id)"""
+    bare = int(chat.get('id') or 0)
+    kind = chat.get('type')
+    if bare < 0 or kind in ('personal_chat', 'bot_chat', 'saved_messages'):
+        return str(bare)
+    if kind == 'private_group':
+        return str(-bare)
+    return f"-100{bare}"
+
+
+def sender(message):
+    """`senders` fields of a message's author, from its "from_id" """
+    from_id = message.get('from_id')
+    if not isinstance(from_id, str):
+        return None
+    for prefix, peer_type, mark in (('user', 'user', ''),
+                                    ('channel', 'channel', '-100'),
+                                    ('chat', 'chat', '-')):
+        if from_id.startswith(prefix) and from_id[len(prefix):].isdigit():
+            return {'id': mark + from_id[len(prefix):], 'peer_type': peer_type,
+                    'username': None, 'display_name': message.get('from'),
+                    'is_bot': None}
+    return None
+
+
+def text_of(text):
+    """Message text, with entities written as Telethon's markdown"""
+    if isinstance(text, str):
+        return text
+    parts = []
+    for part in text or ():
+        if isinstance(part, str):
+            parts.append(part)
+            continue
+        value, kind = part.get('text', ''), part.get('type')
+        if kind in _DELIMITERS:
+            parts.append(_DELIMITERS[kind] + value + _DELIMITERS[kind])
+        elif kind == 'text_link':
+            parts.append(f"[{value}]({part.get('href', '')})")
+        elif kind == 'mention_name':
+            parts.append(f"[{value}](tg://user?id={part.get('user_id')})")
+        else:
+            parts.append(value)
+    return ''.join(parts)
+
+
+def _date(message, unix_key, key):
+    if message.get(unix_key):
+        return datetime.fromtimestamp(int(message[unix_key]),
+                                      timezone.utc).replace(tzinfo=None)
+    if message.get(key):
+        # Older exports only have the exporting machine's local time
+        return datetime.fromisoformat(message[key])
+    return None
+
+
+def normalize(chat, messages, self_id=None):
+    """Rows and senders for messages of one chat; runs in the pool
+
+    Service messages and messages without text are left out, as the
+    collector leaves them out.
+    """
+    channel_id = peer_id(chat)
+    title = chat.get('name') or ('Saved Messages'
+                                 if chat.get('type') == 'saved_messages'
+                                 else channel_id)
+    dialog_type = DIALOG_TYPES.get(chat.get('type'), 'unknown')
+    is_ton_dev = should_be_ton_dev(title)
+    outgoing = f"user{self_id}" if self_id is not None else None
+    rows, senders = [], {}
+    for message in messages:
+        if message.get('type') != 'message':
+            continue
+        content = text_of(message.get('text'))
+        if not content:
+            continue
+        author = sender(message)
+        if author is not None:
+            senders[author['id']] = author
+        rows.append({
+            'message_id': message['id'],
+            'channel_id': channel_id,
+            'channel_title': title,
+            'content': content,
+            'timestamp': _date(message, 'date_unixtime', 'date'),
+            'is_ton_dev': is_ton_dev,
+            'is_outgoing': outgoing is not None and
+            message.get('from_id') == outgoing,
+            'dialog_type': dialog_type,
+            'fwd_from_id': None,
+            'fwd_from_message_id': None,
+            'fwd_date': None,
+            'sender_id': author['id'] if author else None,
+            'edit_date': _date(message, 'edited_unixtime', 'edited'),
+        })
+    return rows, senders
+
+
+def prepare(chat, messages, self_id=None):
+    """`normalize` of messages or their JSON, plus the tally of the rows"""
+    messages = [json.loads(message) if isinstance(message, str) else message
+                for message in messages]
+    rows, senders = normalize(chat, messages, self_id)
+    return rows, senders, participants.tally(rows)
+
+
+# Changefeed number and shared body of rows just inserted, by row id
+_NUMBER = update(TelegramMessage).where(
+    TelegramMessage.id == bindparam('row_id')).values(
+        content=bindparam('content'), body_hash=bindparam('body_hash'),
+        change_seq=bindparam('change_seq'))
+
+
+def insert_statement(dialect_name):
+    """Insert of message rows that skips messages already stored"""
+    dialect = postgresql if dialect_name == 'postgresql' else sqlite
+    return dialect.insert(TelegramMessage).on_conflict_do_nothing().returning(
+        TelegramMessage.id, TelegramMessage.channel_id,
+        TelegramMessage.message_id)
+
+
+def store_rows(conn, rows, senders=None, now=None, deltas=None):
+    """Insert rows of messages not stored yet; returns how many
+
+    The unique index on (channel_id, message_id) decides which rows are new.
+    Only those are numbered for the changefeed, shared as bodies and counted
+    for senders and participants. The `#changes` row is locked before the
+    insert, in the order the collector takes the two. `deltas` is the
+    participants.tally of `rows`, if already known.
+    """
+    if not rows:
+        return 0
+    dialect = conn.dialect.name
+    now = now or datetime.utcnow()
+    conn.execute(changes.allocate_statement(dialect, 0, now))
+    by_key = {}
+    for row in rows:
+        by_key.setdefault((row['channel_id'], row['message_id']), row)
+    inserted = []
+    for row_id, channel_id, message_id in conn.execute(
+            insert_statement(dialect), rows):
+        row = by_key[(channel_id, message_id)]
+        row['row_id'] = row_id
+        inserted.append(row)
+    if len(inserted) < len(rows):
+        deltas = None
+    if not inserted:
+        return 0
+    rows = inserted
+    changes.number(rows, conn.execute(changes.allocate_statement(
+        dialect, len(rows), now)).scalar_one())
+    if Config.CONTENT_DEDUP:
+        bodies.share_rows(conn, rows, now)
+    else:
+        for row in rows:
+            row['body_hash'] = None
+    conn.execute(_NUMBER, rows)
+    sender_rows = participants.sender_rows(rows, senders)
+    if sender_rows:
+        conn.execute(participants.sender_upsert(dialect), sender_rows)
+        deltas = deltas or participants.tally(rows)
+        sketches = {(row.scope, row.granularity, row.bucket_start): row
+                    for row in conn.execute(participants.lookup_query(deltas))}
+        conn.execute(participants.sketch_upsert(dialect),
+                     participants.apply(sketches, deltas, now))
+    conn.execute(versions.bump_statement(dialect),
+                 versions.bump_rows(rows, now))
+    return len(rows)
+
+
+def _identity(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def load_state(state_path, identity):
+    """Saved progress for this export, or None to start over"""
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    if state.get('export') != identity:
+        logger.warning("Ignoring %s, it belongs to another export", state_path)
+        return None
+    return state
+
+
+def save_state(state_path, state):
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def import_export(engine, path, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                  state_path=None, restart=False):
+    """Import a result.json export, resuming a previous run
+
+    `workers` normalizing processes default to one per CPU but the one
+    reading; 0 normalizes in this process. Returns counts of messages read,
+    rows offered, rows inserted, and the rows per second.
+
+    Raises RuntimeError before reading anything if the unique message index
+    is missing, since messages already stored would be inserted again.
+    """
+    with engine.connect() as conn:
+        if not partitions.has_unique_index(conn):
+            raise RuntimeError(
+                f"{partitions.UNIQUE_INDEX} is missing, so stored messages "
+                "would be imported twice; remove duplicate messages and run "
+                "`python manage.py init-db` first")
+    if workers is None:
+        workers = (os.cpu_count() or 1) - 1
+    state_path = state_path or path + STATE_SUFFIX
+    identity = _identity(path)
+    state = None if restart else load_state(state_path, identity)
+    state = state or {'export': identity, 'messages': 0, 'rows': 0,
+                      'inserted': 0}
+    if state['messages']:
+        logger.info("Resuming after %d messages", state['messages'])
+    report = {'messages': 0, 'rows': 0, 'inserted': 0}
+    started = time.perf_counter()
+
+    failed = []
+
+    def stored(result, consumed):
+        if failed:
+            # Never store past a chunk that failed, or resuming would skip it
+            return
+        try:
+            rows, senders, deltas = result.result() if pool else result
+            with engine.begin() as conn:
+                inserted = store_rows(conn, rows, senders, deltas=deltas)
+        except BaseException:
+            failed.append(True)
+            raise
+        for counts in (report, state):
+            counts['messages'] += consumed
+            counts['rows'] += len(rows)
+            counts['inserted'] += inserted
+        save_state(state_path, state)
+        elapsed = time.perf_counter() - started
+        logger.info("Imported %d rows (%d new) from %d messages, %.0f rows/s",
+                    report['rows'], report['inserted'], report['messages'],
+                    report['rows'] / elapsed if elapsed else 0.0)
+
+    pool = ProcessPoolExecutor(workers) if workers else None
+    # One thread stores chunks in file order, keeping the state a count
+    writer = ThreadPoolExecutor(1)
+    writes = deque()
+    try:
+        with open(path, encoding='utf-8') as f:
+            for chat, self_id, messages in chunks(
+                    ExportReader(f, raw=pool is not None), chunk_size,
+                    state['messages']):
+                if pool is None:
+                    result = prepare(chat, messages, self_id)
+                else:
+                    result = pool.submit(prepare, chat, messages, self_id)
+                writes.append(writer.submit(stored, result, len(messages)))
+                if len(writes) > 2 * max(workers, 1):
+                    writes.popleft().result()
+            while writes:
+                writes.popleft().result()
+    finally:
+        writer.shutdown(cancel_futures=True)
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - started
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['rows'] / elapsed, 1) \
+        if elapsed else 0.0
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import a Telegram Desktop JSON export")
+    parser.add_argument('export', help="Path of result.json")
+    parser.add_argument('--workers', type=int,
+                        help="Normalizing processes, 0 for none; "
+                        "defaults to the CPU count less one")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--state', help="Progress file, defaults to "
+                        f"<export>{STATE_SUFFIX}")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore saved progress")
+    args = parser.parse_args(argv)
+
+    from app import app, db
+
+    with app.app_context():
+        try:
+            report = import_export(db.engine, args.export, args.workers,
+                                   args.chunk_size, args.state, args.restart)
+        except RuntimeError as e:
+            parser.exit(1, f"{e}\n")
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Persistent cache of Telegram peers and the dialog list.
+
+The collector used to call `get_dialogs` on every cycle just to learn which
+dialogs exist and how to address them. The cache keeps id, access hash,
+username, title and type of every user, chat and channel we have seen in
+the `telegram_entities` table, so after a restart the dialog list is
+available from the database and peers are addressed with locally built
+InputPeers. `get_dialogs` is then only needed occasionally to reconcile the
+list (new dialogs, archiving, renames), and entity changes seen in incoming
+updates are folded in between reconciliations.
+
+Records are read and written through the collector's async store
+(async_db.py).
+"""
+import logging
+
+from utils import get_proper_dialog_type
+
+logger = logging.getLogger(__name__)
+
+
+class CachedEntity:
+    """Stand-in for a Telethon entity carrying only what scopes look at"""
+
+    def __init__(self, username=None):
+        self.username = username
+
+
+class CachedDialog:
+    """Dialog rebuilt from the cache, quacking like telethon's Dialog"""
+
+    def __init__(self, record):
+        self.id = record['id']
+        self.title = record['title'] or str(record['id'])
+        self.name = self.title
+        self.archived = bool(record['archived'])
+        self.dialog_type = record['dialog_type'] or 'unknown'
+        self.entity = CachedEntity(record['username'])
+        self.input_entity = make_input_peer(record)
+        self.message = None
+
+
+def make_input_peer(record):
+    """Build an InputPeer from a cached record without a network call"""
+    from telethon import utils as tl_utils
+    from telethon.tl.types import (InputPeerUser, InputPeerChat,
+                                   InputPeerChannel)
+
+    real_id, _ = tl_utils.resolve_id(record['id'])
+    if record['peer_type'] == 'user':
+        return InputPeerUser(real_id, record['access_hash'] or 0)
+    if record['peer_type'] == 'chat':
+        return InputPeerChat(real_id)
+    return InputPeerChannel(real_id, record['access_hash'] or 0)
+
+
+def entity_to_record(entity):
+    """Extract the cached fields from a Telethon User, Chat or Channel"""
+    from telethon import utils as tl_utils
+    from telethon.tl.types import User, Chat, ChatForbidden, Channel, ChannelForbidden
+
+    if isinstance(entity, User):
+        peer_type = 'user'
+    elif isinstance(entity, (Chat, ChatForbidden)):
+        peer_type = 'chat'
+    elif isinstance(entity, (Channel, ChannelForbidden)):
+        peer_type = 'channel'
+    else:
+        return None
+
+    return {
+        'id': tl_utils.get_peer_id(entity),
+        'access_hash': getattr(entity, 'access_hash', None),
+        'peer_type': peer_type,
+        'dialog_type': get_proper_dialog_type(entity),
+        'username': getattr(entity, 'username', None),
+        'title': tl_utils.get_display_name(entity) or None,
+    }
+
+
+class EntityCache:
+    """In-memory view of `telegram_entities` with write-behind persistence"""
+
+    def __init__(self, store):
+        self.store = store
+        self.records = {}
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, peer_id):
+        return self.records.get(peer_id)
+
+    async def load(self):
+        """Warm the cache from the database"""
+        for record in await self.store.load_entities():
+            self.records[record['id']] = record
+        logger.info("Loaded %d cached entities", len(self.records))
+        return len(self.records)
+
+    def add_entities(self, entities):
+        """Fold Telethon entities into the cache, marking changed records"""
+        for entity in entities:
+            record = entity_to_record(entity)
+            if record is None:
+                continue
+            current = self.records.get(record['id'])
+            if current is None:
+                record['is_dialog'] = False
+                record['archived'] = False
+                self.records[record['id']] = record
+                self._dirty.add(record['id'])
+                continue
+            # Min constructors carry no access hash, keep the one we have
+            if record['access_hash'] is None:
+                record['access_hash'] = current['access_hash']
+            if any(current.get(key) != value for key, value in record.items()):
+                current.update(record)
+                self._dirty.add(record['id'])
+
+    def sync_dialogs(self, dialogs):
+        """Reconcile the cached dialog list with a fresh `get_dialogs` result"""
+        self.add_entities(dialog.entity for dialog in dialogs)
+
+        seen = set()
+        for dialog in dialogs:
+            record = self.records.get(dialog.id)
+            if record is None:
+                continue
+            seen.add(dialog.id)
+            archived = bool(getattr(dialog, 'archived', False))
+            if not record['is_dialog'] or record['archived'] != archived:
+                record['is_dialog'] = True
+                record['archived'] = archived
+                self._dirty.add(dialog.id)
+
+        for peer_id, record in self.records.items():
+            if record['is_dialog'] and peer_id not in seen:
+                record['is_dialog'] = False
+                self._dirty.add(peer_id)
+
+    def dialogs(self):
+        """Cached dialogs, ready to be scheduled and polled"""
+        return [
+            CachedDialog(record) for record in self.records.values()
+            if record['is_dialog']
+        ]
+
+    def handle_update(self, update):
+        """Telethon raw update handler collecting users and chats it carries
+
+        Telethon strips users/chats off the update container and hands raw
+        handlers the inner update with its entities in ``_entities``.
+        """
+        entities = getattr(update, '_entities', None) or {}
+        if entities:
+            self.add_entities(list(entities.values()))
+
+    async def flush(self):
+        """Persist changed records in one transaction"""
+        if not self._dirty:
+            return 0
+
+        dirty, self._dirty = self._dirty, set()
+        try:
+            await self.store.save_entities(self.records[peer_id]
+                                           for peer_id in dirty)
+        except Exception as e:
+            logger.error("Error saving entity cache: %s", e)
+            self._dirty |= dirty
+            return 0
+        logger.debug("Saved %d cached entities", len(dirty))
+        return len(dirty)
@@ -0,0 +1,257 @@
+"""Streaming bulk export of the message cache.
+
+Rows are read with a server-side cursor (`yield_per`) and written out batch by
+batch as JSON Lines, CSV or Parquet, so memory use depends on the batch size
+and not on the number of exported rows. Parquet output needs the optional
+`pyarrow` dependency and writes one row group per batch.
+
+Usage:
+    python export.py --format jsonl --since 2025-03-01 --output messages.jsonl
+    python export.py --format parquet --channel "TON Dev Chat" -o ton.parquet
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import sys
+from datetime import datetime
+
+from sqlalchemy import select
+
+import bodies
+import content_codec
+from models import TelegramMessage
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+EXPORT_COLUMNS = [
+    'id', 'message_id', 'channel_id', 'channel_title', 'content', 'timestamp',
+    'is_ton_dev', 'is_outgoing', 'dialog_type'
+]
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+class ExportUnavailable(RuntimeError):
+    """The format needs an optional dependency that is not installed"""
+
+
+def parse_bool(value):
+    """Parse an optional boolean filter from a query string or CLI flag"""
+    if value is None or value == '':
+        return None
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_datetime(value):
+    """Parse an optional ISO-8601 date or datetime"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
+
+
+def build_export_query(channel=None, channel_id=None, since=None, until=None,
+                       is_ton_dev=None, is_outgoing=None, dialog_type=None):
+    """Select the exported columns with the requested filters applied
+
+    Content may live in message_bodies, and the compressed content columns
+    follow the exported ones, see content_codec.decode_rows.
+    """
+    query = bodies.join_bodies(
+        select(*[bodies.CONTENT.label(c) if c == 'content' else
+                 getattr(TelegramMessage, c) for c in EXPORT_COLUMNS],
+               *bodies.STORED_COLUMNS))
+    if channel:
+        query = query.where(TelegramMessage.channel_title == channel)
+    if channel_id:
+        query = query.where(TelegramMessage.channel_id == str(channel_id))
+    if since:
+        query = query.where(TelegramMessage.timestamp >= since)
+    if until:
+        query = query.where(TelegramMessage.timestamp < until)
+    if is_ton_dev is not None:
+        query = query.where(TelegramMessage.is_ton_dev == is_ton_dev)
+    if is_outgoing is not None:
+        query = query.where(TelegramMessage.is_outgoing == is_outgoing)
+    if dialog_type:
+        query = query.where(TelegramMessage.dialog_type == dialog_type)
+    # Ordering by primary key keeps the scan index-backed and resumable
+    return query.order_by(TelegramMessage.id)
+
+
+def iter_batches(session, query, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield lists of rows fetched through a server-side cursor"""
+    result = session.execute(query.execution_options(yield_per=batch_size))
+    try:
+        for partition in result.partitions():
+            yield partition
+    finally:
+        result.close()
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def jsonl_chunks(batches):
+    for batch in batches:
+        yield ''.join(
+            json.dumps({c: _json_value(v) for c, v in zip(EXPORT_COLUMNS, row)},
+                       ensure_ascii=False) + '\n' for row in batch).encode('utf-8')
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batches:
+        writer.writerows(
+            [_json_value(v) for v in row] for row in batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def _parquet_schema(pa):
+    return pa.schema([
+        ('id', pa.int64()),
+        ('message_id', pa.int64()),
+        ('channel_id', pa.string()),
+        ('channel_title', pa.string()),
+        ('content', pa.string()),
+        ('timestamp', pa.timestamp('us')),
+        ('is_ton_dev', pa.bool_()),
+        ('is_outgoing', pa.bool_()),
+        ('dialog_type', pa.string()),
+    ])
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportUnavailable(
+            "Parquet export requires pyarrow to be installed")
+    return pa, pq
+
+
+def parquet_chunks(batches):
+    pa, pq = _pyarrow()
+    schema = _parquet_schema(pa)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for batch in batches:
+            columns = list(zip(*batch))
+            table = pa.Table.from_arrays(
+                [pa.array(col, type=field.type)
+                 for col, field in zip(columns, schema)],
+                schema=schema)
+            writer.write_table(table)  # one row group per batch
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+_WRITERS = {
+    'jsonl': jsonl_chunks,
+    'csv': csv_chunks,
+    'parquet': parquet_chunks,
+}
+
+
+def export_chunks(session, fmt, batch_size=DEFAULT_BATCH_SIZE, **filters):
+    """Stream an export as chunks of bytes in the requested format
+
+    Raises ExportUnavailable right away when the format's optional
+    dependency is missing.
+    """
+    if fmt not in _WRITERS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    if fmt == 'parquet':
+        # Fail here, not once the response has started streaming
+        _pyarrow()
+    query = build_export_query(**filters)
+    content = EXPORT_COLUMNS.index('content')
+    batches = (content_codec.decode_rows(batch, content)
+               for batch in iter_batches(session, query, batch_size))
+    return _WRITERS[fmt](batches)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export cached Telegram messages")
+    parser.add_argument('--format', choices=sorted(_WRITERS), default='jsonl')
+    parser.add_argument('-o', '--output', help="Output file, defaults to stdout")
+    parser.add_argument('--channel', help="Channel title")
+    parser.add_argument('--channel-id')
+    parser.add_argument('--since', type=parse_datetime)
+    parser.add_argument('--until', type=parse_datetime)
+    parser.add_argument('--ton-dev', type=parse_bool, dest='is_ton_dev')
+    parser.add_argument('--outgoing', type=parse_bool, dest='is_outgoing')
+    parser.add_argument('--dialog-type')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from app import app, db
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    written = 0
+    try:
+        with app.app_context():
+            for chunk in export_chunks(db.session,
+                                       args.format,
+                                       batch_size=args.batch_size,
+                                       channel=args.channel,
+                                       channel_id=args.channel_id,
+                                       since=args.since,
+                                       until=args.until,
+                                       is_ton_dev=args.is_ton_dev,
+                                       is_outgoing=args.is_outgoing,
+                                       dialog_type=args.dialog_type):
+                out.write(chunk)
+                written += len(chunk)
+    finally:
+        if args.output:
+            out.close()
+    logger.info(f"Exported {written} bytes as {args.format}")
+
+
+if __name__ == "__main__":
+    main()
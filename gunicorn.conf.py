@@ -0,0 +1,60 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Workers share metrics through files in this directory, see metrics.py.
+# Set here so it is inherited by every worker before it imports the app.
+multiproc_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), 'tgcache-prometheus'))
+
+
+manage_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manage.py')
+
+# Set RUN_COLLECTOR=0 when the collector is deployed as its own service
+run_collector = os.environ.get('RUN_COLLECTOR', '1') != '0'
+collector_process = None
+
+
+def on_starting(server):
+    """Start every server run with an empty metrics directory
+
+    Tables are created here, once, instead of in every worker; a separate
+    process keeps the master from importing the app before forking.
+    """
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+    subprocess.run([sys.executable, manage_py, 'init-db'], check=True)
+
+
+def when_ready(server):
+    """Run the collector next to the workers, in its own process"""
+    global collector_process
+    if run_collector:
+        collector_process = subprocess.Popen(
+            [sys.executable, manage_py, 'collector'])
+        server.log.info("Started collector process %s", collector_process.pid)
+
+
+def on_exit(server):
+    if collector_process and collector_process.poll() is None:
+        collector_process.terminate()
+        try:
+            collector_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            collector_process.kill()
+
+
+def child_exit(server, worker):
+    """Drop live gauges of workers that went away"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+# Threaded workers: a request waiting on Telegram (see telegram_gateway.py)
+# or the database holds a thread, not a whole worker process. The async
+# setup views run in that thread too, on a loop of their own.
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
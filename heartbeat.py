@@ -0,0 +1,203 @@
+"""Collector heartbeat and ingest lag, shared through the database.
+
+The collector records when each cycle starts and finishes and when it last
+committed messages. Per dialog it tracks the newest message Telegram has
+shown us, from polls and from new-message updates arriving between polls,
+against the stored high-water mark: the newest message the collector has
+durably processed. Ingest lag is how long the oldest message above that
+mark has been waiting.
+
+Rows live in `collector_heartbeats` and `collector_dialog_lag`, written by
+the collector through its async store and read by any web worker, which can
+report collector health without touching the collector thread.
+A loop stuck in a backoff or a hung await stops refreshing the heartbeat,
+which `collector_health` reports once COLLECTOR_STALE_AFTER seconds pass.
+"""
+import logging
+import os
+import socket
+from datetime import datetime, timezone
+
+from app import db
+from config import Config
+from models import CollectorHeartbeat, DialogLag
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_ID = 'collector'
+
+# Dialogs listed in health responses, most lagging first
+LAGGING_DIALOGS_SHOWN = 10
+
+
+def utc_naive(value):
+    """Telethon dates are aware; stored columns are naive UTC"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class Heartbeat:
+    """Collector-side writer of the heartbeat and dialog lag rows"""
+
+    def __init__(self, store, heartbeat_id=HEARTBEAT_ID):
+        self.store = store
+        self.heartbeat_id = heartbeat_id
+        self.state = {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'cycle': 0,
+            'cycle_started_at': None,
+            'cycle_finished_at': None,
+            'last_commit_at': None,
+            'last_error': None,
+        }
+        self.dialogs = {}
+        self._dirty = set()
+
+    async def cycle_started(self, cycle):
+        self.state['cycle'] = cycle
+        self.state['cycle_started_at'] = datetime.utcnow()
+        await self.flush()
+
+    async def cycle_finished(self, error=None):
+        self.state['cycle_finished_at'] = datetime.utcnow()
+        self.state['last_error'] = error
+        if error is None:
+            metrics.last_cycle_finished.set_to_current_time()
+        await self.flush()
+
+    def committed(self):
+        self.state['last_commit_at'] = datetime.utcnow()
+
+    def _dialog(self, channel_id, title=None):
+        row = self.dialogs.get(channel_id)
+        if row is None:
+            row = self.dialogs[channel_id] = {
+                'channel_id': channel_id,
+                'channel_title': title,
+                'top_message_id': None,
+                'top_message_at': None,
+                'stored_message_id': None,
+                'stored_message_at': None,
+                'pending_since': None,
+            }
+        if title:
+            row['channel_title'] = title
+        row['checked_at'] = datetime.utcnow()
+        self._dirty.add(channel_id)
+        return row
+
+    def seen(self, channel_id, message_id, date, title=None):
+        """Telegram has a message up to `message_id` in this dialog"""
+        row = self._dialog(channel_id, title)
+        date = utc_naive(date)
+        if message_id > (row['top_message_id'] or 0):
+            row['top_message_id'] = message_id
+            row['top_message_at'] = date
+        if message_id > (row['stored_message_id'] or 0) and date and (
+                row['pending_since'] is None or date < row['pending_since']):
+            row['pending_since'] = date
+
+    def stored(self, channel_id, message_id, date, title=None):
+        """Everything up to `message_id` in this dialog is processed"""
+        row = self._dialog(channel_id, title)
+        if message_id is None or message_id < (row['stored_message_id'] or 0):
+            return
+        row['stored_message_id'] = message_id
+        row['stored_message_at'] = utc_naive(date)
+        if message_id >= (row['top_message_id'] or 0):
+            row['pending_since'] = None
+
+    def handle_update(self, update):
+        """Telethon raw update handler noting new messages between polls"""
+        message = getattr(update, 'message', None)
+        peer = getattr(message, 'peer_id', None)
+        if peer is None or not isinstance(getattr(message, 'id', None), int):
+            return
+        from telethon import utils as tl_utils
+        self.seen(str(tl_utils.get_peer_id(peer)), message.id,
+                  getattr(message, 'date', None))
+
+    async def flush(self):
+        """Write the heartbeat and changed dialog rows in one transaction"""
+        dirty, self._dirty = self._dirty, set()
+        try:
+            await self.store.save_heartbeat(
+                self.heartbeat_id, self.state,
+                [self.dialogs[channel_id] for channel_id in dirty])
+        except Exception as e:
+            logger.error("Error saving collector heartbeat: %s", e)
+            self._dirty |= dirty
+            return False
+
+        now = datetime.utcnow()
+        metrics.ingest_lag.set(
+            max(((now - row['pending_since']).total_seconds()
+                 for row in self.dialogs.values()
+                 if row['pending_since'] is not None),
+                default=0.0))
+        return True
+
+
+def _age(value, now):
+    return round((now - value).total_seconds(), 1) if value else None
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def collector_health(now=None):
+    """Collector liveness and ingest lag as a JSON-ready dict
+
+    `status` is "ok", "stuck" (a cycle started but has not finished in
+    time), "stale" (no cycle started in time) or "missing" (no heartbeat).
+    """
+    now = now or datetime.utcnow()
+    stale_after = Config.COLLECTOR_STALE_AFTER
+    beat = db.session.get(CollectorHeartbeat, HEARTBEAT_ID)
+    if beat is None:
+        return {'status': 'missing', 'stale_after': stale_after}
+
+    started_age = _age(beat.cycle_started_at, now)
+    in_cycle = beat.cycle_started_at is not None and (
+        beat.cycle_finished_at is None or
+        beat.cycle_finished_at < beat.cycle_started_at)
+    if started_age is not None and started_age > stale_after:
+        status = 'stuck' if in_cycle else 'stale'
+    elif started_age is None:
+        status = 'stale'
+    else:
+        status = 'ok'
+
+    lagging = sorted(DialogLag.query.all(),
+                     key=lambda row: (row.lag_seconds(now), row.lag_messages),
+                     reverse=True)
+    return {
+        'status': status,
+        'stale_after': stale_after,
+        'host': beat.host,
+        'pid': beat.pid,
+        'cycle': beat.cycle,
+        'cycle_started_at': _iso(beat.cycle_started_at),
+        'cycle_finished_at': _iso(beat.cycle_finished_at),
+        'last_commit_at': _iso(beat.last_commit_at),
+        'seconds_since_cycle_start': started_age,
+        'seconds_since_cycle_end': _age(beat.cycle_finished_at, now),
+        'seconds_since_commit': _age(beat.last_commit_at, now),
+        'last_error': beat.last_error,
+        'dialogs': len(lagging),
+        'max_lag_seconds': lagging[0].lag_seconds(now) if lagging else 0.0,
+        'max_lag_messages': max((row.lag_messages for row in lagging), default=0),
+        'lagging': [{
+            'channel_id': row.channel_id,
+            'channel_title': row.channel_title,
+            'top_message_id': row.top_message_id,
+            'stored_message_id': row.stored_message_id,
+            'lag_messages': row.lag_messages,
+            'lag_seconds': row.lag_seconds(now),
+            'checked_at': _iso(row.checked_at),
+        } for row in lagging[:LAGGING_DIALOGS_SHOWN] if row.lag_messages],
+    }
@@ -0,0 +1,129 @@
+"""Logging configuration for the web app and the collector.
+
+`configure_logging` routes every record through a QueueHandler, so callers
+(including the collector's event loop) only enqueue records; a
+QueueListener thread formats them and does the I/O. LOG_LEVEL sets the root
+level and LOG_FORMAT=json switches to one JSON object per line, which
+includes any `extra=` fields passed with the record.
+
+`LogSampler` lets repetitive events through once per interval per key and
+counts what it suppressed in between.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+
+from config import Config
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'taskName'
+}
+
+_listener = None
+
+
+class StderrHandler(logging.StreamHandler):
+    """Stream handler writing to whatever `sys.stderr` is when emitting"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with `extra=` fields at the top level"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created,
+                                         timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def make_formatter(fmt=None):
+    if (fmt or Config.LOG_FORMAT) == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+
+def configure_logging(level=None, fmt=None):
+    """Send root logging through a background queue listener
+
+    Safe to call more than once; later calls only update level and format.
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level or Config.LOG_LEVEL)
+
+    if _listener is not None:
+        for handler in _listener.handlers:
+            handler.setFormatter(make_formatter(fmt))
+        return root
+
+    stream = StderrHandler()
+    stream.setFormatter(make_formatter(fmt))
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, stream,
+                                               respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    # Telethon logs every request at DEBUG
+    logging.getLogger('telethon').setLevel(
+        max(root.level, logging.INFO))
+    return root
+
+
+class LogSampler:
+    """Let an event through once per `interval` seconds per key"""
+
+    def __init__(self, interval=60.0, clock=time.monotonic):
+        self.interval = interval
+        self._clock = clock
+        self._last = {}
+        self._suppressed = {}
+
+    def allow(self, key):
+        """Return the number of suppressed events to report, or None to skip"""
+        now = self._clock()
+        last = self._last.get(key)
+        if last is not None and now - last < self.interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return None
+        self._last[key] = now
+        return self._suppressed.pop(key, 0)
+
+    def log(self, logger, level, key, msg, *args, **kwargs):
+        """Log `msg` unless an event with the same key was just logged"""
+        if not logger.isEnabledFor(level):
+            return
+        suppressed = self.allow(key)
+        if suppressed is None:
+            return
+        if suppressed:
+            msg += ' (%d similar suppressed)'
+            args += (suppressed,)
+        logger.log(level, msg, *args, **kwargs)
@@ -1,17 +1,31 @@
 from flask import render_template, jsonify, request
+from sqlalchemy.orm import selectinload
 from app import app, db, logger
-from collector import ensure_single_collector, setup_telegram_session
-from telethon import TelegramClient
-from models import TelegramMessage
+from models import TelegramMessage, HOT_WINDOW_DAYS
+from api.routes import api as api_blueprint
+from heartbeat import collector_health
+from db_routing import read_only
+from versions import conditional
+import participants
+import trending
+from telegram_gateway import SetupError, gateway
 from datetime import datetime, timedelta
 import atexit
 import os
 import json
-import asyncio
 import sys
 
+app.register_blueprint(api_blueprint, url_prefix='/api')
+
+
+def _dashboard_salt():
+    # The page shows rolling 3 and 7 day windows and the session state
+    return session_file_valid(), datetime.utcnow().strftime('%Y%m%d%H')
+
 
 @app.route('/')
+@read_only
+@conditional(salt=_dashboard_salt)
 def index():
     # Check if session is valid - use Replit's persistent storage path
     session_path = os.path.join(os.environ.get('REPL_HOME', ''),
@@ -28,6 +42,10 @@ def index():
     last_7_days_count = 0
     channel_activity = []
     last_7_days_activity = []
+    trending_hashtags = []
+    trending_terms = []
+    participants_overall = {}
+    participants_7_days = {}
 
     try:
         # Get total message count
@@ -38,14 +56,12 @@ def index():
             is_ton_dev=True).count()
 
         # Get last 3 days statistics
-        three_days_ago = datetime.utcnow() - timedelta(days=3)
         last_3_days_count = db.session.query(TelegramMessage).filter(
-            TelegramMessage.timestamp >= three_days_ago).count()
+            TelegramMessage.in_last_days(3)).count()
 
         # Get last 7 days statistics
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
         last_7_days_count = db.session.query(TelegramMessage).filter(
-            TelegramMessage.timestamp >= seven_days_ago).count()
+            TelegramMessage.in_last_days(7)).count()
 
         # Get message leaderboard by incoming and outgoing messages (overall)
         channel_activity = db.session.query(
@@ -66,22 +82,45 @@ def index():
             db.func.count(TelegramMessage.id).filter(
                 TelegramMessage.is_outgoing == True).label('outgoing'),
             db.func.count(TelegramMessage.id).label('total')).filter(
-                TelegramMessage.timestamp >= seven_days_ago).group_by(
+                TelegramMessage.in_last_days(7)).group_by(
                     TelegramMessage.channel_title).order_by(
                         db.desc('total')).limit(10).all()
 
-        # Get channel statistics
+        # Get channel statistics; max() over a CASE instead of bool_or,
+        # which SQLite lacks
         channels = db.session.query(
             TelegramMessage.channel_title,
             db.func.count(TelegramMessage.id).label('count'),
-            db.func.bool_or(
-                TelegramMessage.is_ton_dev).label('is_ton_dev')).group_by(
-                    TelegramMessage.channel_title).order_by(
-                        db.desc('count')).all()
-
-        # Get the 100 most recent messages
-        messages = db.session.query(TelegramMessage).order_by(
-            TelegramMessage.timestamp.desc()).limit(100).all()
+            db.func.max(
+                db.case((TelegramMessage.is_ton_dev == True, 1),
+                        else_=0)).label('is_ton_dev')).group_by(
+                            TelegramMessage.channel_title).order_by(
+                                db.desc('count')).all()
+
+        # Unique senders of the leaderboard channels, from HyperLogLog
+        # sketches instead of COUNT(DISTINCT) scans
+        participants_overall = participants.unique_senders_by_title(
+            db.session, [channel.channel_title for channel in channel_activity])
+        participants_7_days = participants.unique_senders_by_title(
+            db.session,
+            [channel.channel_title for channel in last_7_days_activity], days=7)
+
+        # What the last day was about, from the collector's sketches
+        trending_hashtags, _ = trending.top(db.session, 'day', 'hashtags',
+                                            limit=10)
+        trending_terms, _ = trending.top(db.session, 'day', 'terms', limit=10)
+
+        # Get the 100 most recent messages, looking at the hot window first
+        # and only scanning older data when it holds fewer than 100
+        # Deduplicated messages show the text of their shared body
+        messages = db.session.query(TelegramMessage).options(
+            selectinload(TelegramMessage.body)).filter(
+            TelegramMessage.in_last_days(HOT_WINDOW_DAYS)).order_by(
+                TelegramMessage.timestamp.desc()).limit(100).all()
+        if len(messages) < 100:
+            messages = db.session.query(TelegramMessage).options(
+                selectinload(TelegramMessage.body)).order_by(
+                TelegramMessage.timestamp.desc()).limit(100).all()
 
         logger.info(
             f"Loaded {len(messages)} messages and {len(channels)} channels for display"
@@ -97,49 +136,88 @@ def index():
                            last_7_days_count=last_7_days_count,
                            channel_activity=channel_activity,
                            last_7_days_activity=last_7_days_activity,
+                           participants_overall=participants_overall,
+                           participants_7_days=participants_7_days,
+                           trending_hashtags=trending_hashtags,
+                           trending_terms=trending_terms,
                            channels=channels,
                            session_valid=session_valid)
 
 
-@app.route('/status')
-def status():
-    """Health check endpoint"""
-    global collector_thread
-
-    # Check if session exists in Replit's persistent storage
+def session_file_valid():
+    """Whether the collector's Telegram session file exists and is non-empty"""
     session_path = os.path.join(os.environ.get('REPL_HOME', ''),
                                 'ton_collector_session.session')
-    session_exists = os.path.exists(session_path) and os.path.getsize(
-        session_path) > 0
+    return os.path.exists(session_path) and os.path.getsize(session_path) > 0
 
-    # Check if collector thread is running
-    thread_running = collector_thread is not None and collector_thread.is_alive(
-    )
 
-    if session_exists and thread_running:
+def check_database():
+    """Run a trivial query, returning an error message on failure"""
+    try:
+        db.session.execute(db.text('SELECT 1'))
+        return None
+    except Exception as e:
+        db.session.rollback()
+        return str(e)
+
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the web process and its database connection work
+
+    Also reports the collector heartbeat and ingest lag, without failing
+    on them.
+    """
+    db_error = check_database()
+    if db_error:
+        return jsonify({"status": "error", "database": db_error}), 503
+    return jsonify({
+        "status": "ok",
+        "database": "ok",
+        "collector": collector_health()
+    })
+
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: the database works and the collector made recent progress"""
+    db_error = check_database()
+    if db_error:
+        return jsonify({"status": "error", "database": db_error}), 503
+    collector = collector_health()
+    ready = collector['status'] == 'ok'
+    return jsonify({
+        "status": "ok" if ready else "error",
+        "database": "ok",
+        "session": "valid" if session_file_valid() else "invalid",
+        "collector": collector
+    }), 200 if ready else 503
+
+
+@app.route('/status')
+def status():
+    """Health check endpoint
+
+    Read-only; use /restart_collector to restart the collector.
+    """
+    session_exists = session_file_valid()
+    try:
+        collector = collector_health()['status']
+    except Exception as e:
+        logger.error("Could not read collector heartbeat: %s", e)
+        collector = 'unknown'
+
+    if session_exists and collector == 'ok':
         return jsonify({
             "status": "running",
             "collector": "active",
             "session": "valid"
         })
-    elif not session_exists:
-        # Try to restart collector
-        start_collector()
-        return jsonify({
-            "status": "warning",
-            "collector": "restarted",
-            "session": "invalid"
-        })
-    elif not thread_running:
-        # Try to restart collector
-        start_collector()
-        return jsonify({
-            "status": "warning",
-            "collector": "restarted",
-            "thread": "dead"
-        })
-
-    return jsonify({"status": "error", "message": "Unknown state"})
+    return jsonify({
+        "status": "warning",
+        "collector": collector,
+        "session": "valid" if session_exists else "invalid"
+    })
 
 
 @app.route('/setup', methods=['GET', 'POST'])
@@ -157,7 +235,7 @@ def setup():
 
 
 @app.route('/setup_process', methods=['POST'])
-def setup_process():
+async def setup_process():
     """Process the setup form and send verification code"""
     try:
         data = request.get_json()
@@ -169,38 +247,31 @@ def setup_process():
                 "message": "Phone number is required"
             }), 400
 
-        # Store phone number temporarily for session creation
-        os.environ['TELEGRAM_PHONE'] = phone
+        # Runs on the shared gateway loop, awaited instead of blocked on
+        result = await gateway.call(gateway.send_code(phone))
 
-        # Start the Telegram session setup asynchronously
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(setup_telegram_session())
-        loop.close()
-
-        if result:
+        if result == 'authorized':
             return jsonify({
-                "status":
-                "code_sent",
-                "message":
-                "Verification code sent to your Telegram app"
+                "status": "success",
+                "message": "Already authorized with Telegram"
             })
-        else:
-            return jsonify({
-                "status": "error",
-                "message": "Failed to send verification code"
-            }), 500
+        return jsonify({
+            "status": "code_sent",
+            "message": "Verification code sent to your Telegram app"
+        })
 
+    except SetupError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
-        logger.error(f"Setup process failed: {str(e)}")
+        logger.error("Setup process failed: %s", e, exc_info=True)
         return jsonify({
             "status": "error",
             "message": f"Setup failed: {str(e)}"
         }), 500
 
 
-@app.route('/verify_code', methods=['POST', 'GET'])
-def verify_code():
+@app.route('/verify_code', methods=['POST'])
+async def verify_code():
     """Verify the Telegram authentication code"""
     try:
         data = request.get_json()
@@ -212,93 +283,8 @@ def verify_code():
                 "message": "No verification code provided"
             }), 400
 
-        # Store verification code temporarily
-        os.environ['TELEGRAM_CODE'] = code
-
-        # Get credentials from environment
-        api_id = int(os.environ.get('TELEGRAM_API_ID', 0))
-        api_hash = os.environ.get('TELEGRAM_API_HASH', '')
-        phone = os.environ.get('TELEGRAM_PHONE', '')
-
-        if not all([api_id, api_hash, phone]):
-            return jsonify({
-                "status": "error",
-                "message": "Missing API credentials"
-            }), 400
-
-        # Create an async function to handle the verification
-        async def complete_verification():
-            try:
-                session_path = os.path.join(os.environ.get('REPL_HOME', ''),
-                                            'ton_collector_session.session')
-                # Initialize client with proper session name
-                client = TelegramClient(session_path,
-                                        api_id=api_id,
-                                        api_hash=api_hash)
-                if not client.is_user_authorized():
-                    await client.send_code_request(phone)
-
-                await client.connect()
-                phone_code_hash = (
-                    await client.send_code_request(phone)).phone_code_hash
-                logger.info(phone_code_hash)
-                logger.info(code)
-                logger.info("WTF")
-                logger.info(phone)
-                logger.info(api_id)
-                logger.info(api_hash)
-
-                # Ensure we're not already signed in
-                if not await client.is_user_authorized():
-                    # Make sure phone has + prefix
-                    if not phone.startswith('+'):
-                        formatted_phone = '+' + phone
-                    else:
-                        formatted_phone = phone
-                    # Sign in with the verification code
-                    try:
-                        await client.sign_in(formatted_phone, code)
-                    except Exception as e:
-                        exc_type, exc_obj, exc_tb = sys.exc_info()
-                        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                        logger.error(e)
-                        logger.error("File: %s Lineno: %s", fname, exc_tb.tb_lineno)
-                        logger.error(f"Session failed WTFF: {str(e)}")
-                        
-                        await client.sign_in(formatted_phone, password="pmfkjkszpj1")
-
-                    # Check if we're now authorized
-                    if await client.is_user_authorized():
-                        logger.info("Successfully authenticated with Telegram")
-                        await client.disconnect()
-                        return True
-                    else:
-                        logger.error(
-                            "Failed to authorize after sign-in attempt")
-                        await client.disconnect()
-                        return False
-                else:
-                    logger.info("Already authorized with Telegram")
-                    await client.disconnect()
-                    return True
-
-            except Exception as e:
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                logger.error(e)
-                logger.error("File: %s Lineno: %s", fname, exc_tb.tb_lineno)
-                logger.error(f"Session failed: {str(e)}")
-                try:
-                    await client.disconnect()
-                except:
-                    pass
-                return False
-
-        # Run the async verification function
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        success = loop.run_until_complete(complete_verification())
-        loop.close()
+        password = data.get('password') or os.environ.get('TELEGRAM_PASSWORD')
+        success = await gateway.call(gateway.sign_in(code, password))
 
         if success:
             # If verification was successful, restart the collector
@@ -314,12 +300,10 @@ def verify_code():
                 "message": "Failed to verify code with Telegram"
             }), 500
 
+    except SetupError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        logger.error(e)
-        logger.error("File: %s Lineno: %s", fname, exc_tb.tb_lineno)
-        logger.error(f"Code verification failed: {str(e)}")
+        logger.error("Code verification failed: %s", e, exc_info=True)
         return jsonify({
             "status": "error",
             "message": f"Verification failed: {str(e)}"
@@ -392,10 +376,19 @@ def restart_collector():
 # Start the collector thread when the app starts
 collector_thread = None
 
+# Only `python main.py` runs the collector inside the web process. Under
+# gunicorn it is a separate process (`python manage.py collector`, started by
+# gunicorn.conf.py), so web workers never import Telethon.
+collector_in_process = False
+
 
 def start_collector():
     """Initialize and start the collector thread"""
     global collector_thread
+    if not collector_in_process:
+        logger.info("Collector runs in its own process and picks up a new "
+                    "session on its next retry")
+        return True
     logger.info("Starting collector thread...")
     try:
         # Stop existing collector if running
@@ -458,6 +451,8 @@ if __name__ == "__main__":
         with app.app_context():
             db.create_all()
 
+        collector_in_process = True
+
         # Start collector with app context
         with app.app_context():
             start_collector()
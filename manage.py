@@ -0,0 +1,143 @@
+"""Out-of-band setup and the standalone collector process.
+
+Importing the web app no longer creates tables or starts the collector, so
+gunicorn workers only load Flask and SQLAlchemy. Schema setup and collection
+run here instead:
+
+    python manage.py init-db       # create missing tables, columns and indexes
+    python manage.py collector     # run the collector in the foreground
+
+gunicorn.conf.py runs `init-db` before forking workers and starts
+`collector` next to them; `python main.py` still does both in-process for
+local development.
+"""
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+# Indexes models dropped, with the index that replaced each
+SUPERSEDED_INDEXES = {
+    'ix_telegram_messages_channel_message':
+    'uq_telegram_messages_channel_message',
+}
+
+
+def add_missing_columns(conn, metadata):
+    """Add nullable columns that models gained since their table was created
+
+    create_all() only creates missing tables. Returns "table.column" names.
+    """
+    inspector = inspect(conn)
+    added = []
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        present = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in present:
+                continue
+            if not column.nullable:
+                logger.warning(f"Cannot add NOT NULL column {table.name}.{column.name}")
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {table.name} "
+                              f"ADD COLUMN {column.name} {column_type}"))
+            added.append(f"{table.name}.{column.name}")
+            logger.info(f"Added column {table.name}.{column.name}")
+    return added
+
+
+def add_missing_indexes(conn, metadata):
+    """Create indexes that models gained since their table was created
+
+    Returns the names of the created indexes.
+    """
+    inspector = inspect(conn)
+    added = []
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        present = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in present:
+                continue
+            try:
+                with conn.begin_nested():
+                    index.create(conn)
+            except Exception as e:
+                # A unique index fails on rows stored twice before it existed
+                logger.error(f"Could not create index {index.name}: {str(e)}")
+                continue
+            added.append(index.name)
+            logger.info(f"Created index {index.name}")
+    return added
+
+
+def drop_superseded_indexes(conn):
+    """Drop indexes whose replacement exists; returns the dropped names"""
+    inspector = inspect(conn)
+    if not inspector.has_table('telegram_messages'):
+        return []
+    present = {index['name']
+               for index in inspector.get_indexes('telegram_messages')}
+    dropped = []
+    for old, new in SUPERSEDED_INDEXES.items():
+        if old in present and new in present:
+            conn.execute(text(f"DROP INDEX {old}"))
+            dropped.append(old)
+            logger.info(f"Dropped index {old}, superseded by {new}")
+    return dropped
+
+
+def init_db():
+    """Create missing tables, columns and indexes; existing ones are left alone"""
+    import partitions
+    from app import app, db
+
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as conn:
+            add_missing_columns(conn, db.metadata)
+            if partitions.is_postgres(conn) and partitions.is_partitioned(conn):
+                # Needs the partition key, which the model's index lacks
+                try:
+                    with conn.begin_nested():
+                        partitions.create_unique_index(conn)
+                except Exception as e:
+                    logger.error(f"Could not create {partitions.UNIQUE_INDEX}: "
+                                 f"{str(e)}")
+            add_missing_indexes(conn, db.metadata)
+            drop_superseded_indexes(conn)
+    logger.info("Database schema is up to date")
+
+
+def run_collector():
+    """Run the collector loop until interrupted
+
+    This is the only process that imports Telethon.
+    """
+    from collector import collector_loop
+
+    try:
+        asyncio.run(collector_loop())
+    except KeyboardInterrupt:
+        logger.info("Collector stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Database setup and collector")
+    parser.add_argument('command', choices=['init-db', 'collector'])
+    args = parser.parse_args(argv)
+
+    if args.command == 'init-db':
+        init_db()
+    else:
+        run_collector()
+
+
+if __name__ == "__main__":
+    main()
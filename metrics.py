@@ -0,0 +1,112 @@
+"""Prometheus metrics for the collector and the web tier.
+
+Metrics are exposed on `/metrics`. Under gunicorn every worker is a separate
+process, so set PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py does this) to let
+prometheus_client share samples through files in that directory; `/metrics`
+then aggregates all live workers, whichever worker serves the scrape.
+"""
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter,
+                               Gauge, Histogram, REGISTRY, generate_latest,
+                               multiprocess)
+
+# Buckets for Telegram requests and DB commits, from 5ms to 2 minutes
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+messages_ingested = Counter('collector_messages_ingested_total',
+                            'Messages stored by the collector',
+                            ['dialog_type'])
+cycle_duration = Histogram('collector_cycle_duration_seconds',
+                           'Duration of one collector scheduling cycle',
+                           buckets=LATENCY_BUCKETS)
+dialog_fetch_latency = Histogram('collector_dialog_fetch_seconds',
+                                 'Time to fetch and store one dialog',
+                                 ['tier'],
+                                 buckets=LATENCY_BUCKETS)
+flood_wait_seconds = Counter('collector_flood_wait_seconds_total',
+                             'Seconds Telegram asked us to wait')
+queue_depth = Gauge('collector_queue_depth',
+                    'Dialogs due for polling at the start of a cycle',
+                    multiprocess_mode='livemax')
+scheduled_dialogs = Gauge('collector_scheduled_dialogs',
+                          'Dialogs known to the poll scheduler',
+                          multiprocess_mode='livemax')
+ingest_lag = Gauge('collector_ingest_lag_seconds',
+                   'Largest gap between a dialog\'s newest Telegram message '
+                   'and its newest stored message',
+                   multiprocess_mode='livemax')
+last_cycle_finished = Gauge('collector_last_cycle_finished_timestamp_seconds',
+                            'Unix time the last collector cycle finished',
+                            multiprocess_mode='max')
+db_commit_latency = Histogram('db_commit_seconds',
+                              'Latency of collector commits',
+                              buckets=LATENCY_BUCKETS)
+db_commit_retries = Counter('db_commit_retries_total',
+                            'Collector commits retried after an error')
+db_commit_failures = Counter('db_commit_failures_total',
+                             'Collector batches dropped after all retries')
+spool_pending = Gauge('collector_spool_pending_writes',
+                      'Spooled collector writes not yet in the database',
+                      multiprocess_mode='livemax')
+spool_replayed = Counter('collector_spool_replayed_total',
+                         'Spooled collector writes applied to the database')
+spool_replay_errors = Counter('collector_spool_replay_errors_total',
+                              'Spool replays stopped by a database error')
+http_request_latency = Histogram('http_request_duration_seconds',
+                                 'HTTP request latency',
+                                 ['method', 'route', 'status'],
+                                 buckets=LATENCY_BUCKETS)
+replica_lag = Gauge('db_replica_lag_seconds',
+                    'Replication lag of read replicas at the last check',
+                    ['replica'],
+                    multiprocess_mode='livemax')
+routed_reads = Counter('db_routed_read_requests_total',
+                       'Read-only requests by the database serving them',
+                       ['target'])
+cache_requests = Counter('cache_requests_total',
+                         'Cache lookups by cache and result',
+                         ['cache', 'result'])
+
+
+def record_cache(cache, hit):
+    """Count a cache lookup as a hit or a miss"""
+    cache_requests.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+
+def _registry():
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_view():
+    """Render all metrics in the Prometheus text format"""
+    return Response(generate_latest(_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def _start_timer():
+    g.metrics_started = time.perf_counter()
+
+
+def _observe_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None and request.endpoint != 'metrics':
+        # Label by route template, not by path, to bound cardinality
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_latency.labels(method=request.method,
+                                    route=route,
+                                    status=str(response.status_code)).observe(
+                                        time.perf_counter() - started)
+    return response
+
+
+def init_app(app):
+    """Register request instrumentation and the /metrics endpoint"""
+    app.before_request(_start_timer)
+    app.after_request(_observe_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
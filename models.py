@@ -1,15 +1,260 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from app import db
 
+# Most dashboard queries only look this many days back. Keeping them inside
+# the window lets PostgreSQL prune old monthly partitions (see partitions.py).
+HOT_WINDOW_DAYS = 7
+
+
 class TelegramMessage(db.Model):
     __tablename__ = 'telegram_messages'
+    # A message is stored once; partitions.py adds `timestamp` to this index
+    # on a partitioned table, where unique indexes need the partition key
+    __table_args__ = (db.Index('uq_telegram_messages_channel_message',
+                               'channel_id', 'message_id', unique=True),
+                      db.Index('ix_telegram_messages_forward_origin',
+                               'fwd_from_id', 'fwd_from_message_id'),
+                      db.Index('ix_telegram_messages_sender',
+                               'sender_id', 'timestamp'))
 
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.Integer, nullable=False)
     channel_id = db.Column(db.String(100), nullable=False)
     channel_title = db.Column(db.String(200))
     content = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     is_ton_dev = db.Column(db.Boolean, default=False)
     is_outgoing = db.Column(db.Boolean, default=False)
     dialog_type = db.Column(db.String(20))
+    # zstd-compressed content, with `content` left NULL, see content_codec.py
+    content_zstd = db.Column(db.LargeBinary)
+    content_dict_id = db.Column(db.Integer)
+    # Longer bodies are stored once in message_bodies, see bodies.py
+    body_hash = db.Column(db.String(32), index=True)
+    # Origin of a forwarded message: marked peer id, message id and date
+    fwd_from_id = db.Column(db.String(100))
+    fwd_from_message_id = db.Column(db.Integer)
+    fwd_date = db.Column(db.DateTime)
+    # Marked peer id of the author, from the message itself, see senders
+    sender_id = db.Column(db.String(100))
+    # Position in the changefeed of the latest insert or edit, see changes.py
+    change_seq = db.Column(db.BigInteger, index=True)
+    edit_date = db.Column(db.DateTime)
+
+    body = db.relationship(
+        'MessageBody',
+        primaryjoin='foreign(TelegramMessage.body_hash) == MessageBody.hash',
+        uselist=False,
+        viewonly=True)
+
+    @classmethod
+    def in_last_days(cls, days=HOT_WINDOW_DAYS):
+        """Filter clause restricting a query to the last `days` days"""
+        return cls.timestamp >= datetime.utcnow() - timedelta(days=days)
+
+    @property
+    def text(self):
+        """Message text, whether stored inline or as a shared body"""
+        if self.content is not None or self.body is None:
+            return self.content
+        return self.body.text
+
+
+class MessageBody(db.Model):
+    """Text shared by identical messages, stored once, see bodies.py"""
+    __tablename__ = 'message_bodies'
+
+    hash = db.Column(db.String(32), primary_key=True)
+    content = db.Column(db.Text)
+    content_zstd = db.Column(db.LargeBinary)
+    content_dict_id = db.Column(db.Integer)
+    size = db.Column(db.Integer)  # bytes of UTF-8 text
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    chat_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+    first_channel_id = db.Column(db.String(100))
+    first_message_id = db.Column(db.Integer)
+    dialog_type = db.Column(db.String(20))
+    first_seen_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def text(self):
+        if self.content_zstd is None:
+            return self.content
+        return content_codec.codec.decompress(self.content_zstd,
+                                              self.content_dict_id)
+
+
+class BodySighting(db.Model):
+    """A chat a message body was seen in; keeps chat_count exact"""
+    __tablename__ = 'body_sightings'
+
+    body_hash = db.Column(db.String(32), primary_key=True)
+    channel_id = db.Column(db.String(100), primary_key=True)
+    message_id = db.Column(db.Integer)
+    seen_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class NearDuplicate(db.Model):
+    """A message in a cluster of near-identical messages, see near_duplicates.py"""
+    __tablename__ = 'near_duplicates'
+
+    channel_id = db.Column(db.String(100), primary_key=True)
+    message_id = db.Column(db.Integer, primary_key=True)
+    cluster_id = db.Column(db.String(16), nullable=False, index=True)
+    timestamp = db.Column(db.DateTime, index=True)
+    similarity = db.Column(db.Float)  # estimated Jaccard to the matched message
+
+
+class TermSketch(db.Model):
+    """Sketches of the items in one time bucket of messages, see trending.py"""
+    __tablename__ = 'term_sketches'
+    __table_args__ = (db.Index('ix_term_sketches_bucket', 'granularity',
+                               'bucket_start'),)
+
+    scope = db.Column(db.String(100), primary_key=True)  # '*' or a channel_id
+    kind = db.Column(db.String(10), primary_key=True)  # terms, hashtags, ...
+    granularity = db.Column(db.String(4), primary_key=True)  # hour or day
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    messages = db.Column(db.Integer, nullable=False, default=0)
+    top = db.Column(db.Text)  # Space-Saving summary as JSON
+    counts = db.Column(db.LargeBinary)  # Count-Min counters, global scope only
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Sender(db.Model):
+    """Author of collected messages, as last seen in message metadata"""
+    __tablename__ = 'senders'
+
+    id = db.Column(db.String(100), primary_key=True)  # marked peer id
+    peer_type = db.Column(db.String(10))  # user, chat or channel
+    username = db.Column(db.String(100), index=True)
+    display_name = db.Column(db.String(200))
+    is_bot = db.Column(db.Boolean)
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    first_seen_at = db.Column(db.DateTime)
+    last_seen_at = db.Column(db.DateTime)
+
+
+class ParticipantSketch(db.Model):
+    """HyperLogLog of the senders of one channel and day, see participants.py"""
+    __tablename__ = 'participant_sketches'
+    __table_args__ = (db.Index('ix_participant_sketches_bucket', 'granularity',
+                               'bucket_start'),)
+
+    scope = db.Column(db.String(100), primary_key=True)  # '*' or a channel_id
+    granularity = db.Column(db.String(4), primary_key=True)  # day or all
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    registers = db.Column(db.LargeBinary, nullable=False)
+    messages = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class TelegramEntity(db.Model):
+    """Users, chats and channels seen by the collector, keyed by marked peer id"""
+    __tablename__ = 'telegram_entities'
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    access_hash = db.Column(db.BigInteger)
+    peer_type = db.Column(db.String(10), nullable=False)  # user, chat or channel
+    dialog_type = db.Column(db.String(20))
+    username = db.Column(db.String(100))
+    title = db.Column(db.String(200))
+    is_dialog = db.Column(db.Boolean, default=False, nullable=False)
+    archived = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ContentDictionary(db.Model):
+    """zstd dictionary trained on the messages of a dialog type or channel
+
+    Rows are never updated, retraining adds a new one, so content
+    compressed with an older dictionary stays readable.
+    """
+    __tablename__ = 'content_dictionaries'
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(120), nullable=False, index=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    samples = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ApiKey(db.Model):
+    """Keys accepted by the /api endpoints in the X-API-Key header"""
+    __tablename__ = 'api_keys'
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), unique=True, nullable=False)
+    name = db.Column(db.String(100))
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ChangeVersion(db.Model):
+    """Counter bumped with every committed batch, globally and per channel
+
+    Lets the web tier answer conditional GETs without reading messages,
+    see versions.py. The '#changes' row numbers the changefeed instead,
+    see changes.py.
+    """
+    __tablename__ = 'change_versions'
+
+    scope = db.Column(db.String(100), primary_key=True)  # '*' or a channel_id
+    channel_title = db.Column(db.String(200), index=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class MessageTombstone(db.Model):
+    """A deleted message's place in the changefeed, see changes.py"""
+    __tablename__ = 'message_tombstones'
+
+    seq = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    channel_id = db.Column(db.String(100), nullable=False)
+    message_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class CollectorHeartbeat(db.Model):
+    """Liveness of the collector loop, readable from every web worker"""
+    __tablename__ = 'collector_heartbeats'
+
+    id = db.Column(db.String(50), primary_key=True)
+    host = db.Column(db.String(100))
+    pid = db.Column(db.Integer)
+    cycle = db.Column(db.Integer, default=0)
+    cycle_started_at = db.Column(db.DateTime)
+    cycle_finished_at = db.Column(db.DateTime)
+    last_commit_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class DialogLag(db.Model):
+    """Newest message Telegram reported for a dialog vs. the newest we stored"""
+    __tablename__ = 'collector_dialog_lag'
+
+    channel_id = db.Column(db.String(100), primary_key=True)
+    channel_title = db.Column(db.String(200))
+    top_message_id = db.Column(db.Integer)
+    top_message_at = db.Column(db.DateTime)
+    stored_message_id = db.Column(db.Integer)
+    stored_message_at = db.Column(db.DateTime)
+    # Date of the oldest message newer than the stored mark, if any
+    pending_since = db.Column(db.DateTime)
+    checked_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def lag_messages(self):
+        return max((self.top_message_id or 0) - (self.stored_message_id or 0), 0)
+
+    def lag_seconds(self, now=None):
+        """How long the oldest message we have not stored has been waiting"""
+        if self.pending_since is None or not self.lag_messages:
+            return 0.0
+        now = now or datetime.utcnow()
+        return max((now - self.pending_since).total_seconds(), 0.0)
+
+
+# Registers the load hook that decompresses zstd-compressed content
+import content_codec  # noqa: E402,F401
@@ -0,0 +1,279 @@
+"""Near-duplicate clusters of incoming messages, for spam waves.
+
+Coordinated spam reaches many groups with slightly varied text, so exact
+body hashes (bodies.py) miss it. The collector therefore keeps a MinHash/LSH
+index of the messages of the last NEAR_DUP_WINDOW_HOURS:
+
+* text is normalized (case, punctuation, digits) and cut into character
+  5-shingles, hashed with CRC32;
+* a MinHash signature of NUM_PERM values estimates the Jaccard similarity
+  of two shingle sets; signatures of a batch are computed together, with
+  numpy when it is installed (`pip install .[similarity]`);
+* signatures are split into BANDS bands of ROWS values, and messages sharing
+  a band become candidates, verified against NEAR_DUP_THRESHOLD.
+
+Buckets are kept per hour of message time and dropped once they leave the
+window, so memory follows the message rate, not the table size. A message
+matching an earlier one joins its cluster; both are written to
+`near_duplicates`, which the API groups by cluster. The collector rebuilds
+the index from the window when it starts.
+"""
+import hashlib
+import random
+import re
+import zlib
+from array import array
+from datetime import timedelta
+
+from sqlalchemy import and_, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+import bodies
+from config import Config
+from models import NearDuplicate, TelegramMessage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SHINGLE_SIZE = 5
+NUM_PERM = 100
+BANDS = 20
+ROWS = NUM_PERM // BANDS
+
+# Shingle hashes per numpy block, bounding its NUM_PERM x block matrix
+BLOCK_SHINGLES = 16384
+
+_MASK = (1 << 64) - 1
+_rng = random.Random(20250301)
+# Multiply-shift hashing: ((a * h + b) mod 2**64) >> 32, with odd a
+PERMUTATIONS = [(_rng.getrandbits(64) | 1, _rng.getrandbits(64))
+                for _ in range(NUM_PERM)]
+
+_PUNCTUATION = re.compile(r'[\W_]+')
+_DIGITS = re.compile(r'\d')
+
+
+def normalize(text):
+    text = _DIGITS.sub('0', text.casefold())
+    return _PUNCTUATION.sub(' ', text).strip()
+
+
+def text_of(content, min_chars=None):
+    """Normalized text worth indexing, or None for short messages"""
+    if not content:
+        return None
+    min_chars = Config.NEAR_DUP_MIN_CHARS if min_chars is None else min_chars
+    text = normalize(content)
+    return text if len(text) >= max(min_chars, SHINGLE_SIZE) else None
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    return sorted({zlib.crc32(text[i:i + size].encode('utf-8'))
+                   for i in range(max(len(text) - size + 1, 1))})
+
+
+def signatures(texts):
+    """MinHash signatures (array('I')) of normalized texts; None stays None"""
+    result = [None] * len(texts)
+    pending = [(i, shingles(text)) for i, text in enumerate(texts)
+               if text is not None]
+    if np is None:
+        for i, hashes in pending:
+            result[i] = _signature(hashes)
+        return result
+
+    block, size = [], 0
+    for item in pending:
+        block.append(item)
+        size += len(item[1])
+        if size >= BLOCK_SHINGLES:
+            _signature_block(block, result)
+            block, size = [], 0
+    if block:
+        _signature_block(block, result)
+    return result
+
+
+def _signature(hashes):
+    return array('I', (min(((a * h + b) & _MASK) >> 32 for h in hashes)
+                       for a, b in PERMUTATIONS))
+
+
+def _signature_block(block, result):
+    a = np.array([a for a, _ in PERMUTATIONS], dtype=np.uint64)[:, None]
+    b = np.array([b for _, b in PERMUTATIONS], dtype=np.uint64)[:, None]
+    lengths = [len(hashes) for _, hashes in block]
+    hashes = np.fromiter((h for _, item in block for h in item),
+                         dtype=np.uint64, count=sum(lengths))
+    # uint64 arithmetic wraps, matching the `& _MASK` of _signature
+    values = (a * hashes[None, :] + b) >> np.uint64(32)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    minima = np.minimum.reduceat(values, offsets, axis=1).T.astype(np.uint32)
+    for (i, _), row in zip(block, minima):
+        signature = array('I')
+        signature.frombytes(row.tobytes())
+        result[i] = signature
+
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of two signatures"""
+    return sum(x == y for x, y in zip(first, second)) / NUM_PERM
+
+
+def band_keys(signature):
+    return [hash((band, *signature[band * ROWS:(band + 1) * ROWS]))
+            for band in range(BANDS)]
+
+
+def cluster_id(channel_id, message_id):
+    """Id of the cluster first formed around this message"""
+    return hashlib.blake2b(f"{channel_id}:{message_id}".encode(),
+                           digest_size=8).hexdigest()
+
+
+class _Entry:
+    __slots__ = ('key', 'timestamp', 'signature', 'cluster_id', 'similarity')
+
+    def __init__(self, key, timestamp, signature, cluster_id=None,
+                 similarity=None):
+        self.key = key
+        self.timestamp = timestamp
+        self.signature = signature
+        self.cluster_id = cluster_id
+        self.similarity = similarity
+
+    def member(self):
+        return {'channel_id': self.key[0], 'message_id': self.key[1],
+                'cluster_id': self.cluster_id, 'timestamp': self.timestamp,
+                'similarity': self.similarity}
+
+
+class NearDuplicateIndex:
+    """LSH buckets of recent messages, per hour of message time"""
+
+    def __init__(self, window_hours=None, threshold=None):
+        self.window = timedelta(hours=window_hours or Config.NEAR_DUP_WINDOW_HOURS)
+        self.threshold = Config.NEAR_DUP_THRESHOLD if threshold is None \
+            else threshold
+        # hour -> ({band key: [entries]}, [message keys])
+        self.windows = {}
+        self.entries = {}
+        self.newest = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, rows, row_signatures):
+        """Index message rows; returns the near_duplicates rows to write
+
+        A message is compared with everything in the window, including
+        earlier rows of the same batch. Messages already indexed (a batch
+        retried after a failed write) only repeat their own row.
+        """
+        members = {}
+        for row, signature in zip(rows, row_signatures):
+            if signature is None:
+                continue
+            key = (row['channel_id'], row['message_id'])
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry.cluster_id is not None:
+                    members[key] = entry.member()
+                continue
+            entry = _Entry(key, row['timestamp'], signature)
+            if not self._admit(entry.timestamp):
+                continue
+            match, score = self._best_match(signature)
+            if match is not None:
+                if match.cluster_id is None:
+                    match.cluster_id = cluster_id(*match.key)
+                    match.similarity = 1.0
+                entry.cluster_id, entry.similarity = match.cluster_id, score
+                members[match.key] = match.member()
+                members[key] = entry.member()
+            # Bucketed even when an exact copy, so the cluster outlives the
+            # message that started it
+            self._insert(entry)
+        return list(members.values())
+
+    def load(self, rows, codec=None):
+        """Rebuild from rows of `warm_query`, writing nothing"""
+        rows = list(rows)
+        texts = []
+        for _, _, _, content, frame, dict_id, _, _ in rows:
+            if frame is not None:
+                content = codec.decode(None, frame, dict_id) if codec else None
+            texts.append(text_of(content))
+        for row, signature in zip(rows, signatures(texts)):
+            if signature is None or not self._admit(row[2]):
+                continue
+            self._insert(_Entry((row[0], row[1]), row[2], signature,
+                                row[6], row[7]))
+
+    def _admit(self, timestamp):
+        if timestamp is None:
+            return False
+        if self.newest is None or timestamp > self.newest:
+            self.newest = timestamp
+            self._expire()
+        return timestamp >= self.newest - self.window
+
+    def _expire(self):
+        horizon = _hour(self.newest - self.window)
+        for hour in [hour for hour in self.windows if hour < horizon]:
+            _, keys = self.windows.pop(hour)
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def _best_match(self, signature):
+        keys = band_keys(signature)
+        best, best_score, seen = None, 0.0, set()
+        for buckets, _ in self.windows.values():
+            for band_key in keys:
+                for candidate in buckets.get(band_key, ()):
+                    if id(candidate) in seen:
+                        continue
+                    seen.add(id(candidate))
+                    score = similarity(signature, candidate.signature)
+                    if score > best_score:
+                        best, best_score = candidate, score
+                        if score == 1.0:
+                            # No better match; spares scanning every copy
+                            return best, best_score
+        if best_score < self.threshold:
+            return None, 0.0
+        return best, best_score
+
+    def _insert(self, entry):
+        buckets, keys = self.windows.setdefault(_hour(entry.timestamp), ({}, []))
+        keys.append(entry.key)
+        self.entries[entry.key] = entry
+        for band_key in band_keys(entry.signature):
+            buckets.setdefault(band_key, []).append(entry)
+
+
+def _hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def insert_statement(dialect_name):
+    """Insert of near_duplicates rows that skips rows already stored"""
+    dialect = postgresql if dialect_name == 'postgresql' else sqlite
+    return dialect.insert(NearDuplicate).on_conflict_do_nothing(
+        index_elements=[NearDuplicate.channel_id, NearDuplicate.message_id])
+
+
+def warm_query(since):
+    """Messages since `since` with their stored cluster, for `load`"""
+    return bodies.join_bodies(
+        select(TelegramMessage.channel_id, TelegramMessage.message_id,
+               TelegramMessage.timestamp, bodies.CONTENT,
+               *bodies.STORED_COLUMNS, NearDuplicate.cluster_id,
+               NearDuplicate.similarity)).outerjoin(
+                   NearDuplicate, and_(
+                       NearDuplicate.channel_id == TelegramMessage.channel_id,
+                       NearDuplicate.message_id == TelegramMessage.message_id)
+               ).where(TelegramMessage.timestamp >= since).order_by(
+                   TelegramMessage.timestamp)
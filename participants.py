@@ -0,0 +1,228 @@
+"""Senders and approximate unique participants per channel.
+
+The collector takes each message's author from the message itself: the
+sender id is part of every message, and the sender's entity arrives with
+the history page, so no request is made per message. Authors are upserted
+into `senders` and messages keep `sender_id`, indexed with the timestamp
+for exact per-sender queries.
+
+Counting distinct senders per channel over a period would need a scan of
+its messages, so `participant_sketches` keeps a HyperLogLog per channel and
+day, plus one over all time, and one of each across all channels. Sketches
+merge by taking register maxima, so any range of days is a union of day
+sketches: with the default 1024 registers an estimate is within about 3%,
+in 1 KiB per channel and day.
+"""
+import hashlib
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from config import Config
+from models import ChangeVersion, ParticipantSketch, Sender
+from versions import GLOBAL_SCOPE
+
+# Bucket of the sketches over all time
+ALL_TIME = datetime(1970, 1, 1)
+
+
+class HyperLogLog:
+    """Cardinality estimates in 2**precision one-byte registers"""
+
+    def __init__(self, precision=None, registers=None):
+        self.precision = precision or Config.PARTICIPANTS_PRECISION
+        size = 1 << self.precision
+        if registers is not None and len(registers) == size:
+            self.registers = bytearray(registers)
+        else:
+            # Missing, or stored with another precision: start over
+            self.registers = bytearray(size)
+
+    def add(self, item):
+        value = int.from_bytes(hashlib.blake2b(
+            str(item).encode('utf-8'), digest_size=8).digest(), 'big')
+        bits = 64 - self.precision
+        index = value >> bits
+        rest = value & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        raw = alpha * size * size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * size and zeros:
+            # Linear counting is more accurate for small sets
+            return round(size * math.log(size / zeros))
+        return round(raw)
+
+    def dumps(self):
+        return bytes(self.registers)
+
+
+def sender_rows(rows, senders=None):
+    """`senders` upsert rows for message rows, merged with sender details
+
+    `senders` maps sender ids to `utils.sender_info` dicts.
+    """
+    result = {}
+    for row in rows:
+        sender_id = row.get('sender_id')
+        if sender_id is None:
+            continue
+        entry = result.get(sender_id)
+        if entry is None:
+            entry = result[sender_id] = {
+                'id': sender_id, 'peer_type': None, 'username': None,
+                'display_name': None, 'is_bot': None, 'message_count': 0,
+                'first_seen_at': row['timestamp'],
+                'last_seen_at': row['timestamp']}
+            entry.update((senders or {}).get(sender_id) or {})
+        entry['message_count'] += 1
+        entry['first_seen_at'] = min(entry['first_seen_at'], row['timestamp'])
+        entry['last_seen_at'] = max(entry['last_seen_at'], row['timestamp'])
+    return list(result.values())
+
+
+def sender_upsert(dialect_name):
+    """Upsert adding message counts and keeping known names"""
+    dialect = postgresql if dialect_name == 'postgresql' else sqlite
+    stmt = dialect.insert(Sender)
+    new = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[Sender.id],
+        set_={
+            'peer_type': func.coalesce(new.peer_type, Sender.peer_type),
+            'username': func.coalesce(new.username, Sender.username),
+            'display_name': func.coalesce(new.display_name, Sender.display_name),
+            'is_bot': func.coalesce(new.is_bot, Sender.is_bot),
+            'message_count': Sender.message_count + new.message_count,
+            'first_seen_at': case((new.first_seen_at < Sender.first_seen_at,
+                                   new.first_seen_at),
+                                  else_=Sender.first_seen_at),
+            'last_seen_at': case((new.last_seen_at > Sender.last_seen_at,
+                                  new.last_seen_at),
+                                 else_=Sender.last_seen_at),
+        })
+
+
+def _day(timestamp):
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def tally(rows):
+    """Senders of message rows, per (scope, granularity, bucket)
+
+    Returns {key: [set of sender ids, messages]}.
+    """
+    deltas = {}
+    for row in rows:
+        if row.get('sender_id') is None or row.get('timestamp') is None:
+            continue
+        for scope in (GLOBAL_SCOPE, row['channel_id']):
+            for key in ((scope, 'day', _day(row['timestamp'])),
+                        (scope, 'all', ALL_TIME)):
+                delta = deltas.setdefault(key, [set(), 0])
+                delta[0].add(row['sender_id'])
+                delta[1] += 1
+    return deltas
+
+
+# Plain rows, not ORM instances, so long-lived sessions never see stale ones
+_COLUMNS = (ParticipantSketch.scope, ParticipantSketch.granularity,
+            ParticipantSketch.bucket_start, ParticipantSketch.registers,
+            ParticipantSketch.messages)
+
+
+def lookup_query(keys):
+    """Stored sketches for the keys of a `tally`"""
+    return select(*_COLUMNS).where(
+        ParticipantSketch.scope.in_({key[0] for key in keys}),
+        ParticipantSketch.granularity.in_({key[1] for key in keys}),
+        ParticipantSketch.bucket_start.in_({key[2] for key in keys}))
+
+
+def apply(stored, deltas, now):
+    """Rows for `sketch_upsert`: stored sketches plus the new senders"""
+    rows = []
+    for key, (sender_ids, messages) in deltas.items():
+        row = stored.get(key)
+        sketch = HyperLogLog(registers=row.registers if row is not None else None)
+        for sender_id in sender_ids:
+            sketch.add(sender_id)
+        rows.append({'scope': key[0], 'granularity': key[1],
+                     'bucket_start': key[2], 'registers': sketch.dumps(),
+                     'messages': (row.messages if row is not None else 0) +
+                     messages,
+                     'updated_at': now})
+    return rows
+
+
+def sketch_upsert(dialect_name):
+    dialect = postgresql if dialect_name == 'postgresql' else sqlite
+    stmt = dialect.insert(ParticipantSketch)
+    return stmt.on_conflict_do_update(
+        index_elements=[ParticipantSketch.scope, ParticipantSketch.granularity,
+                        ParticipantSketch.bucket_start],
+        set_={column: stmt.excluded[column]
+              for column in ('registers', 'messages', 'updated_at')})
+
+
+def unique_senders(session, scopes, days=None, now=None):
+    """Estimated distinct senders per scope, over all time or the last days
+
+    `scopes` of None means every scope. Scopes without sketches are left
+    out.
+    """
+    query = select(ParticipantSketch.scope, ParticipantSketch.registers)
+    if scopes is not None:
+        query = query.where(ParticipantSketch.scope.in_(list(scopes)))
+    if days is None:
+        query = query.where(ParticipantSketch.granularity == 'all')
+    else:
+        since = _day(now or datetime.utcnow()) - timedelta(days=days - 1)
+        query = query.where(ParticipantSketch.granularity == 'day',
+                            ParticipantSketch.bucket_start >= since)
+    sketches = {}
+    for scope, registers in session.execute(query):
+        sketch = HyperLogLog(registers=registers)
+        if scope in sketches:
+            sketches[scope].merge(sketch)
+        else:
+            sketches[scope] = sketch
+    return {scope: sketch.estimate() for scope, sketch in sketches.items()}
+
+
+def unique_senders_by_title(session, titles, days=None, now=None):
+    """`unique_senders` keyed by channel title, for the dashboard"""
+    scopes = dict(session.execute(
+        select(ChangeVersion.scope, ChangeVersion.channel_title).where(
+            ChangeVersion.channel_title.in_(list(titles)))).all())
+    estimates = unique_senders(session, scopes, days, now)
+    by_title = {}
+    for scope, estimate in estimates.items():
+        # Titles are not unique; add up channels sharing one
+        by_title[scopes[scope]] = by_title.get(scopes[scope], 0) + estimate
+    return by_title
+
+
+def leaderboard(session, days=None, limit=20, now=None):
+    """Channels by estimated distinct senders, and the estimate over all
+
+    Returns (total, [(channel_id, channel_title, participants)]).
+    """
+    estimates = unique_senders(session, None, days, now)
+    total = estimates.pop(GLOBAL_SCOPE, 0)
+    ranked = sorted(estimates.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    titles = dict(session.execute(
+        select(ChangeVersion.scope, ChangeVersion.channel_title).where(
+            ChangeVersion.scope.in_([scope for scope, _ in ranked]))).all())
+    return total, [(scope, titles.get(scope), estimate)
+                   for scope, estimate in ranked]
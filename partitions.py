@@ -0,0 +1,259 @@
+"""Monthly partitioning, retention and archival of telegram_messages.
+
+On PostgreSQL the messages table can be converted into a declaratively
+partitioned table (PARTITION BY RANGE on `timestamp`, one partition per month
+plus a default partition). Dashboard queries only look at the last few days,
+so with partitioning they touch one or two small partitions whose pages stay
+in memory, and old months can be dropped without a bulk DELETE.
+
+Old partitions beyond the retention period are optionally archived to
+gzip-compressed CSV files, then detached and dropped.
+
+Usage:
+    python partitions.py migrate              # one-off conversion
+    python partitions.py maintain --keep-months 12 --archive-dir archive/
+
+Run `maintain` daily (e.g. from cron); it creates upcoming partitions and
+applies the retention policy. On other databases every command is a no-op.
+"""
+import argparse
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'telegram_messages'
+PARTITION_NAME = re.compile(rf'^{TABLE}_y(\d{{4}})m(\d{{2}})$')
+DEFAULT_PARTITION = f'{TABLE}_default'
+UNIQUE_INDEX = f'uq_{TABLE}_channel_message'
+
+# Partitions created ahead of the current month
+MONTHS_AHEAD = 2
+
+
+def add_months(day, months):
+    """First day of the month `months` after the month of `day`"""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{TABLE}_y{month.year:04d}m{month.month:02d}'
+
+
+def is_postgres(conn):
+    return conn.dialect.name == 'postgresql'
+
+
+def is_partitioned(conn):
+    """Whether telegram_messages already is a partitioned table"""
+    return bool(
+        conn.execute(
+            text("SELECT 1 FROM pg_partitioned_table p "
+                 "JOIN pg_class c ON c.oid = p.partrelid "
+                 "WHERE c.relname = :table"), {
+                     'table': TABLE
+                 }).scalar())
+
+
+def list_partitions(conn):
+    """Monthly partitions as (first day of month, table name), oldest first"""
+    names = conn.execute(
+        text("SELECT c.relname FROM pg_inherits i "
+             "JOIN pg_class c ON c.oid = i.inhrelid "
+             "JOIN pg_class p ON p.oid = i.inhparent "
+             "WHERE p.relname = :table"), {
+                 'table': TABLE
+             }).scalars()
+    partitions = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions.append((date(int(match[1]), int(match[2]), 1), name))
+    return sorted(partitions)
+
+
+def create_unique_index(conn):
+    """Index keeping one row per message, including the partition key
+
+    Unique indexes of a partitioned table must contain the partition key, so
+    a message is unique per (channel_id, message_id, timestamp) here.
+    """
+    conn.execute(
+        text(f"CREATE UNIQUE INDEX IF NOT EXISTS {UNIQUE_INDEX} "
+             f"ON {TABLE} (channel_id, message_id, timestamp)"))
+
+
+def has_unique_index(conn):
+    """Whether the unique message index exists; duplicates can prevent it"""
+    if is_postgres(conn):
+        # Also lists the index of a partitioned table
+        query = ("SELECT 1 FROM pg_indexes "
+                 "WHERE tablename = :table AND indexname = :index")
+    else:
+        query = ("SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                 "AND tbl_name = :table AND name = :index")
+    return bool(conn.execute(text(query), {
+        'table': TABLE,
+        'index': UNIQUE_INDEX
+    }).scalar())
+
+
+def create_partition(conn, month):
+    """Create the partition holding `month` unless it exists"""
+    name = partition_name(month)
+    conn.execute(
+        text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TABLE} "
+             f"FOR VALUES FROM ('{month.isoformat()}') "
+             f"TO ('{add_months(month, 1).isoformat()}')"))
+    return name
+
+
+def ensure_partitions(conn, months_ahead=MONTHS_AHEAD, today=None):
+    """Create partitions for the current and the next few months"""
+    current = (today or date.today()).replace(day=1)
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        try:
+            with conn.begin_nested():
+                created.append(create_partition(conn, month))
+        except Exception as e:
+            # Usually rows for that month already sit in the default partition
+            logger.error(f"Could not create partition for {month:%Y-%m}: {str(e)}")
+    return created
+
+
+def migrate(conn):
+    """Convert a plain telegram_messages table into a partitioned one
+
+    Runs in the caller's transaction and copies every row, so schedule it in
+    a maintenance window on large tables.
+    """
+    if is_partitioned(conn):
+        logger.info(f"{TABLE} is already partitioned")
+        return False
+
+    legacy = f'{TABLE}_legacy'
+    conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {legacy}"))
+    conn.execute(
+        text(f"ALTER TABLE {legacy} RENAME CONSTRAINT {TABLE}_pkey TO {legacy}_pkey"))
+    # Index names are schema-wide, free them for the partitioned table
+    for index in (f'ix_{TABLE}_timestamp', f'ix_{TABLE}_channel_message',
+                  UNIQUE_INDEX):
+        conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+    # The partition key has to be part of the primary key
+    conn.execute(
+        text(f"CREATE TABLE {TABLE} (LIKE {legacy} INCLUDING DEFAULTS) "
+             f"PARTITION BY RANGE (timestamp)"))
+    conn.execute(text(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, timestamp)"))
+    conn.execute(
+        text(f"CREATE INDEX IF NOT EXISTS ix_{TABLE}_timestamp ON {TABLE} (timestamp)"))
+    create_unique_index(conn)
+    conn.execute(
+        text(f"UPDATE {legacy} SET timestamp = now() WHERE timestamp IS NULL"))
+
+    first, last = conn.execute(
+        text(f"SELECT min(timestamp), max(timestamp) FROM {legacy}")).one()
+    month = (first or datetime.utcnow()).date().replace(day=1)
+    end = add_months((last or datetime.utcnow()).date(), MONTHS_AHEAD + 1)
+    while month < end:
+        create_partition(conn, month)
+        month = add_months(month, 1)
+    conn.execute(
+        text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} "
+             f"PARTITION OF {TABLE} DEFAULT"))
+
+    # Rows repeating a message and its timestamp are copied once
+    copied = conn.execute(
+        text(f"INSERT INTO {TABLE} SELECT * FROM {legacy} "
+             f"ORDER BY id ON CONFLICT DO NOTHING")).rowcount
+    # Keep the id sequence, which is owned by the legacy column
+    sequence = conn.execute(
+        text("SELECT pg_get_serial_sequence(:table, 'id')"), {
+            'table': legacy
+        }).scalar()
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id"))
+    conn.execute(text(f"DROP TABLE {legacy}"))
+    logger.info(f"Partitioned {TABLE}, copied {copied} rows")
+    return True
+
+
+def archive_partition(conn, name, archive_dir):
+    """Write a partition to `<archive_dir>/<name>.csv.gz` using COPY"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f'{name}.csv.gz')
+    cursor = conn.connection.cursor()
+    try:
+        with gzip.open(path, 'wb') as f:
+            cursor.copy_expert(f"COPY {name} TO STDOUT WITH CSV HEADER", f)
+    finally:
+        cursor.close()
+    return path
+
+
+def apply_retention(conn, keep_months, archive_dir=None, today=None):
+    """Archive, detach and drop partitions older than `keep_months`
+
+    The current month counts as the first kept month. Returns the names of
+    the dropped partitions.
+    """
+    cutoff = add_months((today or date.today()).replace(day=1), 1 - keep_months)
+    dropped = []
+    for month, name in list_partitions(conn):
+        if month >= cutoff:
+            break
+        if archive_dir:
+            path = archive_partition(conn, name, archive_dir)
+            logger.info(f"Archived {name} to {path}")
+        conn.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+        conn.execute(text(f"DROP TABLE {name}"))
+        dropped.append(name)
+        logger.info(f"Dropped partition {name}")
+    return dropped
+
+
+def maintain(conn, keep_months=None, archive_dir=None):
+    """Create upcoming partitions and apply the retention policy"""
+    if not is_postgres(conn) or not is_partitioned(conn):
+        logger.info(f"{TABLE} is not partitioned, nothing to maintain")
+        return [], []
+    created = ensure_partitions(conn)
+    dropped = []
+    if keep_months:
+        dropped = apply_retention(conn, keep_months, archive_dir)
+    return created, dropped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage telegram_messages partitions")
+    parser.add_argument('command', choices=['migrate', 'maintain'])
+    parser.add_argument('--keep-months', type=int,
+                        default=int(os.environ.get('MESSAGE_RETENTION_MONTHS', 0)),
+                        help="Months to keep including the current one, 0 keeps everything")
+    parser.add_argument('--archive-dir',
+                        default=os.environ.get('MESSAGE_ARCHIVE_DIR'),
+                        help="Write dropped partitions here as .csv.gz")
+    args = parser.parse_args(argv)
+
+    from app import app, db
+
+    with app.app_context():
+        with db.engine.begin() as conn:
+            if not is_postgres(conn):
+                logger.warning("Partitioning requires PostgreSQL, nothing to do")
+                return
+            if args.command == 'migrate':
+                migrate(conn)
+            else:
+                maintain(conn, args.keep_months, args.archive_dir)
+
+
+if __name__ == "__main__":
+    main()
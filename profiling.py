@@ -0,0 +1,186 @@
+"""SQL profiling for web requests and collector cycles.
+
+Cursor events on every SQLAlchemy engine time each statement. While a
+profile is active (a request with SQL_PROFILING or debug mode on, or a
+collection cycle with SQL_PROFILING on) statements are counted per profile;
+when it ends, identical statements repeated N_PLUS_ONE_THRESHOLD times or
+more are logged as a likely N+1 pattern. Requests in debug mode also get
+X-DB-Queries, X-DB-Time-Ms and X-DB-Slowest response headers.
+
+Independently of profiles, a sample of statements slower than SLOW_QUERY_MS
+is logged together with the database's EXPLAIN output.
+"""
+import contextlib
+import contextvars
+import heapq
+import logging
+import random
+import time
+from collections import Counter
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Slowest statements kept per profile
+SLOWEST_KEPT = 3
+
+# Statement length kept in headers and log lines
+STATEMENT_PREVIEW = 200
+
+_current = contextvars.ContextVar('sql_profile', default=None)
+_installed = False
+
+
+def _preview(statement):
+    return ' '.join(statement.split())[:STATEMENT_PREVIEW]
+
+
+class QueryProfile:
+    """Statements executed during one request or collection cycle"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = Counter()
+        self._slowest = []  # min-heap of (duration, sequence, statement)
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        self.statements[statement] += 1
+        entry = (duration, self.count, statement)
+        if len(self._slowest) < SLOWEST_KEPT:
+            heapq.heappush(self._slowest, entry)
+        elif duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self):
+        """(duration, statement) pairs, slowest first"""
+        return [(duration, statement)
+                for duration, _, statement in sorted(self._slowest, reverse=True)]
+
+    def repeated(self, threshold):
+        """(statement, count) pairs executed at least `threshold` times"""
+        return [(statement, count)
+                for statement, count in self.statements.most_common()
+                if count >= threshold]
+
+
+def begin(name):
+    """Start profiling statements of the current context"""
+    profile = QueryProfile(name)
+    _current.set(profile)
+    return profile
+
+
+def end():
+    """Stop profiling the current context and report repeated statements"""
+    profile = _current.get()
+    _current.set(None)
+    if profile is not None:
+        for statement, count in profile.repeated(Config.N_PLUS_ONE_THRESHOLD):
+            logger.warning("Possible N+1 in %s: statement ran %d times: %s",
+                           profile.name, count, _preview(statement))
+    return profile
+
+
+@contextlib.contextmanager
+def profile(name):
+    """Profile statements executed inside the block"""
+    profile = begin(name)
+    try:
+        yield profile
+    finally:
+        end()
+
+
+def _explain(conn, statement, parameters):
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    # A raw DBAPI cursor, so the EXPLAIN does not go through these hooks
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return '\n'.join(' '.join(str(col) for col in row)
+                         for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info['query_started'].pop()
+    duration = time.perf_counter() - started
+
+    profile = _current.get()
+    if profile is not None:
+        profile.record(statement, duration)
+
+    if Config.SLOW_QUERY_MS and duration * 1000 >= Config.SLOW_QUERY_MS and \
+            random.random() < Config.SLOW_QUERY_SAMPLE_RATE:
+        plan = None
+        # Only plain reads are explained; the statement just ran with the
+        # same parameters, so the EXPLAIN cannot fail on them
+        if not executemany and statement.lstrip()[:6].upper() == 'SELECT':
+            try:
+                plan = _explain(conn, statement, parameters)
+            except Exception as e:
+                plan = f"unavailable: {str(e)}"
+        logger.warning("Slow query (%.1f ms): %s\nPlan:\n%s", duration * 1000,
+                       _preview(statement), plan or 'n/a')
+
+
+def _handle_error(context):
+    # after_cursor_execute does not run for a failed statement
+    conn = context.connection
+    if conn is not None and conn.info.get('query_started'):
+        conn.info['query_started'].pop()
+
+
+def install():
+    """Attach the timing hooks to every SQLAlchemy engine"""
+    global _installed
+    if not _installed:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _installed = True
+
+
+def _start_request():
+    if Config.SQL_PROFILING or current_app.debug:
+        g.sql_profile = begin(f"request {request.method} {request.path}")
+
+
+def _add_headers(response):
+    profile = g.get('sql_profile')
+    if profile is not None and current_app.debug:
+        response.headers['X-DB-Queries'] = str(profile.count)
+        response.headers['X-DB-Time-Ms'] = f"{profile.total_time * 1000:.1f}"
+        for duration, statement in profile.slowest():
+            response.headers.add('X-DB-Slowest',
+                                 f"{duration * 1000:.1f}ms {_preview(statement)}")
+    return response
+
+
+def _end_request(exc):
+    if g.pop('sql_profile', None) is not None:
+        end()
+
+
+def init_app(app):
+    """Install the hooks and profile requests of `app`"""
+    install()
+    app.before_request(_start_request)
+    app.after_request(_add_headers)
+    app.teardown_request(_end_request)
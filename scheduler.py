@@ -0,0 +1,176 @@
+"""Adaptive per-dialog poll scheduling for the collector.
+
+Each dialog keeps an exponentially weighted moving average (EWMA) of the gap
+between its messages, seeded from stored timestamps and updated from every
+poll. The next poll is scheduled so that roughly a quarter of the tier's
+catch-up depth accumulates in between, bounded by the tier's minimum and base
+interval. Polls that find nothing back off exponentially up to the tier's
+maximum interval, and a poll that fills the whole catch-up window is treated
+as a burst and rescheduled at the minimum interval.
+
+Dialogs are kept in a heap keyed by next-due time, so finding the next dialog
+to poll and the time to sleep until then are both cheap.
+"""
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Weight given to the newest inter-arrival gap
+EWMA_ALPHA = 0.3
+
+# Multiplier applied to the interval after an empty poll
+BACKOFF_FACTOR = 2.0
+
+# Share of the catch-up depth we aim to fetch per poll
+TARGET_FILL = 0.25
+
+
+def _to_seconds(value):
+    """Accept datetimes or plain epoch seconds"""
+    return value.timestamp() if hasattr(value, 'timestamp') else float(value)
+
+
+class DialogSchedule:
+    """Scheduling state of a single dialog"""
+
+    def __init__(self, channel_id, tier, next_due):
+        self.channel_id = channel_id
+        self.tier = tier
+        self.interval = tier.poll_interval
+        self.next_due = next_due
+        self.gap = None  # EWMA of seconds between messages
+        self.last_message_at = None  # epoch seconds of the newest message seen
+
+    @property
+    def rate(self):
+        """Estimated messages per second"""
+        return 1.0 / self.gap if self.gap else 0.0
+
+    def observe(self, timestamps):
+        """Fold new message timestamps into the inter-arrival EWMA"""
+        for ts in sorted(_to_seconds(t) for t in timestamps):
+            if self.last_message_at is not None and ts >= self.last_message_at:
+                # Messages sent within the same second still count as a burst
+                gap = max(ts - self.last_message_at, 0.5)
+                if self.gap is None:
+                    self.gap = gap
+                else:
+                    self.gap = EWMA_ALPHA * gap + (1 - EWMA_ALPHA) * self.gap
+            if self.last_message_at is None or ts > self.last_message_at:
+                self.last_message_at = ts
+
+    def active_interval(self):
+        """Interval to use when the last poll returned new messages"""
+        if not self.gap:
+            return self.tier.poll_interval
+        target = self.gap * max(1.0, self.tier.catch_up_limit * TARGET_FILL)
+        return min(max(target, self.tier.min_interval), self.tier.poll_interval)
+
+
+class PollScheduler:
+    """Priority queue of dialogs keyed by their next poll time"""
+
+    def __init__(self):
+        self.dialogs = {}
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.dialogs)
+
+    def __contains__(self, channel_id):
+        return channel_id in self.dialogs
+
+    def _push(self, state):
+        heapq.heappush(self._heap,
+                       (state.next_due, next(self._counter), state.channel_id))
+
+    def register(self, channel_id, tier, now, timestamps=None):
+        """Add a dialog, or update its tier if it is already scheduled
+
+        New dialogs are due immediately. `timestamps` are stored message
+        dates used to seed the rate estimate.
+        """
+        state = self.dialogs.get(channel_id)
+        if state is not None:
+            if state.tier is not tier:
+                state.tier = tier
+                state.interval = tier.poll_interval
+                if state.next_due > now + tier.poll_interval:
+                    state.next_due = now + tier.poll_interval
+                    self._push(state)
+            return state
+
+        state = DialogSchedule(channel_id, tier, now)
+        if timestamps:
+            state.observe(timestamps)
+        self.dialogs[channel_id] = state
+        self._push(state)
+        return state
+
+    def remove(self, channel_id):
+        """Stop scheduling a dialog; its heap entries are dropped lazily"""
+        self.dialogs.pop(channel_id, None)
+
+    def _peek(self):
+        """Drop stale heap entries and return the live head, if any"""
+        while self._heap:
+            due, _, channel_id = self._heap[0]
+            state = self.dialogs.get(channel_id)
+            if state is not None and state.next_due == due:
+                return state
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now):
+        """Return the ids of all dialogs due at `now`, most overdue first"""
+        due = []
+        while True:
+            state = self._peek()
+            if state is None or state.next_due > now:
+                return due
+            heapq.heappop(self._heap)
+            due.append(state.channel_id)
+
+    def seconds_until_next(self, now, default=None):
+        """Seconds until the next dialog is due, never negative"""
+        state = self._peek()
+        if state is None:
+            return default
+        return max(state.next_due - now, 0.0)
+
+    def defer(self, channel_id, now, delay):
+        """Push a dialog back by `delay` seconds without touching its interval"""
+        state = self.dialogs.get(channel_id)
+        if state is None:
+            return
+        state.next_due = now + delay
+        self._push(state)
+
+    def record_poll(self, channel_id, timestamps, now, fetched=0):
+        """Reschedule a dialog after it was polled
+
+        `timestamps` are the dates of newly stored messages and `fetched` is
+        the number of messages Telegram returned for the poll.
+        """
+        state = self.dialogs.get(channel_id)
+        if state is None:
+            return None
+        tier = state.tier
+
+        if timestamps:
+            state.observe(timestamps)
+            if fetched >= tier.catch_up_limit:
+                # The whole catch-up window was new, we are likely behind
+                state.interval = tier.min_interval
+            else:
+                state.interval = state.active_interval()
+        else:
+            state.interval = min(state.interval * BACKOFF_FACTOR,
+                                 tier.max_interval)
+
+        state.next_due = now + state.interval
+        self._push(state)
+        return state.interval
@@ -0,0 +1,253 @@
+"""Collection scopes and priority tiers for the collector.
+
+Scopes decide which dialogs are collected and which priority tier they
+belong to. Tiers decide how often a dialog is polled and how many recent
+messages are requested per poll (catch-up depth). The poll interval is the
+base interval; the adaptive scheduler in scheduler.py moves each dialog
+between `min_interval` (bursts) and `max_interval` (quiet dialogs).
+
+Configuration is JSON, passed inline via COLLECTOR_SCOPES or as a file via
+COLLECTOR_SCOPES_FILE:
+
+    {
+        "tiers": {
+            "hot": {"poll_interval": 5, "catch_up_limit": 50, "min_interval": 2},
+            "default": {"poll_interval": 30, "catch_up_limit": 20},
+            "archived": {"poll_interval": 3600, "catch_up_limit": 200}
+        },
+        "deny": ["Spam Chat", "@some_bot"],
+        "scopes": [
+            {"tier": "hot", "folders": ["TON"]},
+            {"tier": "hot", "ton_dev_only": true},
+            {"tier": "archived", "archived": true},
+            {"tier": "default", "dialog_types": ["channel", "public_supergroup"]}
+        ],
+        "default_tier": "default"
+    }
+
+Scopes are evaluated in order and the first match wins. Dialogs matching no
+scope fall into `default_tier`, or are skipped when it is null. Without any
+configuration every dialog is collected every 30 seconds with a catch-up
+depth of 20, which is the collector's historical behaviour.
+"""
+import json
+import logging
+
+from utils import should_be_ton_dev, get_proper_dialog_type
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 30
+DEFAULT_CATCH_UP_LIMIT = 20
+
+# Default bounds of the adaptive interval relative to the base interval
+MIN_INTERVAL_DIVISOR = 6
+MAX_INTERVAL_FACTOR = 20
+
+
+class PriorityTier:
+    """Polling frequency and catch-up depth shared by a group of dialogs"""
+
+    def __init__(self, name, poll_interval=DEFAULT_POLL_INTERVAL,
+                 catch_up_limit=DEFAULT_CATCH_UP_LIMIT, min_interval=None,
+                 max_interval=None):
+        if poll_interval <= 0:
+            raise ValueError(f"Tier {name}: poll_interval must be positive")
+        if catch_up_limit <= 0:
+            raise ValueError(f"Tier {name}: catch_up_limit must be positive")
+        self.name = name
+        self.poll_interval = float(poll_interval)
+        self.catch_up_limit = int(catch_up_limit)
+
+        if min_interval is None:
+            min_interval = min(self.poll_interval,
+                               max(self.poll_interval / MIN_INTERVAL_DIVISOR, 1.0))
+        if max_interval is None:
+            max_interval = self.poll_interval * MAX_INTERVAL_FACTOR
+        if not 0 < min_interval <= self.poll_interval <= max_interval:
+            raise ValueError(
+                f"Tier {name}: expected min_interval <= poll_interval <= max_interval")
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+
+    def __repr__(self):
+        return (f"PriorityTier({self.name!r}, poll_interval={self.poll_interval}, "
+                f"catch_up_limit={self.catch_up_limit})")
+
+
+def _normalize_refs(refs):
+    """Split allow/deny entries into dialog ids, usernames and titles"""
+    ids, usernames, titles = set(), set(), set()
+    for ref in refs or []:
+        if isinstance(ref, int):
+            ids.add(str(ref))
+            continue
+        ref = str(ref).strip()
+        if ref.lstrip('-').isdigit():
+            ids.add(ref)
+        elif ref.startswith('@'):
+            usernames.add(ref[1:].lower())
+        elif ref:
+            titles.add(ref.lower())
+    return ids, usernames, titles
+
+
+def _dialog_matches_refs(dialog, refs):
+    ids, usernames, titles = refs
+    if str(getattr(dialog, 'id', '')) in ids:
+        return True
+    username = getattr(getattr(dialog, 'entity', None), 'username', None)
+    if username and username.lower() in usernames:
+        return True
+    title = getattr(dialog, 'title', None)
+    return bool(title) and title.lower() in titles
+
+
+class CollectionScope:
+    """A set of dialog filters mapped to a priority tier"""
+
+    def __init__(self, tier, folders=None, dialog_types=None, allow=None,
+                 deny=None, ton_dev_only=False, archived=None):
+        self.tier = tier
+        self.folders = {f.lower() for f in folders or []}
+        self.dialog_types = set(dialog_types or [])
+        self.allow = _normalize_refs(allow)
+        self.has_allow = bool(allow)
+        self.deny = _normalize_refs(deny)
+        self.ton_dev_only = ton_dev_only
+        self.archived = archived
+
+    def matches(self, dialog, dialog_type, folder_peers):
+        """Check whether a dialog belongs to this scope"""
+        if _dialog_matches_refs(dialog, self.deny):
+            return False
+        if self.has_allow and not _dialog_matches_refs(dialog, self.allow):
+            return False
+        if self.dialog_types and dialog_type not in self.dialog_types:
+            return False
+        if self.ton_dev_only and not should_be_ton_dev(
+                getattr(dialog, 'title', None)):
+            return False
+        if self.archived is not None and bool(
+                getattr(dialog, 'archived', False)) != self.archived:
+            return False
+        if self.folders:
+            dialog_id = getattr(dialog, 'id', None)
+            if not any(dialog_id in folder_peers.get(folder, ())
+                       for folder in self.folders):
+                return False
+        return True
+
+
+class ScopeConfig:
+    """Ordered collection scopes plus the tiers they reference"""
+
+    def __init__(self, tiers=None, scopes=None, deny=None,
+                 default_tier='default'):
+        self.tiers = tiers or {'default': PriorityTier('default')}
+        self.scopes = scopes or []
+        self.deny = _normalize_refs(deny)
+        self.default_tier = default_tier
+
+        for scope in self.scopes:
+            if scope.tier not in self.tiers:
+                raise ValueError(f"Scope references unknown tier: {scope.tier}")
+        if default_tier is not None and default_tier not in self.tiers:
+            raise ValueError(f"Unknown default tier: {default_tier}")
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a scope configuration from its parsed JSON form"""
+        tiers = {
+            name: PriorityTier(name, **(options or {}))
+            for name, options in (data.get('tiers') or {}).items()
+        }
+        if not tiers:
+            tiers = {'default': PriorityTier('default')}
+        scopes = [CollectionScope(**scope) for scope in data.get('scopes', [])]
+        return cls(tiers=tiers,
+                   scopes=scopes,
+                   deny=data.get('deny'),
+                   default_tier=data.get('default_tier', 'default'))
+
+    @classmethod
+    def load(cls, raw=None, path=None):
+        """Load the configuration from inline JSON or a file path"""
+        if path:
+            with open(path, encoding='utf-8') as f:
+                raw = f.read()
+        if not raw:
+            return cls()
+        return cls.from_dict(json.loads(raw))
+
+    @property
+    def folder_names(self):
+        """Folder titles referenced by any scope"""
+        names = set()
+        for scope in self.scopes:
+            names.update(scope.folders)
+        return names
+
+    @property
+    def min_poll_interval(self):
+        return min(tier.poll_interval for tier in self.tiers.values())
+
+    def classify(self, dialog, folder_peers=None, dialog_type=None):
+        """Return the tier for a dialog, or None if it is out of scope"""
+        if _dialog_matches_refs(dialog, self.deny):
+            return None
+        if dialog_type is None:
+            dialog_type = get_proper_dialog_type(getattr(dialog, 'entity', None))
+        folder_peers = folder_peers or {}
+        for scope in self.scopes:
+            if scope.matches(dialog, dialog_type, folder_peers):
+                return self.tiers[scope.tier]
+        if self.default_tier is None:
+            return None
+        return self.tiers[self.default_tier]
+
+
+def _filter_title(dialog_filter):
+    """Dialog filter titles are plain strings or TextWithEntities by layer"""
+    title = getattr(dialog_filter, 'title', '')
+    return getattr(title, 'text', title) or ''
+
+
+async def load_folder_peers(client, folder_names):
+    """Resolve folder titles to the set of dialog ids explicitly included
+
+    Only peers listed in the folder (included or pinned) are returned; the
+    folder's category flags such as "all groups" are better expressed with
+    `dialog_types` in the scope itself.
+    """
+    if not folder_names:
+        return {}
+
+    from telethon import functions, utils as tl_utils
+
+    result = await client(functions.messages.GetDialogFiltersRequest())
+    filters = getattr(result, 'filters', result)
+
+    folder_peers = {}
+    for dialog_filter in filters:
+        title = _filter_title(dialog_filter).lower()
+        if title not in folder_names:
+            continue
+        peers = set()
+        for peer in (list(getattr(dialog_filter, 'include_peers', [])) +
+                     list(getattr(dialog_filter, 'pinned_peers', []))):
+            try:
+                peers.add(tl_utils.get_peer_id(peer))
+            except Exception as e:
+                logger.warning(f"Could not resolve folder peer {peer}: {str(e)}")
+        for peer in getattr(dialog_filter, 'exclude_peers', []):
+            try:
+                peers.discard(tl_utils.get_peer_id(peer))
+            except Exception:
+                pass
+        folder_peers[title] = peers
+
+    missing = folder_names - set(folder_peers)
+    if missing:
+        logger.warning(f"Folders not found in account: {', '.join(sorted(missing))}")
+    return folder_peers
@@ -0,0 +1,210 @@
+"""Durable local spool of collector writes, for database outages.
+
+Without it, a batch the database refuses is retried three times and
+dropped, and the collector stops until the database is back. With
+SPOOL_DIR set, the store (async_db.py) appends every insert, edit and
+deletion to this spool first, fsynced, and treats it as accepted; the spool
+is then replayed into the database in order, right away while the database
+is healthy and with a growing back-off while it is not.
+
+The spool is a directory of numbered, append-only segment files. Each
+record is a JSON document framed by its length and CRC32, so a record torn
+by a crash or damaged on disk is detected and never replayed. The active
+segment rotates once it reaches SPOOL_SEGMENT_BYTES. `checkpoint` names
+the first record not known to be committed; the store advances it after
+each commit, and segments before it are deleted. Once everything is
+replayed the active segment is retired too, so an idle spool is one empty
+file.
+
+A record can be replayed twice when the collector dies between a commit
+and the checkpoint; the store skips messages already stored.
+"""
+import json
+import logging
+import os
+import struct
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Payload length and CRC32 of each record
+HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT_FILE = 'checkpoint'
+
+# Newest spooled message of a channel, shaped like a latest_message row
+Mark = namedtuple('Mark', 'message_id timestamp')
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError(f"Cannot spool {type(value).__name__}")
+
+
+def _object_hook(value):
+    if len(value) == 1 and '$dt' in value:
+        return datetime.fromisoformat(value['$dt'])
+    return value
+
+
+def encode(record):
+    """Framed record: header, then the record as JSON"""
+    payload = json.dumps(record, default=_default,
+                         separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode(data, offset=0):
+    """Intact records of `data` from `offset`, as (end offset, record)
+
+    Stops at the first record that is incomplete or fails its checksum.
+    """
+    while offset + HEADER.size <= len(data):
+        length, checksum = HEADER.unpack_from(data, offset)
+        start, end = offset + HEADER.size, offset + HEADER.size + length
+        payload = data[start:end]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        yield end, json.loads(payload, object_hook=_object_hook)
+        offset = end
+
+
+class Spool:
+    """Append-only segment files with a checkpoint of the applied prefix
+
+    Positions are (segment number, byte offset) pairs.
+    """
+
+    def __init__(self, directory, segment_bytes=None, fsync=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes or Config.SPOOL_SEGMENT_BYTES
+        self.fsync = Config.SPOOL_FSYNC if fsync is None else fsync
+        os.makedirs(directory, exist_ok=True)
+        # Committed position, and position of the records applied since
+        self.committed = self._read_checkpoint()
+        self.position = self.committed
+        self.pending = 0
+        self._unsaved = 0
+        self.high_water = {}
+        self._file = None
+        self._recover()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:010d}{SEGMENT_SUFFIX}")
+
+    def segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                      for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                state = json.load(f)
+            return state['segment'], state['offset']
+        except FileNotFoundError:
+            return 1, 0
+
+    def _recover(self):
+        """Count unapplied records and cut a torn tail off the last segment"""
+        segments = [segment for segment in self.segments()
+                    if segment >= self.committed[0]]
+        for segment in segments:
+            start = self.committed[1] if segment == self.committed[0] else 0
+            with open(self._path(segment), 'rb') as f:
+                data = f.read()
+            end = start
+            for end, record in decode(data, start):
+                self._count(record)
+            if end < len(data):
+                if segment == segments[-1]:
+                    logger.warning("Dropping %d torn bytes at the end of spool "
+                                   "segment %d", len(data) - end, segment)
+                    with open(self._path(segment), 'r+b') as f:
+                        f.truncate(end)
+                else:
+                    logger.error("Spool segment %d is damaged after byte %d; "
+                                 "the rest of it is skipped", segment, end)
+        self._open(segments[-1] if segments else self.committed[0])
+        if self.pending:
+            logger.info("Spool has %d writes to replay", self.pending)
+
+    def _open(self, segment):
+        if self._file is not None:
+            self._file.close()
+        self.segment = segment
+        self._file = open(self._path(segment), 'ab')
+
+    def _count(self, record):
+        self.pending += 1
+        for row in record.get('rows', ()):
+            mark = self.high_water.get(row['channel_id'])
+            if mark is None or row['message_id'] > mark.message_id:
+                self.high_water[row['channel_id']] = Mark(row['message_id'],
+                                                          row['timestamp'])
+
+    def append(self, record):
+        """Write a record durably; returns once it survives a crash"""
+        self._file.write(encode(record))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._count(record)
+        if self._file.tell() >= self.segment_bytes:
+            self._open(self.segment + 1)
+
+    def unapplied(self):
+        """(position after, record) of records not applied yet, in order"""
+        for segment in self.segments():
+            if segment < self.position[0]:
+                continue
+            start = self.position[1] if segment == self.position[0] else 0
+            with open(self._path(segment), 'rb') as f:
+                data = f.read()
+            for end, record in decode(data, start):
+                yield (segment, end), record
+
+    def advance(self, position):
+        """Records up to `position` are applied, not yet committed"""
+        self.position = position
+        self.pending -= 1
+        self._unsaved += 1
+
+    def rewind(self):
+        """The records applied since the last checkpoint were rolled back"""
+        self.position = self.committed
+        self.pending += self._unsaved
+        self._unsaved = 0
+
+    def checkpoint(self):
+        """Persist the applied position and delete replayed segments"""
+        if self.position == self.committed:
+            return
+        if not self.pending and self.position[0] == self.segment and \
+                self.position[1] == self._file.tell():
+            # Fully replayed: retire the active segment too
+            self._open(self.segment + 1)
+            self.position = (self.segment, 0)
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'segment': self.position[0],
+                       'offset': self.position[1]}, f)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.committed = self.position
+        self._unsaved = 0
+        for segment in self.segments():
+            if segment < self.committed[0]:
+                os.remove(self._path(segment))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,76 @@
+"""SQLite backend profile for single-node deployments.
+
+With a local SQLite file there is no network round trip per statement, but
+the defaults (rollback journal, full fsync per commit, a small page cache)
+waste that. Every SQLite engine here therefore gets:
+
+- WAL journal, so readers never block the writer and vice versa
+- synchronous=NORMAL, which is durable across application crashes in WAL
+  mode and only fsyncs on checkpoints
+- a larger page cache, memory-mapped reads and in-memory temp tables
+- a busy timeout instead of immediate "database is locked" errors
+
+The web tier reads through a separate `replica_local` pool on the same file
+whose connections are query_only (routed like a replica, see
+db_routing.py), and the collector writes through a single connection that
+batches many dialogs into one transaction (see async_db.py).
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from config import Config
+
+READER_BIND = 'replica_local'
+
+
+def is_sqlite_file(url):
+    """True for SQLite URLs naming a file rather than an in-memory database"""
+    if not url:
+        return False
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database not in (
+        None, '', ':memory:')
+
+
+def pragmas(read_only=False):
+    statements = [
+        f"PRAGMA busy_timeout = {Config.SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA cache_size = -{Config.SQLITE_CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size = {Config.SQLITE_MMAP_SIZE}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+    if read_only:
+        statements.append("PRAGMA query_only = ON")
+    else:
+        statements += [
+            "PRAGMA journal_mode = WAL",
+            "PRAGMA synchronous = NORMAL",
+        ]
+    return statements
+
+
+def install_pragmas(engine, read_only=False):
+    """Apply the profile to every new connection of a (sync) engine"""
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in pragmas(read_only):
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+
+def reader_binds(url, engine_options):
+    """A query_only reader pool on the primary file, for read-only routes"""
+    if not is_sqlite_file(url):
+        return {}
+    return {READER_BIND: {'url': url, **engine_options}}
+
+
+def configure_engines(engines):
+    """Install the profile on the SQLite file engines of a Flask-SQLAlchemy app"""
+    for key, engine in engines.items():
+        if is_sqlite_file(engine.url):
+            install_pragmas(engine, read_only=key == READER_BIND)
@@ -1,13 +1,13 @@
 import asyncio
 import logging
 from telethon import TelegramClient, events
-from telethon.tl.types import Channel, Folder
+from telethon.tl.types import Channel
 from app import db
 from models import TelegramMessage
 from config import Config
+from scopes import load_folder_peers
+from utils import sender_info
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 class TelegramCollector:
@@ -22,9 +22,11 @@ class TelegramCollector:
     async def get_channels_from_folder(self):
         """Get all channels from the specified folder."""
         try:
+            folder = Config.TARGET_FOLDER.lower()
+            folder_peers = await load_folder_peers(self.client, {folder})
             dialogs = await self.client.get_dialogs()
             for dialog in dialogs:
-                if dialog.folder and dialog.folder.title == Config.TARGET_FOLDER:
+                if dialog.id in folder_peers.get(folder, ()):
                     if isinstance(dialog.entity, Channel):
                         self.target_channels.add(dialog.entity)
                         logger.info(f"Found channel in target folder: {dialog.entity.title}")
@@ -92,13 +94,15 @@ class TelegramCollector:
             async for message in self.client.iter_messages(channel, limit=limit):
                 try:
                     if message.text:  # Only store messages with text content
-                        sender = await message.get_sender()
+                        # Read from the message, unlike get_sender() this
+                        # never hits the network; names go to `senders`
+                        # through the collector's store
+                        sender = sender_info(message)
                         db_message = TelegramMessage(
                             message_id=message.id,
                             channel_id=str(channel.id),
                             channel_title=channel.title if isinstance(channel, Channel) else None,
-                            sender_id=str(sender.id) if sender else None,
-                            sender_username=sender.username if sender else None,
+                            sender_id=sender['id'] if sender else None,
                             content=message.text,
                             timestamp=message.date
                         )
@@ -0,0 +1,189 @@
+"""Shared event loop and Telegram client for web requests.
+
+Session setup used to create a new event loop and a new TelegramClient
+connection in every request, and verification even requested a second code.
+The gateway instead runs one event loop in a background thread for the whole
+process. Requests hand it coroutines and await the result (`call`, from
+async views) or wait on the returned future (`run`), so no request builds
+its own client loop, and the client that requested the login code stays
+connected until the code is verified.
+
+The pending phone number and phone_code_hash are also written next to the
+session file, so a different worker process can finish the sign-in.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds a request waits for a Telegram call to finish
+REQUEST_TIMEOUT = 60
+
+# Seconds allowed for connecting to Telegram
+CONNECT_TIMEOUT = 30
+
+
+def session_path():
+    """The collector's Telethon session, in Replit's persistent storage"""
+    return os.path.join(os.environ.get('REPL_HOME', ''),
+                        'ton_collector_session.session')
+
+
+class SetupError(Exception):
+    """Session setup cannot continue, the message is safe to show"""
+
+
+class TelegramGateway:
+    """One background event loop and one setup client per process"""
+
+    def __init__(self, client_factory=None, path=session_path):
+        self._client_factory = client_factory or self._make_client
+        self._path = path
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.client = None
+        self._pending = None  # phone, phone_code_hash, password_needed
+
+    @staticmethod
+    def _make_client(path):
+        from telethon import TelegramClient
+        api_id = int(os.environ.get('TELEGRAM_API_ID', 0) or 0)
+        api_hash = os.environ.get('TELEGRAM_API_HASH', '')
+        if not api_id or not api_hash:
+            raise SetupError("Missing API credentials")
+        return TelegramClient(path, api_id=api_id, api_hash=api_hash)
+
+    @property
+    def loop(self):
+        """The gateway's event loop, started on first use"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                name='telegram-gateway',
+                                                daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the gateway loop, returning a future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def call(self, coro, timeout=REQUEST_TIMEOUT):
+        """Run a coroutine on the gateway loop and await its result
+
+        For async views: the caller's loop is free while Telegram answers.
+        """
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(coro)),
+                                      timeout)
+
+    def run(self, coro, timeout=REQUEST_TIMEOUT):
+        """Run a coroutine on the gateway loop and wait for its result"""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def _pending_path(self):
+        return self._path() + '.pending.json'
+
+    def _save_pending(self, phone, phone_code_hash, password_needed=False):
+        self._pending = {
+            'phone': phone,
+            'phone_code_hash': phone_code_hash,
+            'password_needed': password_needed,
+        }
+        with open(self._pending_path(), 'w') as f:
+            json.dump(self._pending, f)
+
+    def _load_pending(self):
+        if self._pending is None and os.path.exists(self._pending_path()):
+            with open(self._pending_path()) as f:
+                self._pending = json.load(f)
+        return self._pending
+
+    def _clear_pending(self):
+        self._pending = None
+        if os.path.exists(self._pending_path()):
+            os.remove(self._pending_path())
+
+    async def _connect(self):
+        if self.client is None:
+            self.client = self._client_factory(self._path())
+        if not self.client.is_connected():
+            await asyncio.wait_for(self.client.connect(), CONNECT_TIMEOUT)
+        return self.client
+
+    async def release(self):
+        """Disconnect the setup client so the collector can use the session"""
+        client, self.client = self.client, None
+        if client is not None:
+            await client.disconnect()
+
+    async def send_code(self, phone):
+        """Start a login on a fresh session
+
+        Returns "code_sent", or "authorized" if the session needs no login.
+        """
+        if not phone.startswith('+'):
+            phone = '+' + phone
+        await self.release()
+        self._clear_pending()
+        if os.path.exists(self._path()):
+            os.remove(self._path())
+            logger.info("Removed existing session file for clean start")
+
+        client = await self._connect()
+        if await client.is_user_authorized():
+            await self.release()
+            return 'authorized'
+
+        sent = await client.send_code_request(phone)
+        self._save_pending(phone, sent.phone_code_hash)
+        logger.info("Verification code sent")
+        return 'code_sent'
+
+    async def sign_in(self, code, password=None):
+        """Finish the login started by `send_code`
+
+        `password` is the two-step verification password, if enabled.
+        Returns whether the session is authorized.
+        """
+        from telethon import errors
+
+        client = await self._connect()
+        if not await client.is_user_authorized():
+            pending = self._load_pending()
+            if pending is None:
+                raise SetupError("No verification code was requested")
+            try:
+                # The code is accepted only once; after that only the
+                # two-step password is missing
+                if not pending['password_needed']:
+                    await client.sign_in(pending['phone'], code,
+                                         phone_code_hash=pending['phone_code_hash'])
+            except errors.SessionPasswordNeededError:
+                self._save_pending(pending['phone'], pending['phone_code_hash'],
+                                   password_needed=True)
+            if not await client.is_user_authorized():
+                if not self._pending['password_needed']:
+                    return False
+                if not password:
+                    raise SetupError("Two-step verification password required")
+                await client.sign_in(password=password)
+
+        authorized = await client.is_user_authorized()
+        if authorized:
+            self._clear_pending()
+            # The collector opens the session with its own client
+            await self.release()
+        return authorized
+
+
+gateway = TelegramGateway()
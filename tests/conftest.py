@@ -0,0 +1,71 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+# app.py reads DATABASE_URL at import time; default to a throwaway SQLite file
+os.environ.setdefault(
+    'DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='tgcache-tests-'), 'test.db'))
+# Collectors started by tests spool to a temporary directory too
+os.environ.setdefault('SPOOL_DIR', tempfile.mkdtemp(prefix='tgcache-spool-'))
+
+API_KEY = 'secret'
+
+
+@pytest.fixture
+def client():
+    """Test client of a fresh database, sending a valid API key
+
+    Requests passing their own X-API-Key header override it.
+    """
+    import main  # noqa: F401  registers the routes
+    from app import app, db
+    from models import ApiKey
+
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        db.session.add(ApiKey(key=API_KEY, name='test'))
+        db.session.commit()
+        client = app.test_client()
+        client.environ_base['HTTP_X_API_KEY'] = API_KEY
+        yield client
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest_asyncio.fixture
+async def store():
+    from async_db import CollectorStore
+
+    store = CollectorStore.from_url()
+    yield store
+    await store.close()
+
+
+def build_rows(channel, contents, start=datetime(2025, 3, 1), first=1,
+               step=timedelta(minutes=1), **columns):
+    """Message rows as the collector stores them, one per content
+
+    Message ids count up from `first` and timestamps by `step` from `start`;
+    `columns` are set on every row.
+    """
+    return [dict({
+        'message_id': first + i,
+        'channel_id': channel,
+        'channel_title': f"Channel {channel}",
+        'content': content,
+        'timestamp': start + step * i,
+        'is_ton_dev': False,
+        'is_outgoing': False,
+        'dialog_type': 'channel',
+    }, **columns) for i, content in enumerate(contents)]
+
+
+@pytest.fixture
+def rows():
+    """The `build_rows` message row factory"""
+    return build_rows
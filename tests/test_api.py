@@ -0,0 +1,74 @@
+import json
+import pytest
+from datetime import datetime, timedelta
+from models import TelegramMessage
+from app import db
+from api import serialization
+
+@pytest.fixture
+def client(client):
+    start = datetime(2025, 3, 1)
+    for i in range(25):
+        db.session.add(
+            TelegramMessage(message_id=i + 1,
+                            channel_id="1" if i % 2 else "2",
+                            channel_title="TON Dev Chat" if i % 2 else "News",
+                            content=f"Message {i} — wallet" if i % 5 == 0
+                            else f"Message {i}",
+                            timestamp=start + timedelta(hours=i),
+                            is_ton_dev=bool(i % 2)))
+    db.session.commit()
+    return client
+
+
+def test_messages_page(client):
+    response = client.get('/api/messages?per_page=10&page=2')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    data = response.get_json()
+    assert (data['total'], data['pages'], data['current_page']) == (25, 3, 2)
+    assert [m['message_id'] for m in data['messages']] == list(range(15, 5, -1))
+    assert set(data['messages'][0]) == set(serialization.MESSAGE_FIELDS)
+    assert data['messages'][0]['timestamp'] == '2025-03-01T14:00:00'
+
+
+def test_sparse_fieldsets(client):
+    data = client.get(
+        '/api/messages?channel=News&fields=message_id,content').get_json()
+    assert data['total'] == 13
+    assert data['messages'][0] == {'message_id': 25, 'content': 'Message 24'}
+
+    data = client.get('/api/messages?exclude=content').get_json()
+    assert 'content' not in data['messages'][0]
+    assert 'channel_title' in data['messages'][0]
+
+    response = client.get('/api/messages?fields=id,secret')
+    assert response.status_code == 400
+    assert 'secret' in response.get_json()['error']
+
+
+def test_search(client):
+    response = client.get('/api/search?q=wallet&fields=message_id,content')
+    assert response.status_code == 200
+    data = json.loads(response.get_data())
+    assert [m['message_id'] for m in data['messages']] == [21, 16, 11, 6, 1]
+    assert data['messages'][-1]['content'] == 'Message 0 — wallet'
+
+
+def test_msgpack_negotiation(client):
+    response = client.get('/api/messages?fields=id',
+                          headers={'Accept': 'application/msgpack'})
+    if serialization.msgpack is None:
+        assert response.status_code == 406
+        return
+    assert response.mimetype == 'application/msgpack'
+    data = serialization.msgpack.unpackb(response.get_data())
+    assert data['total'] == 25
+
+
+def test_stdlib_encoder_matches_orjson(monkeypatch):
+    payload = {'timestamp': datetime(2025, 3, 1, 12, 30, 5, 120),
+               'content': 'привет', 'is_ton_dev': True, 'id': None}
+    expected = serialization.dumps_json(payload)
+    monkeypatch.setattr(serialization, 'orjson', None)
+    assert json.loads(serialization.dumps_json(payload)) == json.loads(expected)
@@ -0,0 +1,104 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import app, db
+from async_db import async_database_url
+from models import TelegramMessage
+
+
+@pytest.fixture
+def test_app():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_async_database_url():
+    url = async_database_url('postgres://u:p@db/tg?sslmode=require')
+    assert url.drivername == 'postgresql+asyncpg'
+    assert url.query == {'ssl': 'require'}
+    assert async_database_url('postgresql+psycopg2://db/tg').drivername == \
+        'postgresql+asyncpg'
+    assert async_database_url('sqlite:///x.db').drivername == 'sqlite+aiosqlite'
+    with pytest.raises(ValueError):
+        async_database_url('oracle://db/tg')
+
+
+def texts(count):
+    return [f"message {i}" for i in range(1, count + 1)]
+
+
+@pytest.mark.asyncio
+async def test_bulk_insert_and_reads(test_app, store, rows):
+    start = datetime.utcnow() - timedelta(days=1)
+    assert await store.insert_messages(rows('a', texts(30), start)) == 30
+    await store.insert_messages(rows('b', texts(3), start))
+    # Outside the hot window, ignored for rate seeds
+    await store.insert_messages(rows('c', texts(3),
+                                     start - timedelta(days=30)))
+
+    latest = await store.latest_message('a')
+    assert latest.message_id == 30
+    assert await store.latest_message('missing') is None
+
+    seeds = await store.recent_timestamps(['a', 'b', 'c'], 20)
+    assert set(seeds) == {'a', 'b'}
+    assert len(seeds['a']) == 20 and len(seeds['b']) == 3
+    assert min(seeds['a']) == start + timedelta(minutes=10)
+
+    # The web app's session sees the committed rows
+    await store.commit()
+    assert TelegramMessage.query.count() == 36
+
+
+@pytest.mark.asyncio
+async def test_sqlite_writes_are_batched(test_app, store, rows,
+                                         monkeypatch):
+    assert store.batch_rows
+    monkeypatch.setattr(store, 'batch_rows', 50)
+    start = datetime.utcnow()
+
+    await store.insert_messages(rows('a', texts(30), start))
+    # Visible to the collector, not yet to other connections
+    assert (await store.latest_message('a')).message_id == 30
+    assert TelegramMessage.query.count() == 0
+
+    await store.insert_messages(rows('b', texts(30), start))
+    assert TelegramMessage.query.count() == 60
+
+    await store.insert_messages(rows('c', texts(5), start))
+    await store.save_heartbeat('collector', {'cycle': 1}, [])
+    assert TelegramMessage.query.count() == 65
+
+
+@pytest.mark.asyncio
+async def test_handlers_share_the_batch_session(test_app, store, rows):
+    start = datetime.utcnow()
+    await store.insert_messages(rows('a', texts(20), start))
+    # Change handlers run as tasks of their own, next to the cycle
+    await asyncio.gather(
+        store.insert_messages(rows('b', texts(20), start)),
+        store.edit_messages([{'channel_id': 'a', 'message_id': i,
+                              'content': 'edited', 'edit_date': start}
+                             for i in range(1, 11)]),
+        store.delete_messages('a', list(range(11, 21))),
+        store.latest_message('b'),
+        store.commit())
+    await store.commit()
+
+    assert TelegramMessage.query.count() == 30
+    assert TelegramMessage.query.filter_by(content='edited').count() == 10
+
+
+def test_sqlite_pragmas(test_app):
+    from sqlite_profile import READER_BIND
+    with db.engines[None].connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == 'wal'
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+    with db.engines[READER_BIND].connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA query_only").scalar() == 1
@@ -0,0 +1,133 @@
+from datetime import datetime
+
+import pytest
+
+import bodies
+from app import db
+from config import Config
+from models import BodySighting, MessageBody, TelegramMessage
+
+ANNOUNCEMENT = ("New TON release is out, upgrade your nodes before the next "
+                "validation round. Details: https://ton.org/news #ton")
+
+
+async def store_rows(store, batch):
+    await store.insert_messages(batch)
+    await store.commit()
+
+
+@pytest.mark.asyncio
+async def test_long_bodies_are_stored_once(client, store, rows):
+    await store_rows(store, rows('1', [ANNOUNCEMENT, ANNOUNCEMENT, 'short']))
+    await store_rows(store, rows('2', [ANNOUNCEMENT]))
+    await store_rows(store, rows('3', [ANNOUNCEMENT]))
+
+    body = db.session.get(MessageBody, bodies.body_hash(ANNOUNCEMENT))
+    assert body.text == ANNOUNCEMENT
+    assert (body.message_count, body.chat_count) == (4, 3)
+    assert (body.first_channel_id, body.first_message_id) == ('1', 1)
+    assert BodySighting.query.count() == 3
+
+    messages = TelegramMessage.query.order_by(TelegramMessage.id).all()
+    assert [m.content for m in messages] == [None, None, 'short', None, None]
+    assert all(m.text == ANNOUNCEMENT for m in messages if m.body_hash)
+    assert messages[2].body_hash is None
+
+
+@pytest.mark.asyncio
+async def test_api_reads_through_bodies(client, store, rows):
+    await store_rows(store, rows('1', [ANNOUNCEMENT, 'short']))
+    await store_rows(store, rows('2', [ANNOUNCEMENT]))
+
+    data = client.get(
+        '/api/messages?channel=Channel 1&fields=content,seen_in').get_json()
+    assert {(m['content'], m['seen_in']) for m in data['messages']} == \
+        {(ANNOUNCEMENT, 2), ('short', 1)}
+
+    digest = bodies.body_hash(ANNOUNCEMENT)
+    data = client.get(
+        f'/api/messages?body_hash={digest}&fields=channel_id').get_json()
+    assert data['total'] == 2
+    assert sorted(m['channel_id'] for m in data['messages']) == ['1', '2']
+
+    found = client.get('/api/search?q=validation round').get_json()['messages']
+    assert len(found) == 2
+
+    duplicates = client.get('/api/duplicates').get_json()['bodies']
+    assert [(d['hash'], d['seen_in'], d['content']) for d in duplicates] == \
+        [(digest, 2, ANNOUNCEMENT)]
+    assert client.get('/api/duplicates?min_chats=3').get_json()['bodies'] == []
+
+
+@pytest.mark.asyncio
+async def test_edits_and_deletes_release_bodies(client, store, rows):
+    await store_rows(store, rows('1', [ANNOUNCEMENT, ANNOUNCEMENT]))
+    await store_rows(store, rows('2', [ANNOUNCEMENT]))
+    digest = bodies.body_hash(ANNOUNCEMENT)
+
+    await store.edit_messages([{'channel_id': '2', 'message_id': 1,
+                                'content': 'edited',
+                                'edit_date': datetime(2025, 3, 2)}])
+    await store.delete_messages('1', [1])
+    await store.commit()
+
+    body = db.session.get(MessageBody, digest)
+    db.session.refresh(body)
+    assert (body.message_count, body.chat_count) == (1, 1)
+    assert [s.channel_id for s in BodySighting.query] == ['1']
+
+
+@pytest.mark.asyncio
+async def test_dashboard_shows_shared_bodies(client, store, rows):
+    await store_rows(store, rows('1', [ANNOUNCEMENT], start=datetime.utcnow()))
+    assert ANNOUNCEMENT in client.get('/').get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_retried_batch_keeps_content(client, store, rows):
+    batch = rows('1', [ANNOUNCEMENT])
+    await store_rows(store, batch)
+    # The caller's rows are not rewritten, so a retry stores the text again
+    assert batch[0]['content'] == ANNOUNCEMENT
+
+
+@pytest.mark.asyncio
+async def test_dedup_can_be_disabled(client, store, monkeypatch, rows):
+    monkeypatch.setattr(Config, 'CONTENT_DEDUP', False)
+    await store_rows(store, rows('1', [ANNOUNCEMENT]))
+    assert TelegramMessage.query.one().content == ANNOUNCEMENT
+    assert MessageBody.query.count() == 0
+
+
+def test_plan_counts_new_and_known_bodies(rows):
+    digest = bodies.body_hash(ANNOUNCEMENT)
+    batch = rows('1', [ANNOUNCEMENT, ANNOUNCEMENT]) + rows('2', [ANNOUNCEMENT])
+    now = datetime(2025, 3, 2)
+
+    new, sightings, increments = bodies.plan(
+        [dict(row) for row in batch], bodies.shareable(batch), set(), set(), now)
+    assert [(b['message_count'], b['chat_count']) for b in new] == [(3, 2)]
+    assert len(sightings) == 2 and increments == []
+
+    new, sightings, increments = bodies.plan(
+        batch, bodies.shareable(batch), {digest}, {(digest, '1')}, now)
+    assert new == [] and [s['channel_id'] for s in sightings] == ['2']
+    assert increments == [{'message_count': 3, 'chat_count': 1,
+                           'b_hash': digest}]
+    assert all(row['content'] is None and row['body_hash'] == digest
+               for row in batch)
+
+
+def test_migrate_moves_inline_bodies(client, rows):
+    for channel in '123':
+        for row in rows(channel, [ANNOUNCEMENT, 'short']):
+            db.session.add(TelegramMessage(**row))
+    db.session.commit()
+
+    report = bodies.migrate(db.engine, chunk_size=4)
+    assert (report['rows'], report['shared'], report['new_bodies']) == (6, 3, 1)
+    assert report['bytes_saved'] == 2 * len(ANNOUNCEMENT)
+
+    body = MessageBody.query.one()
+    assert (body.message_count, body.chat_count) == (3, 3)
+    assert bodies.migrate(db.engine)['shared'] == 0
@@ -0,0 +1,92 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import changes
+from app import db
+from models import MessageTombstone, TelegramMessage
+
+LONG = "Shared announcement text that is long enough to be stored as a body"
+
+
+def feed(client, after=0, limit=2, fields='content'):
+    """Every change above `after`, paging with the returned cursor"""
+    collected = []
+    while True:
+        page = client.get(f'/api/changes?after={after}&limit={limit}'
+                          f'&fields={fields}').get_json()
+        collected.extend(page['changes'])
+        if not page['has_more']:
+            return collected, page
+        after = page['next']
+
+
+@pytest.mark.asyncio
+async def test_feed_covers_inserts_edits_and_deletes(client, store, rows):
+    await store.insert_messages(rows('-1001', ['first', LONG, 'third']))
+    # Backfilled late, with an older date: still numbered after the others
+    await store.insert_messages(rows('-1002', ['late'],
+                                     start=datetime(2024, 1, 1)))
+    await store.commit()
+
+    changed, page = feed(client)
+    assert [c['seq'] for c in changed] == [1, 2, 3, 4]
+    assert [c['message']['content'] for c in changed] == \
+        ['first', LONG, 'third', 'late']
+    assert page['last_seq'] == 4 and page['next'] == 4
+
+    assert await store.edit_messages([{
+        'channel_id': '-1001', 'message_id': 2, 'content': 'edited',
+        'edit_date': datetime(2025, 3, 2)}, {
+        'channel_id': '-1001', 'message_id': 99, 'content': 'not stored',
+        'edit_date': datetime(2025, 3, 2)}]) == 1
+    assert await store.delete_messages('-1001', [1, 3]) == 2
+    await store.commit()
+
+    changed, page = feed(client, after=4)
+    assert [(c['seq'], c['op']) for c in changed] == \
+        [(5, 'edit'), (6, 'delete'), (7, 'delete')]
+    assert changed[0]['message']['content'] == 'edited'
+    assert (changed[1]['channel_id'], changed[1]['message_id']) == ('-1001', 1)
+
+    # Each message appears once, at its latest number
+    changed, _ = feed(client, limit=3)
+    assert [(c['seq'], c['op']) for c in changed] == \
+        [(4, 'insert'), (5, 'edit'), (6, 'delete'), (7, 'delete')]
+
+    edited = TelegramMessage.query.filter_by(message_id=2).one()
+    assert (edited.body_hash, edited.text) == (None, 'edited')
+    assert MessageTombstone.query.count() == 2
+
+    # Idle consumers get 304 until something changes
+    response = client.get('/api/changes?after=7')
+    assert response.get_json()['changes'] == []
+    assert client.get('/api/changes?after=7', headers={
+        'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_deletions_without_a_chat_skip_channels(client, store, rows):
+    await store.insert_messages(rows('-1001', ['channel post']) +
+                                rows('42', ['private message']))
+    listener = changes.ChangeListener(store)
+    await listener.deleted(SimpleNamespace(chat_id=None, deleted_ids=[1]))
+    await listener.edited(SimpleNamespace(chat_id=-1001, message=SimpleNamespace(
+        id=1, text='fixed typo', edit_date=None)))
+    await store.commit()
+
+    remaining = {m.channel_id: m.content for m in TelegramMessage.query}
+    assert remaining == {'-1001': 'fixed typo'}
+
+
+def test_backfill_numbers_existing_rows(client, rows):
+    for row in rows('-1001', ['a', 'b', 'c']):
+        db.session.add(TelegramMessage(**row))
+    db.session.commit()
+
+    assert changes.backfill(db.engine, chunk_size=2) == 3
+    assert [m.change_seq for m in TelegramMessage.query.order_by(
+        TelegramMessage.id)] == [1, 2, 3]
+    assert changes.backfill(db.engine) == 0
+    assert changes.last_seq(db.session) == 3
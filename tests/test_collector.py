@@ -1,47 +1,21 @@
 import pytest
 import asyncio
 from unittest.mock import MagicMock, patch
-from collector import collect_messages, should_be_ton_dev
+from collector import run_collection, should_be_ton_dev
 from models import TelegramMessage
 from app import db, app
+from benchmarks.fake_telegram import FakeTelegramClient
 
 @pytest.fixture
 def mock_client():
-    class MockMessage:
-        def __init__(self, id, text, date):
-            self.id = id
-            self.text = text
-            self.date = date
-
-    class MockDialog:
-        def __init__(self, id, title):
-            self.id = id
-            self.title = title
-            
-        async def iter_messages(self, limit):
-            messages = [
-                MockMessage(1, "Test message 1", "2025-02-27"),
-                MockMessage(2, "Test message 2", "2025-02-27")
-            ]
-            for msg in messages:
-                yield msg
-
-    async def mock_get_dialogs(*args, **kwargs):
-        return [
-            MockDialog(1, "TON Dev Chat"),
-            MockDialog(2, "Telegram Developers Community"),
-            MockDialog(3, "Regular Channel")
-        ]
-
-    client = MagicMock()
-    client.get_dialogs = mock_get_dialogs
-    return client
+    # 40 dialogs with 5 messages each; every 17th channel is a TON Dev one
+    return FakeTelegramClient(dialogs=40, backlog=5, mean_rate=0, seed=1)
 
 @pytest.fixture
 def test_app():
     app.config['TESTING'] = True
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    
+
     with app.app_context():
         db.create_all()
         yield app
@@ -54,37 +28,54 @@ async def test_collect_messages(test_app, mock_client):
         # Clear any existing messages
         TelegramMessage.query.delete()
         db.session.commit()
-        
+
         # Run collector
-        await collect_messages(mock_client)
-        
+        await run_collection(mock_client, max_cycles=1)
+
         # Verify messages were collected
         messages = TelegramMessage.query.all()
-        assert len(messages) > 0
-        
+        assert len(messages) == 200
+
         # Verify TON Dev messages are labeled correctly
         ton_dev_messages = TelegramMessage.query.filter_by(is_ton_dev=True).all()
+        assert ton_dev_messages
         for msg in ton_dev_messages:
-            assert any(keyword in msg.channel_title.lower() 
+            assert any(keyword in msg.channel_title.lower()
                       for keyword in ["ton dev", "developers", "开发"])
 
 @pytest.mark.asyncio
 async def test_duplicate_message_handling(test_app, mock_client):
     with app.app_context():
         # Add an existing message
+        dialog = next(iter(mock_client.feeds.values())).dialog
         existing_msg = TelegramMessage(
             message_id=1,
-            channel_id="1",
-            channel_title="TON Dev Chat",
+            channel_id=str(dialog.id),
+            channel_title=dialog.title,
             content="Test message 1",
             is_ton_dev=True
         )
         db.session.add(existing_msg)
         db.session.commit()
-        
+
         # Run collector
-        await collect_messages(mock_client)
-        
+        await run_collection(mock_client, max_cycles=1)
+
         # Verify no duplicate messages
-        messages = TelegramMessage.query.filter_by(message_id=1).all()
+        messages = TelegramMessage.query.filter_by(
+            channel_id=str(dialog.id), message_id=1).all()
         assert len(messages) == 1
+
+@pytest.mark.asyncio
+async def test_flood_wait_defers_remaining_dialogs(test_app, monkeypatch):
+    from config import Config
+    monkeypatch.setattr(Config, 'COLLECTOR_SCOPES',
+                        '{"tiers": {"default": {"poll_interval": 0.5}}}')
+    client = FakeTelegramClient(dialogs=10, backlog=3, mean_rate=0,
+                                flood_wait_probability=0.3,
+                                flood_wait_seconds=0, seed=3)
+    with app.app_context():
+        await run_collection(client, max_cycles=6)
+
+        assert client.stats['flood_waits'] > 0
+        assert TelegramMessage.query.count() == 30
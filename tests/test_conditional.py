@@ -0,0 +1,136 @@
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import versions
+from models import ChangeVersion
+
+
+@pytest.fixture
+def store_batch(store, rows):
+    async def store_batch(channel, count=3, first=1):
+        await store.insert_messages(rows(
+            channel, [f"message {i} " + 'x' * 200
+                      for i in range(first, first + count)],
+            start=datetime(2025, 3, 1) + timedelta(minutes=first),
+            first=first))
+        await store.commit()
+    return store_batch
+
+
+class Statements:
+
+    def __init__(self):
+        self.seen = []
+
+    def __call__(self, conn, cursor, statement, *args):
+        self.seen.append(statement)
+
+    def __enter__(self):
+        event.listen(Engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, 'before_cursor_execute', self)
+
+
+@pytest.mark.asyncio
+async def test_batches_bump_versions(client, store_batch):
+    await store_batch('1')
+    await store_batch('1', first=4)
+    await store_batch('2')
+
+    rows = {v.scope: v for v in ChangeVersion.query.all()}
+    assert rows[versions.GLOBAL_SCOPE].version == 3
+    assert (rows['1'].version, rows['1'].channel_title) == (2, 'Channel 1')
+    assert rows['2'].version == 1
+    assert versions.current_version('Channel 1')[0] == 2
+
+
+@pytest.mark.asyncio
+async def test_not_modified_skips_messages(client, store_batch):
+    await store_batch('1')
+    first = client.get('/api/messages')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert etag.startswith('W/"1-') and first.headers['Last-Modified']
+
+    with Statements() as statements:
+        again = client.get('/api/messages', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    assert not any('telegram_messages' in s for s in statements.seen)
+
+    since = client.get('/api/messages', headers={
+        'If-Modified-Since': first.headers['Last-Modified']})
+    assert since.status_code == 304
+
+    # Another page is another representation
+    other = client.get('/api/messages?page=2', headers={'If-None-Match': etag})
+    assert other.status_code == 200
+
+    await store_batch('1', first=4)
+    changed = client.get('/api/messages', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.get_json()['total'] == 6
+
+
+@pytest.mark.asyncio
+async def test_channel_versions(client, store_batch):
+    await store_batch('1')
+    url = '/api/messages?channel=Channel 1'
+    etag = client.get(url).headers['ETag']
+
+    await store_batch('2')
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/api/channels').status_code == 200
+
+    await store_batch('1', first=4)
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_chats_sharing_a_title(client, store, rows, store_batch):
+    await store_batch('1')
+    await store_batch('1', first=4)
+    await store.insert_messages(rows('2', ['same title'],
+                                     channel_title='Channel 1'))
+    await store.commit()
+    url = '/api/messages?channel=Channel 1'
+    etag = client.get(url).headers['ETag']
+
+    # Chat 2 stays behind chat 1's version, and still counts
+    await store.insert_messages(rows('2', ['again'], first=2,
+                                     channel_title='Channel 1'))
+    await store.commit()
+    assert versions.current_version('Channel 1')[0] == 4
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_dashboard_conditional(client, store_batch):
+    await store_batch('1')
+    etag = client.get('/').headers['ETag']
+    assert client.get('/', headers={'If-None-Match': etag}).status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_gzip(client, store_batch):
+    await store_batch('1', count=20)
+    response = client.get('/api/messages?per_page=20',
+                          headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    data = json.loads(gzip.decompress(response.get_data()))
+    assert len(data['messages']) == 20
+
+    small = client.get('/api/channels',
+                       headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+
+    plain = client.get('/api/messages?per_page=20')
+    assert 'Content-Encoding' not in plain.headers
@@ -0,0 +1,129 @@
+import json
+import random
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('zstandard')
+
+import bodies  # noqa: E402
+import content_codec  # noqa: E402
+from app import db  # noqa: E402
+from benchmarks.fake_telegram import WORDS  # noqa: E402
+from config import Config  # noqa: E402
+from export import export_chunks  # noqa: E402
+from models import ContentDictionary, TelegramMessage  # noqa: E402
+
+SIGNATURE = "\n\n— TON Foundation | https://ton.org | Join us: t.me/toncoin"
+
+
+def texts(count, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 25))) +
+            SIGNATURE for _ in range(count)]
+
+
+@pytest.fixture
+def client(client, monkeypatch):
+    # Dictionary ids restart with every test database
+    monkeypatch.setattr(content_codec, 'codec',
+                        content_codec.ContentCodec(content_codec.codec.loader))
+    return client
+
+
+@pytest.fixture
+def seed_and_train(client, rows):
+    def seed_and_train(count=400):
+        db.session.execute(TelegramMessage.__table__.insert(),
+                           rows('1', texts(count)))
+        db.session.commit()
+        with db.engine.begin() as conn:
+            return content_codec.train_dictionaries(conn, dict_size=4096,
+                                                    channel_min=count)
+    return seed_and_train
+
+
+def test_trained_dictionary_beats_plain_zstd(seed_and_train):
+    assert seed_and_train() == ['dialog_type:channel', 'channel:1']
+    codec = content_codec.codec
+    sample = texts(1, seed=99)[0]
+    frame, dict_id = codec.compress(sample, '1', 'channel')
+    assert dict_id == codec.current['channel:1']
+    assert codec.decompress(frame, dict_id) == sample
+    plain = content_codec.ContentCodec().compress(sample)
+    assert plain is None or len(frame) < len(plain[0])
+    assert len(frame) < len(sample.encode()) / 2
+
+
+def test_migrate_reports_space_saved(seed_and_train):
+    seed_and_train()
+    report = content_codec.migrate(db.engine, chunk_size=150)
+    assert report['rows'] == report['updated'] == 400
+    assert report['bytes_saved'] > report['bytes_before'] / 2
+
+    stored = db.session.execute(
+        db.select(TelegramMessage.content, TelegramMessage.content_zstd)).all()
+    assert all(content is None and frame for content, frame in stored)
+    # ORM loads are decompressed
+    assert TelegramMessage.query.first().content.endswith(SIGNATURE)
+
+    assert content_codec.migrate(db.engine)['updated'] == 0
+
+    report = content_codec.migrate(db.engine, decompress=True)
+    assert report['updated'] == 400 and report['bytes_saved'] < 0
+    assert db.session.execute(db.select(db.func.count()).where(
+        TelegramMessage.content_zstd.isnot(None))).scalar() == 0
+
+
+def test_migrate_skips_rows_edited_after_they_were_read(seed_and_train):
+    seed_and_train(count=200)
+    edited = []
+
+    def edit_first(conn, cursor, statement, parameters, context, executemany):
+        # An edit committed between migrate's read and its update
+        if statement.startswith('UPDATE telegram_messages') and not edited:
+            edited.append(parameters[-2])
+            cursor.execute("UPDATE telegram_messages SET content = 'edited', "
+                           "change_seq = 999 WHERE id = ?", (edited[0],))
+
+    db.event.listen(db.engine, 'before_cursor_execute', edit_first)
+    try:
+        report = content_codec.migrate(db.engine)
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', edit_first)
+
+    assert report['updated'] == 199 and report['skipped'] == 1
+    assert db.session.get(TelegramMessage, edited[0]).content == 'edited'
+
+
+@pytest.mark.asyncio
+async def test_collector_compresses_and_reads_are_transparent(
+        client, store, rows, seed_and_train, monkeypatch):
+    seed_and_train()
+    monkeypatch.setattr(Config, 'CONTENT_COMPRESSION', True)
+    contents = texts(20, seed=7) + ['ok']
+    await store.insert_messages(rows('2', contents, datetime(2025, 4, 1)))
+    await store.commit()
+
+    stored = db.session.execute(bodies.join_bodies(
+        db.select(TelegramMessage.content, *bodies.STORED_COLUMNS)).where(
+            TelegramMessage.channel_id == '2').order_by(
+                TelegramMessage.message_id)).all()
+    # Long bodies are shared through message_bodies, compressed there too
+    assert stored[0].content is None and stored[0][2] == \
+        content_codec.codec.current['dialog_type:channel']
+    # Too short to shrink, stored as text
+    assert stored[-1].content == 'ok'
+
+    data = client.get(
+        '/api/messages?channel=Channel 2&per_page=100').get_json()
+    assert sorted(m['content'] for m in data['messages']) == sorted(contents)
+
+    needle = contents[3].split()[0:3]
+    found = client.get(
+        '/api/search?q=' + ' '.join(needle).upper()).get_json()['messages']
+    assert any(m['content'] == contents[3] for m in found)
+
+    exported = b''.join(export_chunks(db.session, 'jsonl', channel_id='2'))
+    assert [json.loads(line)['content'] for line in exported.splitlines()] == \
+        contents
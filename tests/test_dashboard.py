@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import main  # noqa: F401  registers the routes
+from app import app, db
+from models import TelegramMessage
+
+
+@pytest.fixture
+def test_app():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_dashboard_renders_on_sqlite(test_app):
+    now = datetime.utcnow()
+    db.session.add_all([
+        TelegramMessage(message_id=i, channel_id='1', channel_title='TON Dev Chat',
+                        content=f"dev {i}", timestamp=now - timedelta(hours=i),
+                        is_ton_dev=True, is_outgoing=i % 2 == 0)
+        for i in range(1, 4)
+    ] + [
+        TelegramMessage(message_id=1, channel_id='2', channel_title='Random',
+                        content="hi", timestamp=now - timedelta(days=10))
+    ])
+    db.session.commit()
+
+    with test_app.test_client() as client:
+        response = client.get('/')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'TON Dev Chat' in body and 'Random' in body
+    assert 'Error loading data' not in body
@@ -0,0 +1,92 @@
+import pytest
+from flask import Flask, g
+
+import db_routing
+from api.routes import api
+from app import db
+from db_routing import ReplicaRouter, replica_binds
+from models import ApiKey, TelegramMessage
+
+API_KEY = 'routing-key'
+
+
+@pytest.fixture
+def routed_app(tmp_path, monkeypatch):
+    """An app on a primary SQLite file with a second file as its replica"""
+    monkeypatch.setattr(db_routing, 'router', ReplicaRouter())
+    routed = Flask('routed')
+    routed.config['TESTING'] = True
+    routed.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'primary.db'}"
+    routed.config['SQLALCHEMY_BINDS'] = replica_binds(
+        [f"sqlite:///{tmp_path / 'replica.db'}"])
+    db.init_app(routed)
+    routed.register_blueprint(api, url_prefix='/api')
+
+    with routed.app_context():
+        db.create_all(bind_key=None)
+        replica = db.engines['replica_0']
+        db.metadata.create_all(replica)
+        for engine, title in ((db.engines[None], 'Primary'), (replica, 'Replica')):
+            with engine.begin() as conn:
+                conn.execute(ApiKey.__table__.insert(), {'key': API_KEY, 'is_active': True})
+                conn.execute(TelegramMessage.__table__.insert(), {
+                    'message_id': 1, 'channel_id': '1', 'channel_title': title
+                })
+    yield routed
+    with routed.app_context():
+        db.engines['replica_0'].dispose()
+        db.engines[None].dispose()
+    # Bind metadata is shared by every app using `db`
+    db.metadatas.pop('replica_0', None)
+
+
+def get_channels(app):
+    response = app.test_client().get('/api/channels',
+                                     headers={'X-API-Key': API_KEY})
+    assert response.status_code == 200
+    return response.get_json()['channels']
+
+
+def test_read_only_routes_use_the_replica(routed_app):
+    assert get_channels(routed_app) == ['Replica']
+
+
+def test_lagging_replica_falls_back_to_primary(routed_app, monkeypatch):
+    monkeypatch.setattr(db_routing, 'measure_lag', lambda engine: 600.0)
+    assert get_channels(routed_app) == ['Primary']
+
+
+def test_unreachable_replica_falls_back_to_primary(routed_app, monkeypatch):
+    def fail(engine):
+        raise OSError("connection refused")
+    monkeypatch.setattr(db_routing, 'measure_lag', fail)
+    assert get_channels(routed_app) == ['Primary']
+
+
+def test_writes_in_read_only_requests_go_to_primary(routed_app):
+    with routed_app.test_request_context():
+        g.db_read_only = True
+        assert db.session.query(TelegramMessage.channel_title).scalar() == 'Replica'
+        db.session.add(TelegramMessage(message_id=2, channel_id='1',
+                                       channel_title='Written'))
+        db.session.commit()
+        db.session.remove()
+
+    with routed_app.app_context():
+        titles = {t for (t,) in db.session.query(TelegramMessage.channel_title)}
+        assert titles == {'Primary', 'Written'}
+
+
+def test_lag_checks_are_cached(monkeypatch):
+    now = [0.0]
+    calls = []
+    router = ReplicaRouter(clock=lambda: now[0])
+    monkeypatch.setattr(db_routing, 'measure_lag',
+                        lambda engine: calls.append(engine) or 0.0)
+    engines = {None: 'primary', 'replica_0': 'replica'}
+
+    assert router.pick(engines) == 'replica_0'
+    assert router.pick(engines) == 'replica_0'
+    now[0] = 60
+    router.pick(engines)
+    assert len(calls) == 2
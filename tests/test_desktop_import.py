@@ -0,0 +1,185 @@
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+import changes
+import desktop_import
+from app import app, db
+from models import ChangeVersion, Sender, TelegramMessage
+
+SELF_ID = 42
+
+
+def message(message_id, text, from_id='user7', sender='Alice', **extra):
+    return dict({
+        'id': message_id,
+        'type': 'message',
+        'date': '2025-03-01T12:00:00',
+        'date_unixtime': str(1740830400 + message_id * 60),
+        'from': sender,
+        'from_id': from_id,
+        'text': text,
+        'text_entities': [],
+    }, **extra)
+
+
+EXPORT = {
+    'about': 'Here is the data you requested.',
+    'personal_information': {'user_id': SELF_ID, 'first_name': 'Me'},
+    'contacts': {'about': '', 'list': [{'first_name': 'Bob'}]},
+    'chats': {
+        'about': 'This page lists all chats from this export.',
+        'list': [{
+            'name': 'TON Dev Chat',
+            'type': 'public_supergroup',
+            'id': 1001,
+            'messages': [
+                message(1, 'hello'),
+                message(2, ['see ', {'type': 'bold', 'text': 'this'}, ' and ',
+                            {'type': 'text_link', 'text': 'docs',
+                             'href': 'https://ton.org'}]),
+                {'id': 3, 'type': 'service', 'action': 'pin_message',
+                 'date': '2025-03-01T12:03:00'},
+                message(4, '', photo='photos/1.jpg'),
+                message(5, 'from me', from_id=f'user{SELF_ID}', sender='Me',
+                        edited_unixtime='1740831000'),
+            ],
+        }, {
+            'name': 'Alice',
+            'type': 'personal_chat',
+            'id': 7,
+            'messages': [message(1, 'hi there')],
+        }],
+    },
+    'left_chats': {
+        'about': '',
+        'list': [{
+            'name': 'News',
+            'type': 'public_channel',
+            'id': 2002,
+            'messages': [message(10, 'post', from_id='channel2002',
+                                 sender='News')],
+        }],
+    },
+}
+
+
+@pytest.fixture
+def database():
+    with app.app_context():
+        db.create_all()
+        yield
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def export_path(tmp_path):
+    path = tmp_path / 'result.json'
+    # Telegram Desktop writes indented JSON
+    path.write_text(json.dumps(EXPORT, indent=1, ensure_ascii=False),
+                    encoding='utf-8')
+    return str(path)
+
+
+def test_reader_streams_chats_and_messages():
+    text = json.dumps(EXPORT, indent=1)
+    # Tiny reads put every token across a read boundary somewhere
+    events = list(desktop_import.ExportReader(io.StringIO(text), read_size=7))
+    assert events[0] == ('self', SELF_ID)
+    chats = [value['name'] for kind, value in events if kind == 'chat']
+    assert chats == ['TON Dev Chat', 'Alice', 'News']
+    assert [value['id'] for kind, value in events if kind == 'message'] == \
+        [1, 2, 3, 4, 5, 1, 10]
+
+    single = json.dumps(EXPORT['chats']['list'][1])
+    assert [kind for kind, _ in desktop_import.ExportReader(
+        io.StringIO(single))] == ['chat', 'message']
+
+
+def test_normalize_matches_collected_rows():
+    chat = EXPORT['chats']['list'][0]
+    rows, senders = desktop_import.normalize(chat, chat['messages'], SELF_ID)
+    assert [row['message_id'] for row in rows] == [1, 2, 5]
+    first, second, mine = rows
+    assert first['channel_id'] == '-1001001'
+    assert first['dialog_type'] == 'public_supergroup'
+    assert first['is_ton_dev'] and not first['is_outgoing']
+    assert first['timestamp'] == datetime(2025, 3, 1, 12, 1)
+    assert second['content'] == 'see **this** and [docs](https://ton.org)'
+    assert mine['is_outgoing'] and mine['sender_id'] == str(SELF_ID)
+    assert mine['edit_date'] == datetime(2025, 3, 1, 12, 10)
+    assert senders['7'] == {'id': '7', 'peer_type': 'user', 'username': None,
+                            'display_name': 'Alice', 'is_bot': None}
+
+    assert desktop_import.peer_id({'type': 'private_group', 'id': 5}) == '-5'
+    assert desktop_import.peer_id({'type': 'bot_chat', 'id': 5}) == '5'
+
+
+def test_import_merges_and_repeats_cleanly(database, export_path):
+    db.session.add(TelegramMessage(message_id=1, channel_id='-1001001',
+                                   content='hello',
+                                   timestamp=datetime(2025, 3, 1, 12, 1)))
+    db.session.commit()
+
+    report = desktop_import.import_export(db.engine, export_path, workers=0)
+    assert (report['messages'], report['rows'], report['inserted']) == (7, 5, 4)
+    assert TelegramMessage.query.count() == 5
+    assert db.session.get(Sender, '7').message_count == 2
+    assert db.session.get(ChangeVersion, '-1002002').channel_title == 'News'
+
+    # Only inserted rows take changefeed numbers
+    numbered = db.session.execute(db.select(TelegramMessage.change_seq).where(
+        TelegramMessage.change_seq.isnot(None))).scalars().all()
+    assert sorted(numbered) == [1, 2, 3, 4]
+    assert changes.last_seq(db.session) == 4
+
+    again = desktop_import.import_export(db.engine, export_path, workers=0,
+                                         restart=True)
+    assert (again['rows'], again['inserted']) == (5, 0)
+    assert TelegramMessage.query.count() == 5
+    assert changes.last_seq(db.session) == 4
+
+
+def test_interrupted_import_resumes(database, export_path, monkeypatch):
+    store_rows = desktop_import.store_rows
+    calls = []
+
+    def failing(conn, rows, *args, **kwargs):
+        calls.append(len(rows))
+        if len(calls) == 3:
+            raise ConnectionError("database went away")
+        return store_rows(conn, rows, *args, **kwargs)
+
+    monkeypatch.setattr(desktop_import, 'store_rows', failing)
+    with pytest.raises(ConnectionError):
+        desktop_import.import_export(db.engine, export_path, workers=0,
+                                     chunk_size=2)
+    monkeypatch.undo()
+    assert TelegramMessage.query.count() == 2
+
+    report = desktop_import.import_export(db.engine, export_path, workers=0,
+                                          chunk_size=2)
+    # Only the chunks after the last stored one are read again
+    assert report['messages'] == 3
+    assert TelegramMessage.query.count() == 5
+
+
+def test_import_needs_the_unique_index(database, export_path):
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            'DROP INDEX uq_telegram_messages_channel_message')
+    with pytest.raises(RuntimeError, match='init-db'):
+        desktop_import.import_export(db.engine, export_path, workers=0)
+    assert TelegramMessage.query.count() == 0
+
+
+def test_process_pool(database, export_path):
+    report = desktop_import.import_export(db.engine, export_path, workers=2,
+                                          chunk_size=2)
+    assert report['inserted'] == 5
+    assert report['rows_per_second'] > 0
+    assert sorted(m.channel_id for m in TelegramMessage.query.all()) == \
+        ['-1001001', '-1001001', '-1001001', '-1002002', '7']
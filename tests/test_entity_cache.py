@@ -0,0 +1,101 @@
+import pytest
+from types import SimpleNamespace
+from telethon.tl.types import (Channel, ChatPhotoEmpty, InputPeerChannel,
+                               UpdateChannelTooLong, User)
+from entity_cache import EntityCache
+from models import TelegramEntity
+from app import db, app
+
+
+def make_channel(id, title, username=None, megagroup=False, access_hash=42):
+    return Channel(id=id,
+                   title=title,
+                   photo=ChatPhotoEmpty(),
+                   date=None,
+                   username=username,
+                   megagroup=megagroup,
+                   access_hash=access_hash)
+
+
+def make_dialog(entity, archived=False):
+    from telethon import utils
+    return SimpleNamespace(id=utils.get_peer_id(entity),
+                           entity=entity,
+                           archived=archived)
+
+
+def make_update(*entities):
+    """An update as Telethon hands it to events.Raw handlers"""
+    from telethon import utils
+    update = UpdateChannelTooLong(channel_id=1001)
+    update._entities = {utils.get_peer_id(e): e for e in entities}
+    return update
+
+
+@pytest.fixture
+def test_app():
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.mark.asyncio
+async def test_sync_dialogs_persists_and_reloads(test_app, store):
+    with app.app_context():
+        cache = EntityCache(store)
+        cache.sync_dialogs([
+            make_dialog(make_channel(1001, "TON Dev Chat", username="tondev")),
+            make_dialog(make_channel(1002, "Old News"), archived=True),
+        ])
+        assert await cache.flush() == 2
+        await store.commit()
+        assert TelegramEntity.query.count() == 2
+
+        # A fresh cache after a restart sees the same dialogs without Telegram
+        reloaded = EntityCache(store)
+        assert await reloaded.load() == 2
+        dialogs = {d.id: d for d in reloaded.dialogs()}
+        assert dialogs[-1000000001001].title == "TON Dev Chat"
+        assert dialogs[-1000000001001].entity.username == "tondev"
+        assert dialogs[-1000000001001].dialog_type == 'channel'
+        assert dialogs[-1000000001002].archived
+        assert dialogs[-1000000001001].input_entity == InputPeerChannel(1001, 42)
+
+
+@pytest.mark.asyncio
+async def test_dialogs_missing_from_reconciliation_are_dropped(test_app, store):
+    with app.app_context():
+        cache = EntityCache(store)
+        first = make_channel(1001, "A")
+        cache.sync_dialogs([make_dialog(first), make_dialog(make_channel(1002, "B"))])
+        await cache.flush()
+
+        cache.sync_dialogs([make_dialog(first)])
+        assert await cache.flush() == 1
+        assert [d.title for d in cache.dialogs()] == ["A"]
+
+
+@pytest.mark.asyncio
+async def test_updates_refresh_entities_without_dirtying_unchanged(test_app, store):
+    with app.app_context():
+        cache = EntityCache(store)
+        cache.sync_dialogs([make_dialog(make_channel(1001, "A"))])
+        await cache.flush()
+
+        cache.handle_update(make_update(User(id=7, first_name="Alice",
+                                             access_hash=9),
+                                        make_channel(1001, "A")))
+        assert await cache.flush() == 1
+
+        cache.handle_update(make_update(make_channel(1001, "A renamed",
+                                                     access_hash=None)))
+        assert await cache.flush() == 1
+        record = cache.get(-1000000001001)
+        assert record['title'] == "A renamed"
+        assert record['access_hash'] == 42
+        assert cache.get(7)['peer_type'] == 'user'
@@ -0,0 +1,84 @@
+import csv
+import io
+import json
+import sys
+import pytest
+from datetime import datetime, timedelta
+from export import export_chunks
+from models import TelegramMessage, ApiKey
+from app import db, app
+import main  # noqa: F401  registers the API blueprint
+
+
+@pytest.fixture
+def test_app():
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+
+    with app.app_context():
+        db.create_all()
+        start = datetime(2025, 3, 1)
+        for i in range(25):
+            db.session.add(
+                TelegramMessage(message_id=i + 1,
+                                channel_id="1" if i % 2 else "2",
+                                channel_title="TON Dev Chat" if i % 2 else "News",
+                                content=f"Message {i}",
+                                timestamp=start + timedelta(hours=i),
+                                is_ton_dev=bool(i % 2)))
+        db.session.add(ApiKey(key="secret", name="test"))
+        db.session.commit()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_jsonl_export_streams_in_batches(test_app):
+    with app.app_context():
+        chunks = list(export_chunks(db.session, 'jsonl', batch_size=10))
+        assert len(chunks) == 3
+        rows = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        assert [r['message_id'] for r in rows] == list(range(1, 26))
+        assert rows[0]['timestamp'] == '2025-03-01T00:00:00'
+
+
+def test_csv_export_with_filters(test_app):
+    with app.app_context():
+        data = b''.join(
+            export_chunks(db.session,
+                          'csv',
+                          is_ton_dev=True,
+                          since=datetime(2025, 3, 1, 10))).decode('utf-8')
+        rows = list(csv.DictReader(io.StringIO(data)))
+        assert len(rows) == 7
+        assert {r['channel_title'] for r in rows} == {"TON Dev Chat"}
+
+
+def test_parquet_export_writes_row_groups(test_app):
+    pq = pytest.importorskip('pyarrow.parquet')
+    with app.app_context():
+        data = b''.join(export_chunks(db.session, 'parquet', batch_size=10))
+        parquet = pq.ParquetFile(io.BytesIO(data))
+        assert parquet.metadata.num_rows == 25
+        assert parquet.metadata.num_row_groups == 3
+
+
+def test_export_endpoint(test_app):
+    client = app.test_client()
+    response = client.get('/api/export?format=jsonl&channel=News',
+                          headers={'X-API-Key': 'secret'})
+    assert response.status_code == 200
+    assert len(response.data.splitlines()) == 13
+
+    response = client.get('/api/export?format=xml',
+                          headers={'X-API-Key': 'secret'})
+    assert response.status_code == 400
+
+
+def test_parquet_export_without_pyarrow(test_app, monkeypatch):
+    # A None entry makes the import fail as if pyarrow were not installed
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    response = app.test_client().get('/api/export?format=parquet',
+                                     headers={'X-API-Key': 'secret'})
+    assert response.status_code == 501
+    assert 'pyarrow' in response.get_json()['error']
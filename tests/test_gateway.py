@@ -0,0 +1,129 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+from telethon import errors
+
+import main
+from app import app
+from telegram_gateway import TelegramGateway
+
+
+class FakeAuthClient:
+    """Login surface of TelegramClient"""
+    instances = []
+
+    def __init__(self, path, password=None):
+        self.path = path
+        self.password = password
+        self.connected = False
+        self.authorized = False
+        self.connects = 0
+        self.code_used = False
+        self.threads = set()
+        FakeAuthClient.instances.append(self)
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.threads.add(threading.current_thread().name)
+        self.connects += 1
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def is_user_authorized(self):
+        return self.authorized
+
+    async def send_code_request(self, phone):
+        return SimpleNamespace(phone_code_hash=f"hash{phone}")
+
+    async def sign_in(self, phone=None, code=None, phone_code_hash=None,
+                      password=None):
+        if password is not None:
+            self.authorized = password == self.password
+            return
+        assert phone_code_hash == f"hash{phone}" and code == '12345'
+        assert not self.code_used
+        self.code_used = True
+        if self.password:
+            raise errors.SessionPasswordNeededError(request=None)
+        self.authorized = True
+
+
+@pytest.fixture
+def setup_client(tmp_path, monkeypatch):
+    FakeAuthClient.instances = []
+    started = []
+    monkeypatch.setattr(main, 'start_collector', lambda: started.append(True))
+    app.config['TESTING'] = True
+
+    def use_gateway(**client_options):
+        gateway = TelegramGateway(
+            client_factory=lambda path: FakeAuthClient(path, **client_options),
+            path=lambda: str(tmp_path / 'session.session'))
+        monkeypatch.setattr(main, 'gateway', gateway)
+        return gateway, started
+
+    yield use_gateway
+
+
+def test_setup_and_verify_share_one_client_and_loop(setup_client):
+    gateway, started = setup_client()
+    client = app.test_client()
+
+    response = client.post('/setup_process', json={'phone': '15550123'})
+    assert response.get_json()['status'] == 'code_sent'
+    response = client.post('/verify_code', json={'code': '12345'})
+    assert response.get_json()['status'] == 'success'
+
+    [fake] = FakeAuthClient.instances
+    assert fake.connects == 1
+    assert fake.threads == {'telegram-gateway'}
+    assert fake.authorized and not fake.connected  # released for the collector
+    assert started == [True]
+
+
+def test_verify_in_another_process_uses_saved_code_hash(setup_client):
+    gateway, _ = setup_client()
+    gateway.run(gateway.send_code('+15550123'))
+
+    # A second worker has no client and no in-memory state
+    other, started = setup_client()
+    response = app.test_client().post('/verify_code', json={'code': '12345'})
+    assert response.get_json()['status'] == 'success'
+    assert started == [True]
+
+
+def test_two_step_password(setup_client):
+    gateway, started = setup_client(password='secret')
+    client = app.test_client()
+    client.post('/setup_process', json={'phone': '+15550123'})
+
+    response = client.post('/verify_code', json={'code': '12345'})
+    assert response.status_code == 400
+    assert 'password' in response.get_json()['message']
+
+    response = client.post('/verify_code',
+                           json={'code': '12345', 'password': 'secret'})
+    assert response.get_json()['status'] == 'success'
+
+
+def test_verify_without_code_request(setup_client):
+    setup_client()
+    response = app.test_client().post('/verify_code', json={'code': '12345'})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_call_awaits_the_gateway_loop(setup_client):
+    gateway, _ = setup_client()
+    assert await gateway.call(gateway.send_code('15550123')) == 'code_sent'
+    [fake] = FakeAuthClient.instances
+    assert fake.threads == {'telegram-gateway'}
+
+    with pytest.raises(asyncio.TimeoutError):
+        await gateway.call(asyncio.sleep(5), timeout=0.1)
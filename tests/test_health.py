@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import main  # noqa: F401  registers the routes
+from app import app, db
+from benchmarks.fake_telegram import FakeTelegramClient
+from async_db import CollectorStore
+from collector import run_collection
+from config import Config
+from heartbeat import HEARTBEAT_ID, Heartbeat, collector_health
+from models import CollectorHeartbeat, DialogLag
+
+
+@pytest.fixture
+def test_app():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_missing_heartbeat_is_not_ready(test_app):
+    client = test_app.test_client()
+    assert client.get('/healthz').status_code == 200
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert response.get_json()['collector']['status'] == 'missing'
+
+
+@pytest.mark.asyncio
+async def test_collection_writes_heartbeat(test_app):
+    client = FakeTelegramClient(dialogs=5, backlog=3, mean_rate=0, seed=5)
+    await run_collection(client, max_cycles=1)
+
+    health = collector_health()
+    assert health['status'] == 'ok'
+    assert health['cycle'] == 1
+    assert health['last_commit_at'] is not None
+    assert health['dialogs'] == 5
+    assert health['max_lag_messages'] == 0
+    for row in DialogLag.query.all():
+        assert row.top_message_id == row.stored_message_id == 3
+
+    response = test_app.test_client().get('/readyz')
+    assert response.status_code == 200
+    assert response.get_json()['collector']['cycle'] == 1
+
+
+def test_stuck_and_stale_collector(test_app, monkeypatch):
+    monkeypatch.setattr(Config, 'COLLECTOR_STALE_AFTER', 60)
+    now = datetime.utcnow()
+    db.session.add(CollectorHeartbeat(id=HEARTBEAT_ID,
+                                      cycle=7,
+                                      cycle_started_at=now - timedelta(minutes=5),
+                                      cycle_finished_at=now - timedelta(minutes=6)))
+    db.session.commit()
+    assert collector_health(now)['status'] == 'stuck'
+
+    beat = db.session.get(CollectorHeartbeat, HEARTBEAT_ID)
+    beat.cycle_finished_at = now - timedelta(minutes=4)
+    db.session.commit()
+    assert collector_health(now)['status'] == 'stale'
+    assert test_app.test_client().get('/readyz').status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_updates_between_polls_count_as_lag(test_app):
+    store = CollectorStore.from_url()
+    heartbeat = Heartbeat(store)
+    now = datetime.utcnow()
+    heartbeat.stored('-1001', 10, now - timedelta(minutes=10), 'Chan')
+    heartbeat.seen('-1001', 12, now - timedelta(minutes=2))
+    heartbeat.seen('-1001', 13, now - timedelta(minutes=1))
+    await heartbeat.cycle_started(1)
+
+    health = collector_health(now)
+    [lagging] = health['lagging']
+    assert lagging['lag_messages'] == 3
+    assert 115 <= lagging['lag_seconds'] <= 125
+
+    # A poll storing everything clears the lag
+    heartbeat.stored('-1001', 13, now - timedelta(minutes=1))
+    await heartbeat.flush()
+    await store.close()
+    assert collector_health(now)['max_lag_seconds'] == 0.0
+
+
+def test_status_does_not_restart_collector(test_app, monkeypatch):
+    def fail():
+        raise AssertionError("collector restarted from /status")
+    monkeypatch.setattr(main, 'start_collector', fail)
+    response = test_app.test_client().get('/status')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'warning'
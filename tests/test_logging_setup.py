@@ -0,0 +1,65 @@
+import json
+import logging
+
+import pytest
+
+from app import app, db
+from benchmarks.fake_telegram import FakeTelegramClient
+from collector import run_collection
+from logging_setup import JsonFormatter, LogSampler
+
+
+def make_record(msg, *args, **extra):
+    record = logging.LogRecord('collector', logging.INFO, __file__, 1, msg,
+                               args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_includes_extra_fields():
+    line = JsonFormatter().format(
+        make_record("Cycle %d done", 3, cycle=3, stored=12))
+    entry = json.loads(line)
+
+    assert entry['message'] == "Cycle 3 done"
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'collector'
+    assert entry['cycle'] == 3 and entry['stored'] == 12
+    assert 'args' not in entry and 'msecs' not in entry
+
+
+def test_sampler_suppresses_repeats_within_interval(caplog):
+    now = [0.0]
+    sampler = LogSampler(interval=60, clock=lambda: now[0])
+    logger = logging.getLogger('sampled')
+
+    with caplog.at_level(logging.WARNING, logger='sampled'):
+        for _ in range(5):
+            sampler.log(logger, logging.WARNING, 'a', "Failed %s", 'a')
+        sampler.log(logger, logging.WARNING, 'b', "Failed %s", 'b')
+        now[0] = 61
+        sampler.log(logger, logging.WARNING, 'a', "Failed %s", 'a')
+
+    assert [r.getMessage() for r in caplog.records] == [
+        "Failed a", "Failed b", "Failed a (4 similar suppressed)"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_collector_logs_one_summary_per_cycle(caplog):
+    app.config['TESTING'] = True
+    client = FakeTelegramClient(dialogs=8, backlog=3, mean_rate=0, seed=4)
+    with app.app_context():
+        db.create_all()
+        try:
+            with caplog.at_level(logging.INFO, logger='collector'):
+                await run_collection(client, max_cycles=1)
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    summaries = [r for r in caplog.records if hasattr(r, 'polled')]
+    assert len(summaries) == 1
+    assert summaries[0].polled == 8 and summaries[0].stored == 24
+    # Nothing per dialog or per message at INFO
+    assert len([r for r in caplog.records if r.name == 'collector']) < 8
@@ -0,0 +1,55 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from app import app, db
+from collector import run_collection
+from benchmarks.fake_telegram import FakeTelegramClient
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def ingested_total():
+    return sum(s.value for metric in REGISTRY.collect()
+               for s in metric.samples
+               if s.name == 'collector_messages_ingested_total')
+
+
+@pytest.fixture
+def test_app():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_metrics_endpoint_reports_http_latency(test_app):
+    client = test_app.test_client()
+    client.get('/api/channels')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/channels",status="401"}' in body
+    # Scrapes are not timed themselves
+    assert 'route="/metrics"' not in body
+
+
+@pytest.mark.asyncio
+async def test_collector_metrics(test_app):
+    client = FakeTelegramClient(dialogs=10, backlog=4, mean_rate=0, seed=2)
+    ingested = ingested_total()
+    cycles = sample('collector_cycle_duration_seconds_count')
+    dialog_misses = sample('cache_requests_total', cache='dialogs', result='miss')
+
+    with app.app_context():
+        await run_collection(client, max_cycles=1)
+
+    assert ingested_total() - ingested == 40
+    assert sample('collector_cycle_duration_seconds_count') - cycles == 1
+    assert sample('collector_dialog_fetch_seconds_count', tier='default') >= 10
+    assert sample('collector_queue_depth') == 10
+    assert sample('cache_requests_total', cache='dialogs', result='miss') - dialog_misses == 1
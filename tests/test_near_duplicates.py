@@ -0,0 +1,122 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import near_duplicates
+from async_db import CollectorStore
+from benchmarks.fake_telegram import WORDS
+from models import NearDuplicate
+
+SPAM = ("Congratulations! You were selected for the TON airdrop, claim 500 "
+        "TON today at https://t0n-gift.example/claim before the offer ends")
+
+
+def variant(number):
+    return SPAM.replace('500', str(500 + number)).replace(
+        'today', ['today', 'now', 'today!!'][number % 3])
+
+
+def chatter(count, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(12)) for _ in range(count)]
+
+
+def index_rows(index, batch):
+    texts = [near_duplicates.text_of(row['content']) for row in batch]
+    return index.add(batch, near_duplicates.signatures(texts))
+
+
+def test_signatures_estimate_similarity():
+    texts = [near_duplicates.text_of(t) for t in [SPAM, variant(1)] + chatter(1)]
+    spam, varied, other = near_duplicates.signatures(texts)
+    assert len(spam) == near_duplicates.NUM_PERM
+    assert near_duplicates.similarity(spam, varied) > 0.6
+    assert near_duplicates.similarity(spam, other) < 0.2
+    assert near_duplicates.text_of('Short, but 100% real!') is None
+    assert near_duplicates.signatures([None]) == [None]
+
+
+def test_numpy_and_python_signatures_agree(monkeypatch):
+    pytest.importorskip('numpy')
+    texts = [near_duplicates.text_of(t) for t in chatter(50) + [SPAM]]
+    vectorized = near_duplicates.signatures(texts)
+    monkeypatch.setattr(near_duplicates, 'BLOCK_SHINGLES', 100)
+    assert near_duplicates.signatures(texts) == vectorized
+    monkeypatch.setattr(near_duplicates, 'np', None)
+    assert near_duplicates.signatures(texts) == vectorized
+
+
+def test_index_clusters_variants_across_chats(rows):
+    index = near_duplicates.NearDuplicateIndex(window_hours=24, threshold=0.6)
+    assert index_rows(index, rows('1', chatter(20) + [SPAM])) == []
+
+    members = index_rows(index, rows('2', [variant(1), 'too short']) +
+                         rows('3', [variant(2)]))
+    clusters = {m['cluster_id'] for m in members}
+    assert clusters == {near_duplicates.cluster_id('1', 21)}
+    assert sorted((m['channel_id'], m['message_id']) for m in members) == \
+        [('1', 21), ('2', 1), ('3', 1)]
+
+    # A retried batch repeats its rows instead of forming new clusters
+    again = index_rows(index, rows('3', [variant(2)]))
+    assert [(m['channel_id'], m['cluster_id']) for m in again] == \
+        [('3', near_duplicates.cluster_id('1', 21))]
+
+
+def test_index_forgets_messages_outside_the_window(rows):
+    index = near_duplicates.NearDuplicateIndex(window_hours=2, threshold=0.6)
+    index_rows(index, rows('1', [SPAM]))
+    later = datetime(2025, 3, 1, 16)
+    index_rows(index, rows('2', chatter(1), start=later))
+    assert len(index) == 1 and len(index.windows) == 1
+    assert index_rows(index, rows('3', [variant(1)], start=later)) == []
+    # Too old for the window: ignored
+    assert index_rows(index, rows('4', [SPAM])) == []
+
+
+def test_exact_copies_keep_a_cluster_alive_past_the_original(rows):
+    index = near_duplicates.NearDuplicateIndex(window_hours=2, threshold=0.6)
+    index_rows(index, rows('1', [SPAM]))
+    original = near_duplicates.cluster_id('1', 1)
+    # Each copy arrives an hour after the previous one
+    for hour in range(1, 6):
+        start = datetime(2025, 3, 1, hour)
+        members = index_rows(index, rows(str(hour + 1), [SPAM], start=start))
+        assert members and {m['cluster_id'] for m in members} == {original}
+    assert ('1', 1) not in index.entries
+
+
+@pytest.mark.asyncio
+async def test_collector_clusters_spam_waves(client, store, rows):
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    await store.insert_messages(rows('1', chatter(5) + [SPAM], start))
+    await store.insert_messages(rows('2', [variant(1)],
+                                     start + timedelta(minutes=10)))
+    await store.commit()
+
+    # A restarted collector rebuilds the index from the stored window
+    await store.close()
+    restarted = CollectorStore.from_url()
+    try:
+        await restarted.insert_messages(rows('3', [variant(2)] + chatter(2, 1),
+                                                 start + timedelta(minutes=20)))
+        await restarted.commit()
+    finally:
+        await restarted.close()
+
+    assert NearDuplicate.query.count() == 3
+
+    data = client.get('/api/near-duplicates').get_json()
+    [cluster] = data['clusters']
+    assert (cluster['seen_in'], cluster['message_count']) == (3, 3)
+    assert cluster['content'] == SPAM
+
+    members = client.get(f"/api/near-duplicates/{cluster['cluster_id']}"
+                         '?fields=channel_id,content').get_json()['messages']
+    assert [m['channel_id'] for m in members] == ['1', '2', '3']
+    assert members[2]['content'] == variant(2)
+
+    assert client.get(
+        '/api/near-duplicates?min_chats=4').get_json()['clusters'] == []
+    assert client.get('/api/near-duplicates/unknown').status_code == 404
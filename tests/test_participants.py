@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import participants
+from app import db
+from models import Sender
+from utils import sender_info
+
+
+@pytest.fixture
+def sender_rows(rows):
+    def sender_rows(channel, sender_ids, start, first=1):
+        batch = rows(channel, [f"message {i}" for i in range(len(sender_ids))],
+                     start, first, dialog_type='public_supergroup')
+        for row, sender_id in zip(batch, sender_ids):
+            row['sender_id'] = sender_id
+        return batch
+    return sender_rows
+
+
+def test_hyperloglog_estimates_and_merges():
+    first, second = participants.HyperLogLog(), participants.HyperLogLog()
+    for i in range(6000):
+        first.add(f"user{i}")
+    for i in range(4000, 10000):
+        second.add(f"user{i}")
+    assert abs(first.estimate() - 6000) < 6000 * 0.08
+
+    first.merge(participants.HyperLogLog(registers=second.dumps()))
+    assert abs(first.estimate() - 10000) < 10000 * 0.08
+
+    small = participants.HyperLogLog()
+    for i in range(25):
+        small.add(i)
+        small.add(i)
+    assert small.estimate() == 25
+    assert participants.HyperLogLog(registers=b'\x01' * 7).estimate() == 0
+
+
+def test_sender_info_reads_message_metadata():
+    user = SimpleNamespace(sender_id=42, sender=SimpleNamespace(
+        username='alice', first_name='Alice', last_name=None, bot=False))
+    assert sender_info(user) == {'id': '42', 'peer_type': 'user',
+                                 'username': 'alice', 'display_name': 'Alice',
+                                 'is_bot': False}
+    post = SimpleNamespace(sender_id=-1001234, sender=SimpleNamespace(
+        title='TON News', username=None))
+    assert sender_info(post)['display_name'] == 'TON News'
+    assert sender_info(post)['peer_type'] == 'channel'
+    # Entity not attached: the id alone
+    assert sender_info(SimpleNamespace(sender_id=7, sender=None))['username'] is None
+    assert sender_info(SimpleNamespace(sender_id=None)) is None
+
+
+@pytest.mark.asyncio
+async def test_collector_tracks_senders(client, store, sender_rows):
+    today = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    old = today - timedelta(days=20)
+    alice = {'id': '1', 'peer_type': 'user', 'username': 'alice',
+             'display_name': 'Alice', 'is_bot': False}
+    await store.insert_messages(sender_rows('10', ['1', '2', '1', None], old),
+                                senders={'1': alice})
+    await store.insert_messages(sender_rows('10', ['1', '3'], today, first=10))
+    await store.insert_messages(sender_rows('20', ['1', '4', '5', '6'], today))
+    await store.commit()
+
+    sender = db.session.get(Sender, '1')
+    # Names survive batches without the entity
+    assert (sender.username, sender.display_name) == ('alice', 'Alice')
+    assert sender.message_count == 4
+    assert (sender.first_seen_at, sender.last_seen_at) == (old, today)
+
+    data = client.get('/api/senders/1').get_json()
+    assert data['display_name'] == 'Alice' and data['message_count'] == 4
+    assert client.get('/api/senders/99').status_code == 404
+
+    data = client.get(
+        '/api/messages?sender_id=1&fields=channel_id,sender_id').get_json()
+    assert data['total'] == 4
+    assert {m['sender_id'] for m in data['messages']} == {'1'}
+
+    overall = client.get('/api/participants').get_json()
+    assert overall['participants'] == 6
+    assert [(c['channel_title'], c['participants'])
+            for c in overall['channels']] == [('Channel 20', 4),
+                                              ('Channel 10', 3)]
+    week = client.get('/api/participants?days=7').get_json()
+    assert week['participants'] == 5
+    assert {c['channel_id']: c['participants'] for c in week['channels']} == \
+        {'20': 4, '10': 2}
+
+    page = client.get('/').data.decode()
+    assert '<th>Participants</th>' in page
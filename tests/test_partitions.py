@@ -0,0 +1,37 @@
+from datetime import date
+from unittest.mock import MagicMock
+import partitions
+from partitions import add_months, partition_name, apply_retention
+
+
+def test_add_months():
+    assert add_months(date(2025, 3, 15), 0) == date(2025, 3, 1)
+    assert add_months(date(2025, 11, 1), 2) == date(2026, 1, 1)
+    assert add_months(date(2025, 1, 31), -1) == date(2024, 12, 1)
+
+
+def test_partition_name():
+    assert partition_name(date(2025, 3, 1)) == 'telegram_messages_y2025m03'
+    assert partitions.PARTITION_NAME.match('telegram_messages_y2025m03')
+    assert not partitions.PARTITION_NAME.match('telegram_messages_default')
+
+
+def test_apply_retention_drops_only_expired_months(monkeypatch):
+    monkeypatch.setattr(partitions, 'list_partitions', lambda conn: [
+        (date(2024, 12, 1), 'telegram_messages_y2024m12'),
+        (date(2025, 1, 1), 'telegram_messages_y2025m01'),
+        (date(2025, 2, 1), 'telegram_messages_y2025m02'),
+        (date(2025, 3, 1), 'telegram_messages_y2025m03'),
+    ])
+    conn = MagicMock()
+
+    dropped = apply_retention(conn, keep_months=2, today=date(2025, 3, 20))
+
+    assert dropped == ['telegram_messages_y2024m12', 'telegram_messages_y2025m01']
+    statements = [str(call.args[0]) for call in conn.execute.call_args_list]
+    assert statements == [
+        'ALTER TABLE telegram_messages DETACH PARTITION telegram_messages_y2024m12',
+        'DROP TABLE telegram_messages_y2024m12',
+        'ALTER TABLE telegram_messages DETACH PARTITION telegram_messages_y2025m01',
+        'DROP TABLE telegram_messages_y2025m01',
+    ]
@@ -0,0 +1,74 @@
+import logging
+
+import pytest
+
+import profiling
+from app import app, db
+from config import Config
+from models import TelegramMessage
+
+
+@pytest.fixture
+def test_app():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_profile_counts_statements_and_flags_repeats(test_app, monkeypatch,
+                                                     caplog):
+    monkeypatch.setattr(Config, 'N_PLUS_ONE_THRESHOLD', 5)
+    with caplog.at_level(logging.WARNING, logger='profiling'):
+        with profiling.profile('test') as profile:
+            for channel_id in range(6):
+                TelegramMessage.query.filter_by(
+                    channel_id=str(channel_id)).first()
+            TelegramMessage.query.count()
+
+    assert profile.count == 7
+    assert profile.total_time > 0
+    assert len(profile.slowest()) == profiling.SLOWEST_KEPT
+    [(statement, count)] = profile.repeated(5)
+    assert count == 6 and 'telegram_messages' in statement
+    assert 'Possible N+1 in test: statement ran 6 times' in caplog.text
+    # Nothing is recorded once the profile ended
+    TelegramMessage.query.count()
+    assert profile.count == 7
+
+
+def test_slow_query_log_includes_plan(test_app, monkeypatch, caplog):
+    monkeypatch.setattr(Config, 'SLOW_QUERY_MS', 0.000001)
+    monkeypatch.setattr(Config, 'SLOW_QUERY_SAMPLE_RATE', 1.0)
+    with caplog.at_level(logging.WARNING, logger='profiling'):
+        TelegramMessage.query.filter_by(channel_id='1').all()
+
+    assert 'Slow query' in caplog.text
+    # SQLite's EXPLAIN QUERY PLAN mentions the table it reads
+    assert 'SCAN' in caplog.text or 'SEARCH' in caplog.text
+
+
+def test_debug_responses_carry_profile_headers(test_app, monkeypatch):
+    monkeypatch.setattr(app, 'debug', True)
+    response = test_app.test_client().get('/api/channels',
+                                          headers={'X-API-Key': 'wrong'})
+
+    assert response.status_code == 401
+    assert int(response.headers['X-DB-Queries']) >= 1
+    assert float(response.headers['X-DB-Time-Ms']) >= 0
+    assert 'api_keys' in response.headers['X-DB-Slowest']
+
+
+def test_headers_are_omitted_outside_debug(test_app):
+    response = test_app.test_client().get('/api/channels',
+                                          headers={'X-API-Key': 'wrong'})
+    assert 'X-DB-Queries' not in response.headers
+
+
+def test_failed_statement_does_not_leave_a_start_time(test_app):
+    with db.engine.connect() as conn:
+        with pytest.raises(Exception):
+            conn.exec_driver_sql('SELECT * FROM no_such_table')
+        assert conn.info.get('query_started') == []
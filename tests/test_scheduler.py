@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+from scheduler import PollScheduler
+from scopes import PriorityTier
+
+
+def make_tier():
+    return PriorityTier('default', poll_interval=30, catch_up_limit=20)
+
+
+def test_new_dialogs_are_due_immediately():
+    scheduler = PollScheduler()
+    tier = make_tier()
+    scheduler.register('1', tier, now=100)
+    scheduler.register('2', tier, now=100)
+
+    assert scheduler.pop_due(100) == ['1', '2']
+    assert scheduler.pop_due(100) == []
+    assert scheduler.seconds_until_next(100) is None
+
+
+def test_quiet_dialog_backs_off_exponentially():
+    scheduler = PollScheduler()
+    tier = make_tier()
+    scheduler.register('1', tier, now=0)
+    scheduler.pop_due(0)
+
+    intervals = []
+    now = 0
+    for _ in range(8):
+        interval = scheduler.record_poll('1', [], now)
+        intervals.append(interval)
+        now += interval
+        assert scheduler.pop_due(now) == ['1']
+
+    assert intervals[:3] == [60, 120, 240]
+    assert intervals[-1] == tier.max_interval
+
+
+def test_busy_dialog_tightens_interval():
+    scheduler = PollScheduler()
+    tier = make_tier()
+    start = datetime(2025, 3, 1)
+    seeded = [start + timedelta(seconds=i) for i in range(10)]
+    scheduler.register('1', tier, now=0, timestamps=seeded)
+    scheduler.pop_due(0)
+
+    new = [start + timedelta(seconds=10 + i) for i in range(5)]
+    interval = scheduler.record_poll('1', new, now=1, fetched=5)
+
+    assert interval == tier.min_interval
+    assert scheduler.dialogs['1'].rate > 0.5
+
+
+def test_full_catch_up_window_is_a_burst():
+    scheduler = PollScheduler()
+    tier = make_tier()
+    scheduler.register('1', tier, now=0)
+    scheduler.pop_due(0)
+
+    start = datetime(2025, 3, 1)
+    new = [start + timedelta(minutes=i) for i in range(20)]
+    assert scheduler.record_poll('1', new, now=0, fetched=20) == tier.min_interval
+
+
+def test_slow_dialog_stays_at_base_interval():
+    scheduler = PollScheduler()
+    tier = make_tier()
+    start = datetime(2025, 3, 1)
+    seeded = [start + timedelta(hours=i) for i in range(5)]
+    scheduler.register('1', tier, now=0, timestamps=seeded)
+    scheduler.pop_due(0)
+
+    interval = scheduler.record_poll('1', [start + timedelta(hours=5)], now=0,
+                                     fetched=1)
+    assert interval == tier.poll_interval
+
+
+def test_heap_orders_by_next_due_and_skips_removed():
+    scheduler = PollScheduler()
+    tier = make_tier()
+    for channel_id in ('a', 'b', 'c'):
+        scheduler.register(channel_id, tier, now=0)
+    scheduler.pop_due(0)
+
+    scheduler.record_poll('a', [], now=0)  # due at 60
+    scheduler.record_poll('b', [datetime(2025, 3, 1)], now=0, fetched=1)  # 30
+    scheduler.record_poll('c', [], now=10)  # due at 70
+    scheduler.remove('b')
+
+    assert scheduler.seconds_until_next(0) == 60
+    assert scheduler.pop_due(65) == ['a']
+    assert scheduler.pop_due(100) == ['c']
@@ -0,0 +1,81 @@
+import json
+import pytest
+from types import SimpleNamespace
+from scopes import ScopeConfig, PriorityTier
+
+
+def make_dialog(id, title, username=None, archived=False):
+    return SimpleNamespace(id=id,
+                           title=title,
+                           archived=archived,
+                           entity=SimpleNamespace(username=username))
+
+
+CONFIG = {
+    "tiers": {
+        "hot": {"poll_interval": 5, "catch_up_limit": 50},
+        "default": {"poll_interval": 30, "catch_up_limit": 20},
+        "archived": {"poll_interval": 3600, "catch_up_limit": 200}
+    },
+    "deny": ["Spam Chat"],
+    "scopes": [
+        {"tier": "hot", "folders": ["TON"]},
+        {"tier": "hot", "ton_dev_only": True},
+        {"tier": "archived", "archived": True},
+        {"tier": "default", "dialog_types": ["channel"], "deny": ["@muted"]}
+    ],
+    "default_tier": None
+}
+
+
+def test_default_config_collects_everything():
+    config = ScopeConfig.load()
+    tier = config.classify(make_dialog(1, "Anything"), dialog_type='private')
+    assert tier.name == 'default'
+    assert tier.poll_interval == 30
+    assert tier.catch_up_limit == 20
+
+
+def test_first_matching_scope_wins():
+    config = ScopeConfig.load(json.dumps(CONFIG))
+    folder_peers = {'ton': {10}}
+
+    assert config.classify(make_dialog(10, "News"), folder_peers,
+                           'channel').name == 'hot'
+    assert config.classify(make_dialog(11, "TON Dev Chat"), folder_peers,
+                           'group').name == 'hot'
+    assert config.classify(make_dialog(12, "Old", archived=True), folder_peers,
+                           'channel').name == 'archived'
+    assert config.classify(make_dialog(13, "News"), folder_peers,
+                           'channel').name == 'default'
+
+
+def test_out_of_scope_and_denied_dialogs_are_skipped():
+    config = ScopeConfig.load(json.dumps(CONFIG))
+
+    assert config.classify(make_dialog(14, "Friend"), {}, 'private') is None
+    assert config.classify(make_dialog(15, "Spam Chat"), {}, 'channel') is None
+    assert config.classify(make_dialog(16, "Muted", username="muted"), {},
+                           'channel') is None
+
+
+def test_allow_list_by_id():
+    config = ScopeConfig.from_dict({
+        "scopes": [{"tier": "default", "allow": [-100123]}],
+        "default_tier": None
+    })
+    assert config.classify(make_dialog(-100123, "A"), {}, 'channel') is not None
+    assert config.classify(make_dialog(-100124, "B"), {}, 'channel') is None
+
+
+def test_invalid_config():
+    with pytest.raises(ValueError):
+        ScopeConfig.from_dict({"scopes": [{"tier": "missing"}]})
+    with pytest.raises(ValueError):
+        PriorityTier('bad', poll_interval=0)
+
+
+def test_min_poll_interval():
+    config = ScopeConfig.load(json.dumps(CONFIG))
+    assert config.min_poll_interval == 5
+    assert config.folder_names == {'ton'}
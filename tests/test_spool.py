@@ -0,0 +1,168 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+import spool
+from app import app, db
+from async_db import CollectorStore
+from models import MessageTombstone, TelegramMessage
+from spool import Spool
+
+
+@pytest.fixture
+def database():
+    with app.app_context():
+        db.create_all()
+        yield
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest_asyncio.fixture
+async def store(tmp_path):
+    store = CollectorStore.from_url(spool_dir=str(tmp_path / 'spool'))
+    yield store
+    await store.close()
+
+
+def rows(channel, first, count):
+    start = datetime(2025, 3, 1)
+    return [{
+        'message_id': first + i,
+        'channel_id': channel,
+        'channel_title': f"Channel {channel}",
+        'content': f"message {first + i}",
+        'timestamp': start + timedelta(minutes=first + i),
+        'is_ton_dev': False,
+        'is_outgoing': False,
+        'dialog_type': 'channel',
+        'sender_id': 7,
+    } for i in range(count)]
+
+
+def stored_ids():
+    return sorted(m.message_id for m in TelegramMessage.query.all())
+
+
+def test_records_round_trip_and_rotate(tmp_path):
+    log = Spool(str(tmp_path), segment_bytes=1024, fsync=False)
+    for first in range(1, 100, 10):
+        log.append({'op': 'insert', 'rows': rows('1', first, 10), 'senders': []})
+    assert len(log.segments()) > 1
+    assert log.pending == 10
+    assert log.high_water['1'] == (100, datetime(2025, 3, 1, 1, 40))
+
+    records = list(log.unapplied())
+    assert [record['rows'][0]['message_id'] for _, record in records] == \
+        list(range(1, 100, 10))
+    assert records[0][1]['rows'][0]['timestamp'] == datetime(2025, 3, 1, 0, 1)
+
+    for position, _ in records[:5]:
+        log.advance(position)
+    log.checkpoint()
+    assert min(log.segments()) == records[4][0][0]
+
+    reopened = Spool(str(tmp_path), segment_bytes=1024, fsync=False)
+    assert reopened.pending == 5
+    assert [record['rows'][0]['message_id']
+            for _, record in reopened.unapplied()] == list(range(51, 100, 10))
+
+
+def test_rewind_and_full_replay(tmp_path):
+    log = Spool(str(tmp_path), fsync=False)
+    for op in ('a', 'b'):
+        log.append({'op': op})
+    for position, _ in log.unapplied():
+        log.advance(position)
+    log.rewind()
+    assert log.pending == 2
+    assert [record['op'] for _, record in log.unapplied()] == ['a', 'b']
+
+    for position, _ in log.unapplied():
+        log.advance(position)
+    log.checkpoint()
+    # Everything replayed: only a fresh, empty segment is left
+    assert len(log.segments()) == 1
+    assert os.path.getsize(log._path(log.segment)) == 0
+    assert list(Spool(str(tmp_path), fsync=False).unapplied()) == []
+
+
+def test_torn_and_damaged_records_are_not_replayed(tmp_path):
+    log = Spool(str(tmp_path), fsync=False)
+    log.append({'op': 'a'})
+    log.append({'op': 'b'})
+    log.close()
+    path = log._path(log.segment)
+    with open(path, 'ab') as f:
+        f.write(spool.encode({'op': 'c'})[:-3])
+    reopened = Spool(str(tmp_path), fsync=False)
+    assert [record['op'] for _, record in reopened.unapplied()] == ['a', 'b']
+    reopened.close()
+    # The torn tail was cut off, so appending goes on cleanly
+    assert os.path.getsize(path) == 2 * len(spool.encode({'op': 'a'}))
+
+    with open(path, 'r+b') as f:
+        f.seek(len(spool.encode({'op': 'a'})) + spool.HEADER.size + 3)
+        f.write(b'X')
+    reopened = Spool(str(tmp_path), fsync=False)
+    assert [record['op'] for _, record in reopened.unapplied()] == ['a']
+    assert reopened.pending == 1
+
+
+@pytest.mark.asyncio
+async def test_writes_are_spooled_while_database_is_down(database, store,
+                                                         monkeypatch):
+    async def unavailable(*args):
+        raise ConnectionError("database is down")
+
+    monkeypatch.setattr(store, '_insert_messages', unavailable)
+    assert await store.insert_messages(rows('1', 1, 3)) == 3
+    assert await store.insert_messages(rows('1', 4, 2)) == 2
+    assert store.spool.pending == 2
+    # Polling goes on from the spooled messages
+    assert (await store.latest_message('1')).message_id == 5
+
+    monkeypatch.undo()
+    # Retried only after the back-off
+    assert await store.replay() == 0
+    store._replay_at = 0.0
+    assert await store.delete_messages('1', [2]) == 1
+    await store.commit()
+    assert store.spool.pending == 0
+    assert stored_ids() == [1, 3, 4, 5]
+    assert MessageTombstone.query.one().message_id == 2
+
+
+@pytest.mark.asyncio
+async def test_replay_skips_messages_already_stored(database, tmp_path):
+    directory = str(tmp_path / 'spool')
+    store = CollectorStore.from_url(spool_dir=directory)
+    await store.insert_messages(rows('1', 1, 3))
+    await store.close()
+    assert stored_ids() == [1, 2, 3]
+
+    # A crash between the commit and the checkpoint
+    os.remove(os.path.join(directory, spool.CHECKPOINT_FILE))
+    log = Spool(directory)
+    log.append({'op': 'insert', 'rows': rows('1', 1, 4), 'senders': []})
+    log.close()
+    store = CollectorStore.from_url(spool_dir=directory)
+    assert await store.replay() == 1
+    await store.close()
+    assert stored_ids() == [1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_rolled_back_batch_is_replayed(database, store):
+    # SQLite keeps a batch transaction open; losing it loses spooled rows
+    assert store.batch_rows is not None
+    await store.insert_messages(rows('1', 1, 2))
+    await store._rollback()
+    assert store.spool.pending == 1
+
+    await store.replay()
+    await store.commit()
+    assert stored_ids() == [1, 2]
+    assert store.spool.pending == 0
@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+from sqlalchemy import create_engine, text
+
+from benchmarks.startup import parse_importtime
+from manage import (add_missing_columns, add_missing_indexes,
+                    drop_superseded_indexes)
+from models import TelegramMessage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import sys, threading
+import main
+print(sorted({m.split('.')[0] for m in sys.modules} & {'telethon', 'collector'}))
+print(sorted(t.name for t in threading.enumerate()))
+"""
+
+
+def _run(args, database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    return subprocess.run([sys.executable] + args, cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def _tables(path):
+    with sqlite3.connect(path) as conn:
+        return {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_web_import_is_lazy(tmp_path):
+    path = tmp_path / 'web.db'
+    out = _run(['-c', PROBE], f'sqlite:///{path}').stdout.splitlines()
+
+    assert out[0] == '[]'  # neither Telethon nor the collector
+    assert 'collector' not in out[1].lower()
+    assert not path.exists() or not _tables(path)
+
+
+def test_init_db_creates_tables(tmp_path):
+    path = tmp_path / 'init.db'
+    _run(['manage.py', 'init-db'], f'sqlite:///{path}')
+
+    assert {'telegram_messages', 'collector_heartbeats'} <= _tables(path)
+
+
+def test_parse_importtime():
+    stderr = ("import time: self [us] | cumulative | imported package\n"
+              "import time:       120 |        120 |   json.decoder\n"
+              "import time:        80 |        200 | json\n")
+    assert parse_importtime(stderr) == [('json.decoder', 120, 120),
+                                        ('json', 80, 200)]
+
+
+def test_add_missing_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE telegram_messages (id INTEGER PRIMARY KEY, "
+                          "message_id INTEGER NOT NULL, channel_id VARCHAR(100) "
+                          "NOT NULL, content TEXT)"))
+        added = add_missing_columns(conn, TelegramMessage.metadata)
+    assert 'telegram_messages.content_zstd' in added
+    assert 'telegram_messages.content' not in added
+    with engine.begin() as conn:
+        assert add_missing_columns(conn, TelegramMessage.metadata) == []
+        added = add_missing_indexes(conn, TelegramMessage.metadata)
+        assert 'ix_telegram_messages_sender' in added
+        assert add_missing_indexes(conn, TelegramMessage.metadata) == []
+
+
+def test_drop_superseded_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    TelegramMessage.__table__.create(engine)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX ix_telegram_messages_channel_message "
+                          "ON telegram_messages (channel_id, message_id)"))
+        assert drop_superseded_indexes(conn) == [
+            'ix_telegram_messages_channel_message']
+        assert drop_superseded_indexes(conn) == []
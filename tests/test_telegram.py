@@ -1,6 +1,6 @@
 import pytest
 from unittest.mock import MagicMock, patch
-from collector import collect_messages
+from collector import collect_messages, run_collection
 from models import TelegramMessage
 from utils import should_be_ton_dev
 
@@ -43,16 +43,19 @@ async def test_collect_messages_handles_empty_session():
         mock_exists.assert_called_once_with('ton_collector_session.session')
 
 @pytest.mark.asyncio
-async def test_collect_messages_processes_ton_channels(mock_telegram_channel, mock_telegram_message):
+async def test_collect_messages_processes_ton_channels():
     """Test collector properly processes TON dev channels"""
-    # Mock the TelegramClient
-    mock_client = MagicMock()
-    mock_client.get_dialogs.return_value = [mock_telegram_channel]
-    mock_client.iter_messages.return_value = [mock_telegram_message]
-    
-    with patch('telethon.TelegramClient', return_value=mock_client):
-        await collect_messages()
-        
-        # Verify dialog was processed
-        mock_client.get_dialogs.assert_called_once()
-        mock_client.iter_messages.assert_called_once()
+    from app import app, db
+    from benchmarks.fake_telegram import FakeTelegramClient
+
+    mock_client = FakeTelegramClient(dialogs=17, backlog=1, mean_rate=0)
+
+    with app.app_context():
+        db.create_all()
+        await run_collection(mock_client, max_cycles=1)
+
+        # Verify dialogs were listed once and every dialog was polled
+        assert mock_client.stats['get_dialogs'] == 1
+        assert mock_client.stats['iter_messages'] == 17
+        assert TelegramMessage.query.filter_by(is_ton_dev=True).count() == 1
+        db.drop_all()
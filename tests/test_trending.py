@@ -0,0 +1,114 @@
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+
+import trending
+from app import db
+from models import TermSketch
+
+
+def test_extract_items():
+    items = trending.extract(
+        "Mainnet upgrade is LIVE! #TON #ton read https://Ton.org/news/?utm=x, "
+        "ask @ton_support or t.me/toncoin. Upgrade today")
+    assert items['hashtags'] == {'ton'}
+    assert items['mentions'] == {'ton_support'}
+    assert items['links'] == {'ton.org/news', 't.me/toncoin'}
+    assert items['terms'] == {'mainnet', 'upgrade', 'live', 'read', 'ask',
+                              'today'}
+    assert trending.extract(None)['terms'] == set()
+
+
+def test_space_saving_keeps_heavy_hitters():
+    rng = random.Random(3)
+    stream = [f"rare{rng.randrange(5000)}" for _ in range(3000)] + \
+        ['ton'] * 300 + ['gram'] * 200
+    rng.shuffle(stream)
+    halves = trending.SpaceSaving(20), trending.SpaceSaving(20)
+    for i, item in enumerate(stream):
+        halves[i % 2].offer(item)
+
+    merged = trending.SpaceSaving(20)
+    for half in halves:
+        merged.merge(trending.SpaceSaving.loads(half.dumps(), 20))
+    (first, count), (second, _) = merged.top(2)
+    assert (first, second) == ('ton', 'gram')
+    # Counts are upper bounds, off by at most the error
+    assert count - merged.errors['ton'] <= 300 <= count
+    assert len(merged.counts) == 20
+
+
+def test_space_saving_merge_bounds_items_missing_from_one_side():
+    first, second = trending.SpaceSaving(2), trending.SpaceSaving(2)
+    for item in 'xxxxxyyyz':
+        first.offer(item)
+    for item in 'xxyyyww':
+        second.offer(item)
+    # Each side evicted an item the other kept
+    assert 'y' not in first.counts and 'x' not in second.counts
+
+    first.merge(second)
+    true_counts = Counter('xxxxxyyyz' + 'xxyyyww')
+    for item, count in first.counts.items():
+        assert count - first.errors[item] <= true_counts[item] <= count
+
+
+def test_count_min_sketch_merges():
+    first, second = trending.CountMinSketch(256, 4), trending.CountMinSketch(256, 4)
+    truth = Counter()
+    for i in range(2000):
+        item = f"item{i % 300}"
+        (first if i % 2 else second).offer(item)
+        truth[item] += 1
+    first.merge(trending.CountMinSketch.loads(second.dumps(), 256, 4))
+    assert all(first.estimate(item) >= count for item, count in truth.items())
+    assert first.estimate('item7') <= truth['item7'] + 2000 // 256 * 4
+    assert trending.CountMinSketch.loads(b'', 256, 4).estimate('item7') == 0
+
+
+@pytest.mark.asyncio
+async def test_collector_feeds_trending_endpoint(client, store, rows):
+    now = datetime.utcnow().replace(microsecond=0)
+    day_before = now - timedelta(hours=30)
+    await store.insert_messages(rows('1', ["Airdrop season #ton"] * 3 +
+                                     ["Validators wanted #jobs"], now))
+    await store.insert_messages(rows('2', ["New wallet release #ton"], now))
+    await store.insert_messages(rows('2', ["Quiet day #ton"], day_before,
+                                     first=10))
+    await store.commit()
+
+    data = client.get('/api/trending?period=day&kind=hashtags').get_json()
+    assert data['messages'] == 5
+    assert [(i['item'], i['count'], i['previous']) for i in data['items']] == \
+        [('ton', 4, 1), ('jobs', 1, 0)]
+
+    data = client.get('/api/trending?period=hour&channel=Channel 1').get_json()
+    assert data['items'][0] == {'item': 'airdrop', 'count': 3, 'error': 0,
+                                'previous': 0}
+
+    week = client.get(
+        '/api/trending?period=week&kind=hashtags&limit=1').get_json()
+    assert [(i['item'], i['count']) for i in week['items']] == [('ton', 5)]
+
+    assert client.get('/api/trending?kind=emoji').status_code == 400
+    assert client.get('/api/trending?channel=Nope').status_code == 404
+    page = client.get('/').data.decode()
+    assert '<td>airdrop</td>' in page and 'Trending Hashtags' in page
+
+
+def test_prune_drops_expired_buckets(client):
+    now = datetime(2025, 3, 20, 12)
+    for granularity, age in [('hour', timedelta(hours=60)),
+                             ('hour', timedelta(hours=2)),
+                             ('day', timedelta(days=20)),
+                             ('day', timedelta(days=8))]:
+        db.session.add(TermSketch(
+            scope='*', kind='terms', granularity=granularity,
+            bucket_start=trending.bucket_start(now - age, granularity)))
+    db.session.commit()
+    db.session.execute(trending.prune_statement(now))
+    db.session.commit()
+    assert sorted((s.granularity, s.bucket_start) for s in TermSketch.query) == [
+        ('day', datetime(2025, 3, 12)), ('hour', datetime(2025, 3, 20, 10))]
@@ -0,0 +1,356 @@
+"""Trending terms, hashtags, links and mentions from streaming sketches.
+
+Counting words over the message table on demand would scan every message of
+the period, so the collector keeps the counts as it stores batches instead.
+For every scope (all messages, and each channel), kind of term and time
+bucket, `term_sketches` holds:
+
+* a Space-Saving summary of the TRENDING_CAPACITY most frequent items, with
+  the overestimate of each count;
+* for the global scope, a Count-Min sketch of every item's frequency
+  (TRENDING_CMS_DEPTH x TRENDING_CMS_WIDTH counters).
+
+Both have a fixed size whatever the message volume, and both merge: the
+"last day" is the merge of 24 hour buckets, the "last week" of 7 day buckets.
+Hour buckets are kept for two days and day buckets for two weeks, so the
+previous period is at hand for comparison. An item is counted once per
+message.
+"""
+import hashlib
+import json
+import re
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from config import Config
+from models import TermSketch
+from versions import GLOBAL_SCOPE
+
+KINDS = ('terms', 'hashtags', 'links', 'mentions')
+
+GRANULARITIES = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+RETENTION = {'hour': timedelta(hours=49), 'day': timedelta(days=15)}
+# period -> (granularity, number of buckets)
+PERIODS = {'hour': ('hour', 1), 'day': ('hour', 24), 'week': ('day', 7)}
+
+_LINK = re.compile(r'https?://[^\s<>"\']+|\bt\.me/[^\s<>"\']+', re.IGNORECASE)
+_HASHTAG = re.compile(r'#(\w+)')
+_MENTION = re.compile(r'(?<![\w.])@(\w{4,32})')
+_WORD = re.compile(r'[^\W\d_][\w\'-]+')
+_TRAILING = '.,;:!?)]}\'"'
+
+STOPWORDS = frozenset("""
+a about after all also an and any are as at be been but by can could did do
+does for from had has have he her here his how i if in into is it its just
+me more most my no not now of on one only or our out over she so some than
+that the their them then there these they this to up us was we were what
+when where which who will with would you your
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы
+по только ее мне было вот от меня еще нет о из ему теперь когда даже ну ли
+если уже или ни быть был него до вас нибудь опять уж вам ведь там потом себя
+ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб
+без будто чего раз тоже себе под будет ж тогда кто этот того потому этого
+какой совсем ним здесь этом один почти мой тем чтобы нее были куда зачем
+всех никогда можно при наконец два об другой хоть после над больше тот через
+эти нас про всего них какая много разве три эту моя впрочем хорошо свою этой
+перед иногда лучше чуть том нельзя такой им более всегда конечно всю между
+это
+""".split())
+
+
+def extract(text):
+    """Distinct items of each kind in a message text"""
+    items = {kind: set() for kind in KINDS}
+    if not text:
+        return items
+    for link in _LINK.findall(text):
+        link = link.rstrip(_TRAILING)
+        if '://' not in link:
+            link = 'https://' + link
+        scheme, _, rest = link.partition('://')
+        host, _, path = rest.partition('/')
+        path = path.split('?', 1)[0].split('#', 1)[0].rstrip('/')
+        items['links'].add(host.lower() + ('/' + path if path else ''))
+    text = _LINK.sub(' ', text)
+    items['hashtags'].update(tag.lower() for tag in _HASHTAG.findall(text))
+    items['mentions'].update(name.lower() for name in _MENTION.findall(text))
+    text = _MENTION.sub(' ', _HASHTAG.sub(' ', text))
+    for word in _WORD.findall(text.casefold()):
+        word = word.strip('\'-')
+        if len(word) >= 3 and word not in STOPWORDS:
+            items['terms'].add(word)
+    return items
+
+
+def bucket_start(timestamp, granularity):
+    start = timestamp.replace(minute=0, second=0, microsecond=0)
+    return start.replace(hour=0) if granularity == 'day' else start
+
+
+class SpaceSaving:
+    """Top-k heavy hitters in fixed space (Metwally et al.)
+
+    Counts are upper bounds; `errors` holds how much each may be over.
+    """
+
+    def __init__(self, capacity, counts=None, errors=None):
+        self.capacity = capacity
+        self.counts = counts or {}
+        self.errors = errors or {}
+
+    def offer(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            evicted = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(evicted)
+            del self.errors[evicted]
+            self.counts[item] = floor + count
+            self.errors[item] = floor
+
+    def merge(self, other):
+        """Fold in a summary of other messages (Agarwal et al. merge)
+
+        An item missing from a full summary may have been counted there up
+        to that summary's smallest counter, so it is charged that much.
+        """
+        own_floor = self._floor()
+        other_floor = other._floor()
+        for item in self.counts:
+            if item not in other.counts:
+                self.counts[item] += other_floor
+                self.errors[item] += other_floor
+        for item, count in other.counts.items():
+            if item in self.counts:
+                self.counts[item] += count
+                self.errors[item] += other.errors[item]
+            else:
+                self.counts[item] = count + own_floor
+                self.errors[item] = other.errors[item] + own_floor
+        if len(self.counts) > self.capacity:
+            keep = sorted(self.counts, key=self.counts.get,
+                          reverse=True)[:self.capacity]
+            self.counts = {item: self.counts[item] for item in keep}
+            self.errors = {item: self.errors[item] for item in keep}
+
+    def _floor(self):
+        """Most a missing item can have been counted: 0 unless full"""
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def top(self, limit):
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def dumps(self):
+        return json.dumps([[item, count, self.errors[item]]
+                           for item, count in self.top(self.capacity)],
+                          ensure_ascii=False)
+
+    @classmethod
+    def loads(cls, data, capacity):
+        summary = cls(capacity)
+        for item, count, error in json.loads(data) if data else ():
+            summary.counts[item] = count
+            summary.errors[item] = error
+        return summary
+
+
+class CountMinSketch:
+    """Frequency estimates of any item in depth x width counters"""
+
+    def __init__(self, width, depth, counters=None):
+        self.width = width
+        self.depth = depth
+        self.counters = counters if counters is not None else \
+            array('I', bytes(4 * width * depth))
+
+    def _cells(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (first + row * second) % self.width
+                for row in range(self.depth)]
+
+    def offer(self, item, count=1):
+        for cell in self._cells(item):
+            self.counters[cell] += count
+
+    def estimate(self, item):
+        return min(self.counters[cell] for cell in self._cells(item))
+
+    def merge(self, other):
+        for cell, count in enumerate(other.counters):
+            if count:
+                self.counters[cell] += count
+
+    def dumps(self):
+        return self.counters.tobytes()
+
+    @classmethod
+    def loads(cls, data, width, depth):
+        counters = array('I')
+        if data and len(data) == 4 * width * depth:
+            counters.frombytes(data)
+            return cls(width, depth, counters)
+        # Missing, or stored with other dimensions: start over
+        return cls(width, depth)
+
+
+def _new_summary():
+    return SpaceSaving(Config.TRENDING_CAPACITY)
+
+
+def _new_sketch(scope):
+    if scope != GLOBAL_SCOPE:
+        return None
+    return CountMinSketch(Config.TRENDING_CMS_WIDTH, Config.TRENDING_CMS_DEPTH)
+
+
+def tally(rows, now=None):
+    """Item counts of message rows, per (scope, kind, granularity, bucket)
+
+    Returns {key: [Counter, messages]}. Messages older than the day buckets
+    are kept for are skipped.
+    """
+    now = now or datetime.utcnow()
+    horizon = bucket_start(now - RETENTION['day'], 'day')
+    deltas = {}
+    for row in rows:
+        timestamp = row.get('timestamp')
+        if timestamp is None or timestamp < horizon:
+            continue
+        items = extract(row.get('content'))
+        for granularity in GRANULARITIES:
+            start = bucket_start(timestamp, granularity)
+            if start < now - RETENTION[granularity]:
+                continue
+            for scope in (GLOBAL_SCOPE, row['channel_id']):
+                for kind in KINDS:
+                    delta = deltas.setdefault((scope, kind, granularity, start),
+                                              [Counter(), 0])
+                    delta[0].update(items[kind])
+                    delta[1] += 1
+    return deltas
+
+
+# Plain rows: ORM instances would be served stale from a long-lived session
+_COLUMNS = (TermSketch.scope, TermSketch.kind, TermSketch.granularity,
+            TermSketch.bucket_start, TermSketch.messages, TermSketch.top,
+            TermSketch.counts)
+
+
+def lookup_query(keys):
+    """Stored sketches for the keys of a `tally`"""
+    return select(*_COLUMNS).where(
+        TermSketch.scope.in_({key[0] for key in keys}),
+        TermSketch.kind.in_({key[1] for key in keys}),
+        TermSketch.granularity.in_({key[2] for key in keys}),
+        TermSketch.bucket_start.in_({key[3] for key in keys}))
+
+
+def apply(stored, deltas, now):
+    """Rows for `upsert_statement`: stored sketches plus the deltas
+
+    `stored` maps keys to TermSketch rows already in the database.
+    """
+    rows = []
+    for key, (counts, messages) in deltas.items():
+        scope, kind, granularity, start = key
+        row = stored.get(key)
+        summary = SpaceSaving.loads(row.top, Config.TRENDING_CAPACITY) \
+            if row is not None else _new_summary()
+        sketch = _new_sketch(scope)
+        if sketch is not None and row is not None:
+            sketch = CountMinSketch.loads(row.counts, sketch.width, sketch.depth)
+        # Heaviest first, so rare items are the ones evicted
+        for item, count in counts.most_common():
+            summary.offer(item, count)
+            if sketch is not None:
+                sketch.offer(item, count)
+        rows.append({
+            'scope': scope, 'kind': kind, 'granularity': granularity,
+            'bucket_start': start,
+            'messages': (row.messages if row is not None else 0) + messages,
+            'top': summary.dumps(),
+            'counts': sketch.dumps() if sketch is not None else None,
+            'updated_at': now,
+        })
+    return rows
+
+
+def upsert_statement(dialect_name):
+    dialect = postgresql if dialect_name == 'postgresql' else sqlite
+    stmt = dialect.insert(TermSketch)
+    return stmt.on_conflict_do_update(
+        index_elements=[TermSketch.scope, TermSketch.kind,
+                        TermSketch.granularity, TermSketch.bucket_start],
+        set_={column: stmt.excluded[column]
+              for column in ('messages', 'top', 'counts', 'updated_at')})
+
+
+def prune_statement(now=None):
+    """Delete buckets older than their granularity is kept for"""
+    now = now or datetime.utcnow()
+    return delete(TermSketch).where(or_(*(
+        (TermSketch.granularity == granularity) &
+        (TermSketch.bucket_start < bucket_start(now - keep, granularity))
+        for granularity, keep in RETENTION.items())))
+
+
+def _merged(session, scope, kind, granularity, starts):
+    summary, sketch, messages = _new_summary(), _new_sketch(scope), 0
+    rows = session.execute(select(*_COLUMNS).where(
+        TermSketch.scope == scope, TermSketch.kind == kind,
+        TermSketch.granularity == granularity,
+        TermSketch.bucket_start.in_(starts)))
+    for row in rows:
+        summary.merge(SpaceSaving.loads(row.top, Config.TRENDING_CAPACITY))
+        if sketch is not None:
+            sketch.merge(CountMinSketch.loads(row.counts, sketch.width,
+                                              sketch.depth))
+        messages += row.messages
+    return summary, sketch, messages
+
+
+def top(session, period='day', kind='terms', scope=GLOBAL_SCOPE, limit=20,
+        now=None):
+    """Most frequent items of the period, with the previous period's counts
+
+    Returns (items, messages) where items are dicts of `item`, `count`,
+    `error` (how much `count` may be over) and `previous`.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period: {period}")
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind: {kind}")
+    granularity, buckets = PERIODS[period]
+    step = GRANULARITIES[granularity]
+    newest = bucket_start(now or datetime.utcnow(), granularity)
+    starts = [newest - i * step for i in range(2 * buckets)]
+
+    summary, sketch, messages = _merged(session, scope, kind, granularity,
+                                        starts[:buckets])
+    before, before_sketch, _ = _merged(session, scope, kind, granularity,
+                                       starts[buckets:])
+    items = []
+    for item, count in summary.top(limit):
+        error = summary.errors[item]
+        if sketch is not None:
+            # Both are upper bounds; keep the tighter one
+            estimate = sketch.estimate(item)
+            if estimate < count:
+                count, error = estimate, min(error, estimate)
+        previous = before_sketch.estimate(item) if before_sketch is not None \
+            else before.counts.get(item, 0)
+        items.append({'item': item, 'count': count, 'error': error,
+                      'previous': previous})
+    items.sort(key=lambda entry: (-entry['count'], entry['item']))
+    return items, messages
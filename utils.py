@@ -40,3 +40,45 @@ def get_proper_dialog_type(entity) -> str:
     except Exception as e:
         logger.error(f"Error determining dialog type: {str(e)}")
         return 'unknown'
+
+def forward_origin(message):
+    """(peer id, message id, date) a forwarded message was copied from
+
+    Read from the message's own forward header, so no request is made. All
+    None for messages that are not forwards.
+    """
+    fwd = getattr(message, 'fwd_from', None)
+    if fwd is None:
+        return None, None, None
+    from_id = getattr(fwd, 'from_id', None)
+    peer_id = None
+    if from_id is not None:
+        try:
+            from telethon.utils import get_peer_id
+            peer_id = str(get_peer_id(from_id))
+        except Exception as e:
+            logger.error(f"Error resolving forward origin: {str(e)}")
+    return peer_id, getattr(fwd, 'channel_post', None), getattr(fwd, 'date', None)
+
+def sender_info(message):
+    """Fields of `senders` for a message's author, or None
+
+    Only the message and the entities Telethon attached to it are read;
+    `message.sender` is None when the entity did not come along.
+    """
+    sender_id = getattr(message, 'sender_id', None)
+    if sender_id is None:
+        return None
+    sender = getattr(message, 'sender', None)
+    info = {'id': str(sender_id),
+            'peer_type': 'user' if sender_id > 0 else
+            'channel' if str(sender_id).startswith('-100') else 'chat',
+            'username': getattr(sender, 'username', None),
+            'display_name': None,
+            'is_bot': getattr(sender, 'bot', None)}
+    if sender is not None:
+        name = getattr(sender, 'title', None) or ' '.join(
+            part for part in (getattr(sender, 'first_name', None),
+                              getattr(sender, 'last_name', None)) if part)
+        info['display_name'] = name or None
+    return info
@@ -0,0 +1,132 @@
+"""Change versions and conditional GET for the dashboard and API.
+
+Every batch the collector stores bumps a global counter and one counter per
+channel in `change_versions`, inside the same transaction as the messages,
+so a version becomes visible exactly when its rows do. Views wrapped in
+`conditional` look up the relevant version (a primary-key read of a tiny
+table), derive an ETag and Last-Modified from it, and answer
+If-None-Match / If-Modified-Since with 304 before any message is read.
+"""
+import hashlib
+from datetime import timezone
+from functools import wraps
+
+from flask import Response, make_response, request
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+from models import ChangeVersion
+
+GLOBAL_SCOPE = '*'
+
+
+def bump_statement(dialect_name):
+    """Upsert adding one to each given scope's version
+
+    Execute with rows of `scope`, `channel_title` and `changed_at`.
+    """
+    dialect = postgresql if dialect_name == 'postgresql' else sqlite
+    stmt = dialect.insert(ChangeVersion).values(version=1)
+    return stmt.on_conflict_do_update(
+        index_elements=[ChangeVersion.scope],
+        set_={
+            'version': ChangeVersion.version + 1,
+            'changed_at': stmt.excluded.changed_at,
+            'channel_title': func.coalesce(stmt.excluded.channel_title,
+                                           ChangeVersion.channel_title),
+        })
+
+
+def bump_rows(messages, now):
+    """Scopes touched by a batch of message rows: global plus each channel"""
+    rows = {GLOBAL_SCOPE: {'scope': GLOBAL_SCOPE, 'channel_title': None,
+                           'changed_at': now}}
+    for message in messages:
+        rows[message['channel_id']] = {'scope': message['channel_id'],
+                                       'channel_title': message.get('channel_title'),
+                                       'changed_at': now}
+    return list(rows.values())
+
+
+def current_version(channel_title=None):
+    """(version, changed_at, scopes) of everything, or of one channel by title
+
+    Several chats can share a title; the version is then the sum of theirs,
+    which goes up whenever any of them changes, and `scopes` holds each
+    chat's (scope, version) so the ETag also changes when the set of chats
+    does. (0, None, ()) until the collector stored its first batch.
+    """
+    query = select(ChangeVersion.scope, ChangeVersion.version,
+                   ChangeVersion.changed_at)
+    if channel_title:
+        query = query.where(ChangeVersion.channel_title == channel_title)
+    else:
+        query = query.where(ChangeVersion.scope == GLOBAL_SCOPE)
+    rows = db.session.execute(query.order_by(ChangeVersion.scope)).all()
+    if not rows:
+        return 0, None, ()
+    return (sum(row.version for row in rows),
+            max((row.changed_at for row in rows if row.changed_at),
+                default=None),
+            tuple((row.scope, row.version) for row in rows))
+
+
+def make_etag(version, *salt):
+    """Opaque tag for this URL and representation at `version`"""
+    key = '|'.join(str(part) for part in (
+        version, request.full_path, request.headers.get('Accept', ''), *salt))
+    return f"{version}-{hashlib.blake2s(key.encode(), digest_size=8).hexdigest()}"
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        # If-None-Match wins over If-Modified-Since (RFC 9110 13.2.2)
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return last_modified is not None and since is not None and \
+        last_modified.replace(microsecond=0) <= since
+
+
+def _validators(response, etag, last_modified):
+    # Weak, since the body may be gzip-encoded on the way out
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept')
+    return response
+
+
+def conditional(channel_arg=None, salt=None):
+    """Serve 304 while the relevant change version is unchanged
+
+    `channel_arg` names a query parameter holding a channel title; when it is
+    set, the channel's own version is used instead of the global one. `salt`
+    returns extra values that change the response, such as the current hour
+    for views showing rolling time windows.
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            channel = request.args.get(channel_arg) if channel_arg else None
+            version, changed_at, scopes = current_version(channel)
+            etag = make_etag(version, *scopes, *(salt() if salt else ()))
+            last_modified = changed_at.replace(tzinfo=timezone.utc) \
+                if changed_at else None
+
+            if _not_modified(etag, last_modified):
+                return _validators(Response(status=304), etag, last_modified)
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                _validators(response, etag, last_modified)
+            return response
+
+        return wrapper
+
+    return decorator